@@ -0,0 +1,435 @@
+import argparse
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import ujson as json
+
+from nupic.bindings.algorithms import SpatialPooler as SP
+from nupic.bindings.algorithms import TemporalMemory as TM
+
+from nupic_history import SpSnapshots as SP_SNAPS
+from nupic_history import TmSnapshots as TM_SNAPS
+from nupic_history import wire
+from nupic_history.io_client import FileIoClient
+from nupic_history.sp_facade import SpFacade
+from nupic_history.tm_facade import TmFacade
+from nupic_history.write_queue import WriteQueue
+
+
+
+def makePreset(numInputs, numColumns, cellsPerColumn, activeColumns,
+               sparsity=0.1):
+  """
+  SP and TM params for one model size. The SP params are the ones from the
+  README.
+  """
+  return {
+    "sp": {
+      "inputDimensions": [numInputs],
+      "columnDimensions": [numColumns],
+      "potentialRadius": 16,
+      "potentialPct": 0.85,
+      "globalInhibition": True,
+      "localAreaDensity": -1.0,
+      "numActiveColumnsPerInhArea": float(activeColumns),
+      "stimulusThreshold": 1,
+      "synPermInactiveDec": 0.008,
+      "synPermActiveInc": 0.05,
+      "synPermConnected": 0.10,
+      "minPctOverlapDutyCycle": 0.001,
+      "dutyCyclePeriod": 1000,
+      "boostStrength": 0.0,
+      "seed": 42,
+      "spVerbosity": 0,
+      "wrapAround": True,
+    },
+    "tm": {
+      "columnDimensions": [numColumns],
+      "cellsPerColumn": cellsPerColumn,
+      "activationThreshold": 13,
+      "initialPermanence": 0.21,
+      "connectedPermanence": 0.5,
+      "minThreshold": 10,
+      "maxNewSynapseCount": 20,
+      "permanenceIncrement": 0.1,
+      "permanenceDecrement": 0.1,
+      "predictedSegmentDecrement": 0.0,
+      "maxSegmentsPerCell": 255,
+      "maxSynapsesPerSegment": 255,
+      "seed": 42,
+    },
+    "sparsity": sparsity,
+  }
+
+
+PRESETS = {
+  "small": makePreset(256, 512, 8, 10),
+  # The README's SP.
+  "readme": makePreset(1024, 2048, 32, 40),
+  "large": makePreset(4096, 4096, 32, 80),
+}
+
+# How history is stored. None runs without saving.
+STORAGE_MODES = {
+  "memory": None,
+  "full": {"keyframeInterval": 1, "historyMode": FileIoClient.DELTA},
+  "delta": {"keyframeInterval": 16, "historyMode": FileIoClient.DELTA},
+  "replay": {"keyframeInterval": 16, "historyMode": FileIoClient.REPLAY},
+}
+
+# What each iteration computes.
+#   sp: SpFacade.compute + getState + save
+#   tm: TmFacade.compute + getState + save
+#   http: PUT /_compute/ (SP, TM and classifier) through the web app in-process
+SCENARIOS = ["sp", "tm", "http"]
+
+MODEL_ID = "bench"
+
+
+
+def makeEncodings(numInputs, sparsity, count, sequenceLength=32, seed=42):
+  """
+  Synthetic sparse encodings: a sequence of random patterns, repeated, so the
+  TM has something to learn.
+  :return: list of sorted uint32 on-bit index arrays
+  """
+  rng = np.random.RandomState(seed)
+  onBits = max(int(numInputs * sparsity), 1)
+  patterns = [
+    np.sort(rng.choice(numInputs, onBits, replace=False)).astype("uint32")
+    for _ in xrange(sequenceLength)
+  ]
+  return [patterns[i % sequenceLength] for i in xrange(count)]
+
+
+
+def toDense(indices, length):
+  dense = np.zeros(length, dtype="uint32")
+  dense[indices] = 1
+  return dense
+
+
+
+def makeIoClient(workingDir, mode):
+  # Redis cases are configured the same way as the web server. Redis is only
+  # imported for them, so file-only runs do not need it installed.
+  if "NUPIC_HISTORY_REDIS_URL" in os.environ:
+    from nupic_history.redis_io_client import RedisIoClient
+    return RedisIoClient(
+      url=os.environ["NUPIC_HISTORY_REDIS_URL"],
+      prefix=os.environ["NUPIC_HISTORY_REDIS_PREFIX"],
+      writeQueue=WriteQueue(workers=2, maxDepth=256), **(mode or {})
+    )
+  return FileIoClient(
+    workingDir=workingDir, writeQueue=WriteQueue(workers=2, maxDepth=256),
+    **(mode or {})
+  )
+
+
+
+def directorySize(path):
+  size = 0
+  for root, _, files in os.walk(path):
+    for name in files:
+      size += os.path.getsize(os.path.join(root, name))
+  return size
+
+
+
+def runSp(preset, mode, snapshot, encodings, workingDir):
+  ioClient = makeIoClient(workingDir, mode)
+  sp = SpFacade(SP(**preset["sp"]), ioClient, modelId=MODEL_ID)
+  numInputs = preset["sp"]["inputDimensions"][0]
+  states = [snapshot] if snapshot is not None else []
+  latencies = []
+  start = time.time()
+  for indices in encodings:
+    encoding = toDense(indices, numInputs)
+    computeStart = time.time()
+    sp.compute(encoding, learn=True, save=mode is not None)
+    sp.getState(*states)
+    latencies.append((time.time() - computeStart) * 1000)
+  ioClient.flush()
+  return latencies, time.time() - start, 0
+
+
+
+def runTm(preset, mode, snapshot, encodings, workingDir):
+  ioClient = makeIoClient(workingDir, mode)
+  tm = TmFacade(TM(**preset["tm"]), ioClient, modelId=MODEL_ID)
+  states = [snapshot] if snapshot is not None else []
+  latencies = []
+  start = time.time()
+  for activeColumns in encodings:
+    computeStart = time.time()
+    tm.compute(activeColumns, learn=True, save=mode is not None)
+    tm.getState(*states)
+    latencies.append((time.time() - computeStart) * 1000)
+  ioClient.flush()
+  return latencies, time.time() - start, 0
+
+
+
+def runHttp(preset, mode, snapshot, encodings, workingDir):
+  # The web server builds its IO client when imported, so it must be imported
+  # here, after the working directory is set.
+  os.environ["NUPIC_HISTORY_WORKING_DIR"] = workingDir
+  import webserver
+  app = webserver.app
+  spCreate = {
+    "id": MODEL_ID,
+    "params": preset["sp"],
+    "states": [],
+    "save": mode is not None,
+  }
+  spCreate.update(mode or {})
+  app.request("/_sp/", method="POST", data=json.dumps(spCreate))
+  app.request(
+    "/_tm/?id={}".format(MODEL_ID), method="POST",
+    data=json.dumps(preset["tm"])
+  )
+  path = "/_compute/?id={}&bucketIdx=0&actValue=0".format(MODEL_ID)
+  if snapshot is not None:
+    path += "&get{}{}=true".format(snapshot[:1].upper(), snapshot[1:])
+  headers = {"Content-Type": wire.SDR_INDICES, "Accept": wire.MSGPACK}
+  latencies = []
+  responseBytes = 0
+  start = time.time()
+  for indices in encodings:
+    computeStart = time.time()
+    response = app.request(
+      path, method="PUT", data=indices.astype("<u4").tostring(),
+      headers=headers
+    )
+    latencies.append((time.time() - computeStart) * 1000)
+    if not response.status.startswith("200"):
+      raise RuntimeError("PUT {} failed: {}".format(path, response.status))
+    responseBytes += len(response.data)
+  webserver.ioClient.flush()
+  return latencies, time.time() - start, responseBytes
+
+
+
+RUNNERS = {
+  "sp": runSp,
+  "tm": runTm,
+  "http": runHttp,
+}
+
+
+
+def runCase(case, iterations, seed, results, redisUrl=None):
+  """
+  Runs one benchmark case. Meant to run in its own process, so its peak RSS
+  and files (or Redis keys) are its own.
+  """
+  preset = PRESETS[case["preset"]]
+  if case["scenario"] == "tm":
+    # The TM gets synthetic active columns, at the SP's density.
+    numColumns = preset["tm"]["columnDimensions"][0]
+    sparsity = preset["sp"]["numActiveColumnsPerInhArea"] / numColumns
+    encodings = makeEncodings(numColumns, sparsity, iterations, seed=seed)
+  else:
+    encodings = makeEncodings(
+      preset["sp"]["inputDimensions"][0], preset["sparsity"], iterations,
+      seed=seed
+    )
+  workingDir = tempfile.mkdtemp(prefix="nupic-history-bench-")
+  server = None
+  if case["backend"] == "redis":
+    os.environ["NUPIC_HISTORY_REDIS_URL"] = redisUrl
+    os.environ["NUPIC_HISTORY_REDIS_PREFIX"] = "htm-bench:" \
+      + os.path.basename(workingDir)
+    import redis
+    server = redis.StrictRedis.from_url(redisUrl)
+    memoryBefore = server.info("memory")["used_memory"]
+  try:
+    latencies, elapsed, responseBytes = RUNNERS[case["scenario"]](
+      preset, STORAGE_MODES[case["storageMode"]], case["snapshot"],
+      encodings, workingDir
+    )
+    if server is None:
+      bytesWritten = directorySize(workingDir)
+    else:
+      bytesWritten = server.info("memory")["used_memory"] - memoryBefore
+    out = dict(case)
+    out.update({
+      "iterations": iterations,
+      "seconds": elapsed,
+      "throughput": iterations / elapsed,
+      "meanMs": float(np.mean(latencies)),
+      "p50Ms": float(np.percentile(latencies, 50)),
+      "p99Ms": float(np.percentile(latencies, 99)),
+      "maxMs": float(np.max(latencies)),
+      "bytesWritten": bytesWritten,
+      "responseBytes": responseBytes,
+      "peakRssKb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+    results.put(out)
+  except Exception as e:
+    out = dict(case)
+    out["error"] = str(e)
+    results.put(out)
+  finally:
+    shutil.rmtree(workingDir, ignore_errors=True)
+    if server is not None:
+      makeIoClient(workingDir, None).nuke()
+
+
+
+def listCases(presets, scenarios, storageModes, snapshots=None,
+              backends=("file",)):
+  """
+  Every combination of preset, scenario, storage mode, backend and snapshot. A
+  snapshot of None requests no state besides what the scenario always returns.
+  The memory storage mode saves nothing, so it only runs once.
+  """
+  cases = []
+  for preset in presets:
+    for scenario in scenarios:
+      if scenario == "sp":
+        available = SP_SNAPS.listValues()
+      elif scenario == "tm":
+        available = TM_SNAPS.listValues()
+      else:
+        available = SP_SNAPS.listValues() + TM_SNAPS.listValues()
+      if snapshots is not None:
+        available = [snap for snap in available if snap in snapshots]
+      for storageMode in storageModes:
+        for backend in backends[:1] if storageMode == "memory" else backends:
+          for snapshot in [None] + sorted(available):
+            cases.append({
+              "preset": preset,
+              "scenario": scenario,
+              "storageMode": storageMode,
+              "backend": backend,
+              "snapshot": snapshot,
+            })
+  return cases
+
+
+
+def caseKey(result):
+  return (
+    result["preset"], result["scenario"], result["storageMode"],
+    result.get("backend", "file"), result["snapshot"]
+  )
+
+
+
+def getCommit():
+  try:
+    return subprocess.check_output(
+      ["git", "rev-parse", "HEAD"], stderr=open(os.devnull, "w")
+    ).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+
+def compare(results, baseline):
+  """
+  Prints throughput and p99 changes against an earlier run.
+  """
+  before = dict(
+    (caseKey(result), result) for result in baseline["results"]
+    if "error" not in result
+  )
+  for result in results:
+    previous = before.get(caseKey(result))
+    if previous is None or "error" in result:
+      continue
+    print "{:<50} throughput {:+7.1f}%  p99 {:+7.1f}%".format(
+      "/".join(str(part) for part in caseKey(result)),
+      (result["throughput"] / previous["throughput"] - 1) * 100,
+      (result["p99Ms"] / max(previous["p99Ms"], 1e-9) - 1) * 100,
+    )
+
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Benchmarks SP/TM compute, snapshots and history writes."
+  )
+  parser.add_argument("--presets", default="readme",
+                      help="comma-separated, from: " + ",".join(PRESETS))
+  parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                      help="comma-separated, from: " + ",".join(SCENARIOS))
+  parser.add_argument("--storage", default=",".join(sorted(STORAGE_MODES)),
+                      help="comma-separated, from: "
+                           + ",".join(sorted(STORAGE_MODES)))
+  parser.add_argument("--snapshots", default=None,
+                      help="comma-separated snapshots to try (default all)")
+  parser.add_argument("--redis", default=None,
+                      help="also run every storage mode against this Redis "
+                           "server, like redis://localhost:6379/0")
+  parser.add_argument("--iterations", type=int, default=200)
+  parser.add_argument("--seed", type=int, default=42)
+  parser.add_argument("--out", default="benchmark.json",
+                      help="file the results are written to")
+  parser.add_argument("--baseline", default=None,
+                      help="earlier results file to compare against")
+  args = parser.parse_args()
+
+  snapshots = None
+  if args.snapshots is not None:
+    snapshots = args.snapshots.split(",")
+  backends = ("file",) if args.redis is None else ("file", "redis")
+  cases = listCases(
+    args.presets.split(","), args.scenarios.split(","),
+    args.storage.split(","), snapshots, backends
+  )
+
+  results = []
+  queue = multiprocessing.Queue()
+  for i, case in enumerate(cases):
+    process = multiprocessing.Process(
+      target=runCase,
+      args=(case, args.iterations, args.seed, queue, args.redis)
+    )
+    process.start()
+    result = queue.get()
+    process.join()
+    results.append(result)
+    if "error" in result:
+      print "[{}/{}] {} failed: {}".format(
+        i + 1, len(cases), "/".join(str(p) for p in caseKey(result)),
+        result["error"]
+      )
+    else:
+      print "[{}/{}] {}: {:.1f}/s p50 {:.2f}ms p99 {:.2f}ms {} bytes".format(
+        i + 1, len(cases), "/".join(str(p) for p in caseKey(result)),
+        result["throughput"], result["p50Ms"], result["p99Ms"],
+        result["bytesWritten"]
+      )
+
+  report = {
+    "commit": getCommit(),
+    "timestamp": time.time(),
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "platform": platform.platform(),
+    "iterations": args.iterations,
+    "seed": args.seed,
+    "presets": dict((name, PRESETS[name]) for name in args.presets.split(",")),
+    "results": results,
+  }
+  with open(args.out, "w") as f:
+    f.write(json.dumps(report, indent=2))
+  print "Wrote {} results to {}".format(len(results), args.out)
+
+  if args.baseline is not None:
+    with open(args.baseline) as f:
+      compare(results, json.loads(f.read()))
+
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,222 @@
+import atexit
+import os
+import re
+import urlparse
+import uuid
+
+import ujson as json
+import web
+
+from nupic_history import wire
+from nupic_history.shard_pool import ShardPool, WORKING_DIR_ENV
+
+
+shardPool = ShardPool(
+  int(os.environ.get("NUPIC_HISTORY_SHARDS", 4)),
+  basePort=int(os.environ.get("NUPIC_HISTORY_SHARD_PORT", 8100)),
+  workingDir=os.environ.get(WORKING_DIR_ENV, "./working"),
+)
+
+urls = (
+  "/", "Index",
+  "/_shards/", "ShardsRoute",
+  "/_flush/", "BroadcastRoute",
+  "/_writes/", "BroadcastRoute",
+  "/_cache/", "BroadcastRoute",
+  "/_codecs/", "BroadcastRoute",
+  "/_metrics/", "BroadcastRoute",
+  "/_compact/", "BroadcastRoute",
+  "/_sp/", "CreateRoute",
+  "/.*", "ProxyRoute",
+)
+web.config.debug = False
+app = web.application(urls, globals())
+
+# Routes with the model id in their path.
+MODEL_PATH = re.compile(r"^/_(?:sp|models|stream|activity)/([^/]+)")
+
+
+
+def findModelId(path, query, body, contentType):
+  """
+  Finds which model a request is for: from its path, its "id" URL param, or an
+  "id" in its JSON or msgpack body.
+  :return: model id, or None
+  """
+  match = MODEL_PATH.match(path)
+  if match is not None:
+    return match.group(1)
+  params = urlparse.parse_qs(query.lstrip("?"))
+  if "id" in params:
+    return params["id"][0]
+  if body and not wire.isBinarySdr(contentType):
+    try:
+      payload = wire.decode(body, contentType)
+    except ValueError:
+      return None
+    if isinstance(payload, dict) and "id" in payload:
+      return payload["id"]
+  return None
+
+
+
+def requestHeaders():
+  headers = {}
+  env = web.ctx.env
+  if env.get("CONTENT_TYPE"):
+    headers["Content-Type"] = env["CONTENT_TYPE"]
+  if env.get("HTTP_ACCEPT"):
+    headers["Accept"] = env["HTTP_ACCEPT"]
+  return headers
+
+
+
+def relay(shard, stream=False, body=None):
+  """
+  Forwards the current request to a shard and hands its response back.
+  """
+  if body is None:
+    body = web.data()
+  try:
+    status, headers, responseBody = shardPool.forward(
+      shard, web.ctx.method, web.ctx.path + web.ctx.query, body,
+      requestHeaders(), stream=stream
+    )
+  except Exception as e:
+    print "Shard {} failed: {}".format(shard, e)
+    web.ctx.status = "502 Bad Gateway"
+    return "Shard {} failed: {}".format(shard, e)
+  web.ctx.status = status
+  for name, value in headers:
+    web.header(name, value)
+  return responseBody
+
+
+
+class Index:
+
+
+  def GET(self):
+    return "NuPIC History Server ({} shards)".format(
+      shardPool.getNumShards()
+    )
+
+
+
+class ShardsRoute:
+
+
+  def GET(self):
+    """
+    Returns each shard's health and load: whether its process is alive, the
+    requests forwarded to it, and its own cache and write queue stats.
+    """
+    web.header("Content-Type", "application/json")
+    return json.dumps(shardPool.getHealth())
+
+
+  def POST(self):
+    """
+    Restarts any shard whose process has died.
+    """
+    shardPool.start()
+    web.header("Content-Type", "application/json")
+    return json.dumps(shardPool.getHealth())
+
+
+
+class BroadcastRoute:
+  """
+  Server-wide routes go to every shard. The response lists each shard's.
+  """
+
+
+  def _broadcast(self):
+    out = []
+    results = shardPool.broadcast(
+      web.ctx.method, web.ctx.path + web.ctx.query, web.data(),
+      requestHeaders()
+    )
+    for shard, result in enumerate(results):
+      if isinstance(result, Exception):
+        out.append({"shard": shard, "error": str(result)})
+        continue
+      status, headers, body = result
+      try:
+        body = json.loads(body)
+      except ValueError:
+        pass
+      out.append({"shard": shard, "status": status, "body": body})
+    web.header("Content-Type", "application/json")
+    return json.dumps(out)
+
+
+  def GET(self):
+    return self._broadcast()
+
+
+  def POST(self):
+    return self._broadcast()
+
+
+  def DELETE(self):
+    return self._broadcast()
+
+
+
+class CreateRoute:
+
+
+  def POST(self):
+    """
+    Creates an SP. The front picks its id, so it knows which shard owns it.
+    """
+    payload = json.loads(web.data())
+    if "id" not in payload:
+      payload["id"] = str(uuid.uuid4()).split('-')[0]
+    return relay(
+      shardPool.shardFor(payload["id"]), body=json.dumps(payload)
+    )
+
+
+  def PUT(self):
+    return ProxyRoute().PUT()
+
+
+
+class ProxyRoute:
+
+
+  def _proxy(self):
+    body = web.data()
+    modelId = findModelId(
+      web.ctx.path, web.ctx.query, body, web.ctx.env.get("CONTENT_TYPE")
+    )
+    if modelId is None:
+      print "Cannot tell which model {} is for.".format(web.ctx.path)
+      return web.badrequest()
+    stream = web.ctx.method == "GET" and web.ctx.path.startswith("/_stream/")
+    return relay(shardPool.shardFor(modelId), stream=stream, body=body)
+
+
+  def GET(self):
+    return self._proxy()
+
+
+  def POST(self):
+    return self._proxy()
+
+
+  def PUT(self):
+    return self._proxy()
+
+
+  def DELETE(self):
+    return self._proxy()
+
+
+
+if __name__ == "__main__":
+  shardPool.start()
+  atexit.register(shardPool.stop)
+  app.run()
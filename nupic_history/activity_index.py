@@ -0,0 +1,299 @@
+import array
+import bisect
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+from nupic_history import SpSnapshots as SP_SNAPS
+from nupic_history import TmSnapshots as TM_SNAPS
+
+
+class ActivityIndex(object):
+  """
+  Inverted index of activity, kept in each model's directory. For every column
+  (or TM cell) it holds the sorted iterations it was active in, so questions
+  like "when did column 42 fire?" never need any snapshot to be loaded.
+
+  Each model and state has two files:
+
+    log:       append-only, one record per save: iteration, number of active
+               indices, then the indices (little-endian uint32)
+    postings:  checkpoint of the index for the start of the log, rewritten
+               every "checkpointEvery" records. Iterations are delta-encoded
+               per column and the whole thing is zlib compressed.
+
+  Opening a model reads its postings and replays the rest of the log. When an
+  iteration is saved again, its latest record wins.
+  """
+
+  # File names.
+  LOG = "htm_actlog_{}_{}.npc"        # modelId, state
+  POSTINGS = "htm_actpost_{}_{}.npc"  # modelId, state
+
+  STATES = [
+    SP_SNAPS.ACT_COL,
+    TM_SNAPS.ACT_CELLS,
+    TM_SNAPS.PRD_CELLS,
+  ]
+
+  _RECORD = struct.Struct("<II")
+  _HEADER = struct.Struct("<QQ")
+
+  def __init__(self, workingDir, checkpointEvery=1024):
+    """
+    :param workingDir: directory model directories are in
+    :param checkpointEvery: log records between postings checkpoints
+    """
+    self._workingDir = workingDir
+    self._checkpointEvery = checkpointEvery
+    self._lock = threading.Lock()
+    self._postings = {}
+
+
+  def _path(self, modelId, key):
+    return os.path.join(self._workingDir, modelId, key)
+
+
+  def _get(self, modelId, state):
+    if state not in self.STATES:
+      raise ValueError("{} is not in the activity index.".format(state))
+    key = (modelId, state)
+    if key not in self._postings:
+      self._postings[key] = self._load(modelId, state)
+    return self._postings[key]
+
+
+  def _load(self, modelId, state):
+    postings = _Postings()
+    postingsPath = self._path(modelId, self.POSTINGS.format(modelId, state))
+    if os.path.exists(postingsPath):
+      with open(postingsPath, "rb") as f:
+        data = f.read()
+      logOffset, lastIteration = self._HEADER.unpack_from(data)
+      postings.restore(zlib.decompress(data[self._HEADER.size:]))
+      postings.lastIteration = lastIteration - 1
+      postings.logSize = logOffset
+
+    logPath = self._path(modelId, self.LOG.format(modelId, state))
+    if os.path.exists(logPath):
+      with open(logPath, "rb") as f:
+        f.seek(postings.logSize)
+        data = f.read()
+      offset = 0
+      while offset + self._RECORD.size <= len(data):
+        iteration, count = self._RECORD.unpack_from(data, offset)
+        end = offset + self._RECORD.size + count * 4
+        if end > len(data):
+          break
+        indices = np.frombuffer(
+          data, dtype="<u4", count=count, offset=offset + self._RECORD.size
+        )
+        postings.add(iteration, indices)
+        offset = end
+      postings.logSize += offset
+      if offset < len(data):
+        # A record cut short by a crash. Drop it, so appends stay aligned.
+        with open(logPath, "r+b") as f:
+          f.truncate(postings.logSize)
+    return postings
+
+
+  def record(self, modelId, state, iteration, indices):
+    """
+    Appends one save to the index.
+    :param indices: indices of the active columns or cells
+    """
+    indices = np.unique(np.asarray(indices, dtype="uint32"))
+    data = self._RECORD.pack(iteration, len(indices)) \
+           + indices.astype("<u4").tostring()
+    with self._lock:
+      postings = self._get(modelId, state)
+      logPath = self._path(modelId, self.LOG.format(modelId, state))
+      with open(logPath, "ab") as log:
+        log.write(data)
+      postings.logSize += len(data)
+      postings.add(iteration, indices)
+      postings.records += 1
+      if postings.records >= self._checkpointEvery:
+        self._checkpoint(modelId, state, postings)
+
+
+  def _checkpoint(self, modelId, state, postings):
+    path = self._path(modelId, self.POSTINGS.format(modelId, state))
+    data = self._HEADER.pack(postings.logSize, postings.lastIteration + 1) \
+           + zlib.compress(postings.dump())
+    with open(path + ".tmp", "wb") as f:
+      f.write(data)
+    os.rename(path + ".tmp", path)
+    postings.records = 0
+
+
+  def rebuild(self, modelId, records):
+    """
+    Replaces a model's index.
+    :param records: (dict) iterable of (iteration, indices) per state
+    """
+    with self._lock:
+      for state in records:
+        for key in [self.LOG, self.POSTINGS]:
+          path = self._path(modelId, key.format(modelId, state))
+          if os.path.exists(path):
+            os.unlink(path)
+        self._postings.pop((modelId, state), None)
+    for state, stateRecords in records.iteritems():
+      for iteration, indices in stateRecords:
+        self.record(modelId, state, iteration, indices)
+      with self._lock:
+        self._checkpoint(modelId, state, self._get(modelId, state))
+
+
+  def contains(self, modelId, state):
+    path = self._path(modelId, self.LOG.format(modelId, state))
+    return os.path.exists(path)
+
+
+  def getIterations(self, modelId, state, index, start=0, stop=None):
+    """
+    :param index: column or cell index
+    :return: sorted uint32 array of the iterations in [start, stop) it was
+             active in
+    """
+    with self._lock:
+      iterations = self._get(modelId, state).get(index)
+    first = np.searchsorted(iterations, start)
+    last = len(iterations) if stop is None \
+      else np.searchsorted(iterations, stop)
+    return iterations[first:last]
+
+
+  def _getIterationsOf(self, modelId, state, indices, start, stop):
+    """
+    :return: (list) getIterations() for each index
+    """
+    return [
+      self.getIterations(modelId, state, index, start, stop)
+      for index in indices
+    ]
+
+
+  def getActivity(self, modelId, state, indices, start=0, stop=None):
+    """
+    :return: (dict) per index: how many iterations in [start, stop) it was
+             active in, and the first and last of them (None if none)
+    """
+    out = {}
+    iterationsOf = self._getIterationsOf(modelId, state, indices, start, stop)
+    for index, iterations in zip(indices, iterationsOf):
+      out[index] = {
+        "count": len(iterations),
+        "first": int(iterations[0]) if len(iterations) > 0 else None,
+        "last": int(iterations[-1]) if len(iterations) > 0 else None,
+      }
+    return out
+
+
+  def getCoactivation(self, modelId, state, indices, start=0, stop=None):
+    """
+    :return: (numpy.ndarray) len(indices) square matrix with the number of
+             iterations in [start, stop) both indices were active in. The
+             diagonal has each index's own count.
+    """
+    iterations = self._getIterationsOf(modelId, state, indices, start, stop)
+    out = np.zeros((len(indices), len(indices)), dtype="uint32")
+    for i in xrange(len(indices)):
+      out[i, i] = len(iterations[i])
+      for j in xrange(i + 1, len(indices)):
+        out[i, j] = out[j, i] = len(np.intersect1d(
+          iterations[i], iterations[j], assume_unique=True
+        ))
+    return out
+
+
+  def forget(self, modelId):
+    with self._lock:
+      for key in self._postings.keys():
+        if key[0] == modelId:
+          del self._postings[key]
+
+
+  def reset(self):
+    with self._lock:
+      self._postings = {}
+
+
+
+class _Postings(object):
+  """
+  The sorted iterations of every index of one model's state, as growable uint32
+  arrays.
+  """
+
+  def __init__(self):
+    self.iterations = []
+    self.lastIteration = -1
+    self.logSize = 0
+    self.records = 0
+
+
+  def _iterations(self, index):
+    while index >= len(self.iterations):
+      self.iterations.append(array.array("I"))
+    return self.iterations[index]
+
+
+  def add(self, iteration, indices):
+    if iteration > self.lastIteration:
+      for index in indices:
+        self._iterations(index).append(iteration)
+      self.lastIteration = iteration
+      return
+    # Saved again, or out of order.
+    for iterations in self.iterations:
+      if len(iterations) > 0 and iterations[-1] >= iteration:
+        position = bisect.bisect_left(iterations, iteration)
+        if position < len(iterations) and iterations[position] == iteration:
+          del iterations[position]
+    for index in indices:
+      iterations = self._iterations(index)
+      iterations.insert(bisect.bisect_left(iterations, iteration), iteration)
+
+
+  def get(self, index):
+    if index >= len(self.iterations):
+      return np.zeros(0, dtype="uint32")
+    return np.array(self.iterations[index], dtype="uint32")
+
+
+  def dump(self):
+    """
+    :return: number of indices (uint64), their offsets into the iterations
+             (uint64, one more than there are indices), then every index's
+             iterations, delta-encoded (uint32)
+    """
+    offsets = np.zeros(len(self.iterations) + 1, dtype="<u8")
+    offsets[1:] = np.cumsum([len(i) for i in self.iterations])
+    deltas = np.zeros(int(offsets[-1]), dtype="<u4")
+    for index, iterations in enumerate(self.iterations):
+      if len(iterations) == 0:
+        continue
+      values = np.array(iterations, dtype="int64")
+      values[1:] -= values[:-1].copy()
+      deltas[int(offsets[index]):int(offsets[index + 1])] = values
+    return struct.pack("<Q", len(self.iterations)) + offsets.tostring() \
+           + deltas.tostring()
+
+
+  def restore(self, data):
+    (numIndices,) = struct.unpack_from("<Q", data)
+    offsets = np.frombuffer(data, dtype="<u8", count=numIndices + 1, offset=8)
+    deltas = np.frombuffer(data, dtype="<u4", offset=8 * (numIndices + 2))
+    self.iterations = []
+    for index in xrange(numIndices):
+      iterations = array.array("I")
+      iterations.fromstring(np.cumsum(
+        deltas[int(offsets[index]):int(offsets[index + 1])], dtype="uint32"
+      ).astype("=u4").tostring())
+      self.iterations.append(iterations)
@@ -0,0 +1,361 @@
+import os
+import pickle
+
+import numpy as np
+
+from nupic_history import SpSnapshots as SNAPS
+
+
+class ColumnStore(object):
+  """
+  Column-major side store for SP history, kept in each model's directory.
+  Each compute cycle's column states are written into fixed-size segments of
+  iterations, laid out so that one column's values across a whole segment are
+  contiguous on disk. Reading the history of one column is then one
+  sequential read per state per segment, and never needs a Spatial Pooler to
+  be de-serialized.
+
+  Storage per state:
+
+    activeColumns:  bitmap, one bit per column per iteration
+    permanences:    float32 per potential synapse per iteration, exactly what
+                    the SP holds. Inputs outside a column's potential pool
+                    are always 0, so they are not stored. Not stored unless
+                    asked for, since it is by far the biggest state.
+    overlaps, activeDutyCycles, overlapDutyCycles, boostFactors:
+                    one number per column per iteration
+  """
+
+  # File names.
+  SEGMENT = "htm_colseg_{}_{}_{}.npc"       # modelId, state, segment
+  PRESENT = "htm_colseg_{}_present_{}.npc"  # modelId, segment
+  META = "htm_colmeta_{}.npc"               # modelId
+
+  STATES = [
+    SNAPS.ACT_COL,
+    SNAPS.PERMS,
+    SNAPS.OVERLAPS,
+    SNAPS.ACT_DC,
+    SNAPS.OVP_DC,
+    SNAPS.BST_FCTRS,
+  ]
+
+  # Stored for new models unless told otherwise.
+  DEFAULT_STATES = [state for state in STATES if state != SNAPS.PERMS]
+
+  _DTYPES = {
+    SNAPS.ACT_COL: "uint8",
+    SNAPS.PERMS: "float32",
+    SNAPS.OVERLAPS: "uint32",
+    SNAPS.ACT_DC: "float32",
+    SNAPS.OVP_DC: "float32",
+    SNAPS.BST_FCTRS: "float32",
+  }
+
+  def __init__(self, workingDir, states=None, segmentSize=256):
+    """
+    :param workingDir: directory to write segments into
+    :param states: which of STATES to index for new models (default
+                   DEFAULT_STATES)
+    :param segmentSize: iterations per segment, a multiple of 8
+    """
+    if states is None:
+      states = self.DEFAULT_STATES
+    for state in states:
+      if state not in self.STATES:
+        raise ValueError("{} cannot be stored by column.".format(state))
+    if segmentSize % 8 != 0:
+      raise ValueError("Column store segment size must be a multiple of 8.")
+    self._workingDir = workingDir
+    self._states = states
+    self._segmentSize = segmentSize
+    self._metas = {}
+
+
+  def _path(self, modelId, key):
+    return os.path.join(self._workingDir, modelId, key)
+
+
+  def _shape(self, meta, state):
+    numColumns = meta["numColumns"]
+    segmentSize = meta["segmentSize"]
+    if state == SNAPS.ACT_COL:
+      return numColumns, segmentSize // 8
+    elif state == SNAPS.PERMS:
+      return len(meta["potentialInputs"]), segmentSize
+    else:
+      return numColumns, segmentSize
+
+
+  def _open(self, modelId, key, dtype, shape, write):
+    path = self._path(modelId, key)
+    if os.path.exists(path):
+      mode = "r+" if write else "r"
+    elif write:
+      mode = "w+"
+    else:
+      return None
+    return np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+
+
+  def getMeta(self, modelId):
+    if modelId not in self._metas:
+      path = self._path(modelId, self.META.format(modelId))
+      if not os.path.exists(path):
+        return None
+      with open(path, "r") as f:
+        self._metas[modelId] = pickle.load(f)
+    return self._metas[modelId]
+
+
+  def _createMeta(self, modelId, numColumns, numInputs, potentialPools):
+    meta = {
+      "numColumns": numColumns,
+      "numInputs": numInputs,
+      "segmentSize": self._segmentSize,
+      "states": list(self._states),
+    }
+    if SNAPS.PERMS in self._states:
+      if potentialPools is None:
+        raise ValueError(
+          "Permanences cannot be stored without the potential pools."
+        )
+      meta["potentialOffsets"], meta["potentialInputs"] = potentialPools
+    modelDir = os.path.join(self._workingDir, modelId)
+    if not os.path.isdir(modelDir):
+      os.makedirs(modelDir)
+    with open(self._path(modelId, self.META.format(modelId)), "w") as fileout:
+      pickle.dump(meta, fileout)
+    self._metas[modelId] = meta
+    return meta
+
+
+  def reset(self):
+    self._metas = {}
+
+
+  def contains(self, modelId, state):
+    meta = self.getMeta(modelId)
+    if meta is None or state not in meta["states"]:
+      return False
+    # Stores from before permanences were kept sparse are not read.
+    return state != SNAPS.PERMS or "potentialOffsets" in meta
+
+
+  def needsPotentialPools(self, modelId):
+    """
+    :return: whether the next write() for a model must be given its potential
+             pools
+    """
+    return SNAPS.PERMS in self._states and self.getMeta(modelId) is None
+
+
+  def write(self, modelId, iteration, numColumns, numInputs, values,
+            potentialPools=None):
+    """
+    Stores one iteration's column states.
+    :param values: (dict) keyed by state. Active columns are given as an array
+                   of active column indices, permanences as a
+                   (numColumns, numInputs) array, everything else as one value
+                   per column.
+    :param potentialPools: (offsets, inputs) every column's potential pool in
+                           CSR layout (see utils.getPotentialCsr), needed the
+                           first time permanences are written
+    """
+    if iteration < 0:
+      return
+    meta = self.getMeta(modelId)
+    if meta is None:
+      meta = self._createMeta(modelId, numColumns, numInputs, potentialPools)
+    segmentSize = meta["segmentSize"]
+    segment, slot = divmod(iteration, segmentSize)
+
+    for state in meta["states"]:
+      if state not in values:
+        continue
+      data = self._open(
+        modelId, self.SEGMENT.format(modelId, state, segment),
+        self._DTYPES[state], self._shape(meta, state), True
+      )
+      if state == SNAPS.ACT_COL:
+        byte, bit = divmod(slot, 8)
+        data[:, byte] &= ~np.uint8(1 << bit)
+        data[np.asarray(values[state], dtype="uint32"), byte] |= \
+          np.uint8(1 << bit)
+      elif state == SNAPS.PERMS:
+        data[:, slot] = np.asarray(values[state])[
+          _potentialColumns(meta), meta["potentialInputs"]
+        ]
+      else:
+        data[:, slot] = values[state]
+      del data
+
+    present = self._open(
+      modelId, self.PRESENT.format(modelId, segment), "uint8",
+      (segmentSize,), True
+    )
+    present[slot] = 1
+    del present
+
+
+  def dropStates(self, modelId, states, start, stop):
+    """
+    Deletes the segments of some states that hold no iterations at or after
+    stop, from the one holding start onwards. Reads of those iterations then
+    get no values for these states.
+    :return: (int) bytes deleted
+    """
+    meta = self.getMeta(modelId)
+    if meta is None:
+      return 0
+    segmentSize = meta["segmentSize"]
+    dropped = 0
+    for segment in xrange(start // segmentSize, stop // segmentSize):
+      for state in states:
+        path = self._path(
+          modelId, self.SEGMENT.format(modelId, state, segment)
+        )
+        if os.path.exists(path):
+          dropped += os.path.getsize(path)
+          os.unlink(path)
+    return dropped
+
+
+  def read(self, modelId, columnIndex, states, start, stop):
+    """
+    Reads one column's history for iterations [start, stop).
+    :return: (dict) list of values per state, with None for iterations that
+             were never written. Active columns are 1 or 0, permanences are a
+             list per iteration.
+    """
+    meta = self.getMeta(modelId)
+    segmentSize = meta["segmentSize"]
+    out = {}
+    for state in states:
+      out[state] = []
+    iteration = start
+    while iteration < stop:
+      segment, first = divmod(iteration, segmentSize)
+      last = min(segmentSize, first + stop - iteration)
+      present = self._open(
+        modelId, self.PRESENT.format(modelId, segment), "uint8",
+        (segmentSize,), False
+      )
+      if present is None:
+        present = np.zeros(segmentSize, dtype="uint8")
+      present = np.array(present[first:last])
+      for state in states:
+        data = self._open(
+          modelId, self.SEGMENT.format(modelId, state, segment),
+          self._DTYPES[state], self._shape(meta, state), False
+        )
+        if data is None:
+          values = [None] * (last - first)
+        elif state == SNAPS.ACT_COL:
+          slots = np.arange(first, last)
+          packed = np.array(data[columnIndex])[slots // 8]
+          values = ((packed >> (slots % 8)) & 1).tolist()
+        elif state == SNAPS.PERMS:
+          values = _densePermanences(
+            meta, data, [columnIndex], np.arange(first, last)
+          )[:, 0].tolist()
+        else:
+          values = np.array(data[columnIndex, first:last]).tolist()
+        for i, isPresent in enumerate(present):
+          out[state].append(values[i] if isPresent else None)
+        del data
+      iteration += last - first
+    return out
+
+
+  def readMatrix(self, modelId, columns, states, start, stop, stride=1):
+    """
+    Reads the history of many columns at once, for iterations start,
+    start + stride, ... below stop. Each segment file is read once per state,
+    however many columns are asked for.
+    :param columns: column indices, or None for every column
+    :return: (dict) "iterations", "present" (1 for iterations that were
+             written with every requested state, 0 otherwise) and one matrix
+             per state, with a row per iteration and a column per requested
+             column. Active columns are 1 or 0, permanences have a third axis
+             for the inputs. Iterations never written, and states dropped by
+             dropStates(), are all zeros.
+    """
+    meta = self.getMeta(modelId)
+    segmentSize = meta["segmentSize"]
+    if columns is None:
+      columns = np.arange(meta["numColumns"])
+    columns = np.asarray(columns, dtype="int64")
+    iterations = np.arange(start, stop, stride)
+    written = np.zeros(len(iterations), dtype="uint8")
+    present = np.zeros(len(iterations), dtype="uint8")
+    out = {}
+    for state in states:
+      shape = (len(iterations), len(columns))
+      if state == SNAPS.PERMS:
+        shape += (meta["numInputs"],)
+      out[state] = np.zeros(shape, dtype=self._DTYPES[state])
+
+    segments = iterations // segmentSize
+    for segment in np.unique(segments):
+      rows = np.nonzero(segments == segment)[0]
+      slots = iterations[rows] - segment * segmentSize
+      presentData = self._open(
+        modelId, self.PRESENT.format(modelId, segment), "uint8",
+        (segmentSize,), False
+      )
+      if presentData is None:
+        continue
+      written[rows] = presentData[slots]
+      present[rows] = written[rows]
+      del presentData
+      for state in states:
+        data = self._open(
+          modelId, self.SEGMENT.format(modelId, state, segment),
+          self._DTYPES[state], self._shape(meta, state), False
+        )
+        if data is None:
+          present[rows] = 0
+          continue
+        if state == SNAPS.ACT_COL:
+          byteIndices, inverse = np.unique(slots // 8, return_inverse=True)
+          packed = data[np.ix_(columns, byteIndices)][:, inverse]
+          out[state][rows] = ((packed >> (slots % 8)) & 1).T
+        elif state == SNAPS.PERMS:
+          out[state][rows] = _densePermanences(meta, data, columns, slots)
+        else:
+          out[state][rows] = data[np.ix_(columns, slots)].T
+        del data
+
+    for state in states:
+      out[state][written == 0] = 0
+    out["iterations"] = iterations
+    out["present"] = present
+    return out
+
+
+
+def _potentialColumns(meta):
+  """
+  :return: the column of each potential synapse, in the order they are stored
+  """
+  offsets = np.asarray(meta["potentialOffsets"], dtype="int64")
+  return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+
+def _densePermanences(meta, data, columns, slots):
+  """
+  Spreads stored permanences back over all inputs.
+  :param data: (numPotential, segmentSize) permanences of one segment
+  :param slots: iterations to read, as offsets into the segment
+  :return: (len(slots), len(columns), numInputs) float32 array, 0 outside the
+           columns' potential pools
+  """
+  offsets = meta["potentialOffsets"]
+  inputs = np.asarray(meta["potentialInputs"])
+  out = np.zeros((len(slots), len(columns), meta["numInputs"]), dtype="float32")
+  for i, column in enumerate(columns):
+    synapses = slice(offsets[column], offsets[column + 1])
+    out[:, i, inputs[synapses]] = data[synapses][:, slots].T
+  return out
@@ -1,47 +1,262 @@
+import multiprocessing
+
+import numpy as np
+
 from nupic_history.sp_facade import SpFacade
 from nupic_history.tm_facade import TmFacade
-from nupic_history.io_client import FileIoClient
 
 from nupic_history import SpSnapshots as SNAPS
 
 class NupicHistory(object):
 
 
-  def __init__(self, ioClient):
+  def __init__(self, ioClient, processes=1, minIterationsPerProcess=8,
+               pool=None):
     """
     Provides top-level control over the SP History Facades.
+
+    :param processes: size of the process pool that history reconstruction
+                      fans out to, when SPs must be loaded at many iterations.
+                      1 loads them on the calling thread.
+    :param minIterationsPerProcess: fewer iterations than this per process are
+                                    not worth handing to the pool
+    :param pool: multiprocessing.Pool of that size to use instead of starting
+                 one here
     """
     self._ioClient = ioClient
+    self._processes = processes
+    self._minIterationsPerProcess = minIterationsPerProcess
+    self._pool = pool
+    if pool is None and processes > 1:
+      # Workers are forked with whatever locks other threads hold at the time,
+      # like the IO client's write queue's, and could wait on them forever.
+      # Callers that have started threads already should pass a pool started
+      # before them.
+      self._pool = multiprocessing.Pool(processes)
 
 
-  def getColumnHistory(self, spId, columnIndex, states):
+  def _loadColumns(self, spId, iterations, states, columns):
+    """
+    Loads the SP at each iteration and extracts the states of some columns.
+    Contiguous ranges of iterations go to the process pool, and the results
+    are merged in order, so this returns the same as loading them all here.
+    :return: (dict) per state, an array with a row per iteration
+    """
+    numChunks = min(
+      self._processes, len(iterations) // self._minIterationsPerProcess
+    )
+    if numChunks <= 1:
+      out = _extractColumns(self._ioClient, spId, iterations, states, columns)
+    else:
+      # Workers read from storage, so everything queued must be written first.
+      self._ioClient.flush(modelId=spId)
+      ioClass = type(self._ioClient)
+      options = self._ioClient.getOptions()
+      results = self._pool.map(_extractColumnsInWorker, [
+        (ioClass, options, spId, chunk.tolist(), states, columns)
+        for chunk in np.array_split(np.asarray(iterations), numChunks)
+      ])
+      out = dict(
+        (state, np.concatenate([result[state] for result in results]))
+        for state in states
+      )
+    for state in states:
+      out.setdefault(state, np.zeros(0))
+    return out
+
+
+  def _loadKeptColumns(self, spId, iterations, states, columns):
+    """
+    Like _loadColumns(), but skips iterations whose SP state was compacted
+    away by the model's retention policy.
+    :return: (kept, out) a mask of the iterations loaded, and per state an
+             array with a row per iteration, zeros where not kept
+    """
+    ioClient = self._ioClient
+    kept = np.array(
+      [not ioClient.isCompacted(spId, i) for i in iterations], dtype="bool"
+    )
+    if kept.all():
+      return kept, self._loadColumns(spId, iterations, states, columns)
+    loaded = self._loadColumns(
+      spId, np.asarray(iterations)[kept].tolist(), states, columns
+    )
     out = {}
     for state in states:
-      out[state] = []
-
-    for iteration in xrange(self._ioClient.getMaxIteration(spId)):
-      spFacade = SpFacade(spId, self._ioClient, iteration=iteration)
-      spFacade.load()
-      print spFacade._activeColumns
-      for state in states:
-        # Column activity only needs to be returned for the specified column.
-        myState = spFacade.getState(state)[state]
-        if state == SNAPS.ACT_COL:
-          isActive = columnIndex in myState["indices"]
-          if isActive:
-            isActive = 1
-          else:
-            isActive = 0
-          out[state].append(isActive)
-        else:
-          out[state].append(myState[columnIndex])
+      values = loaded[state]
+      out[state] = np.zeros(
+        (len(iterations),) + values.shape[1:], dtype=values.dtype
+      )
+      out[state][kept] = values
+    return kept, out
+
+
+  def getColumnHistory(self, spId, columnIndex, states):
+    ioClient = self._ioClient
+    maxIteration = ioClient.getMaxIteration(spId, kind="spac")
+    out = {}
+
+    # States kept in the column store are read straight from it.
+    indexed = [s for s in states if ioClient.hasColumnHistory(spId, s)]
+    if len(indexed) > 0:
+      out.update(ioClient.getColumnHistory(
+        spId, columnIndex, indexed, 0, maxIteration
+      ))
+
+    # Anything else needs the SP loaded at every iteration.
+    remaining = [s for s in states if s not in indexed]
+    if len(remaining) == 0:
+      return out
+
+    kept, history = self._loadKeptColumns(
+      spId, range(maxIteration), remaining, [columnIndex]
+    )
+    for state in remaining:
+      out[state] = [
+        _columnValue(state, row[0]) if isKept else None
+        for row, isKept in zip(history[state], kept)
+      ]
+
+    return out
+
+
+  def getColumnsHistory(self, spId, states, columns=None, start=0, stop=None,
+                        stride=1):
+    """
+    History of many columns and states in one pass over the stored iterations,
+    instead of one pass per column.
+
+    :param states: SP states to read
+    :param columns: column indices, or None for every column
+    :param start: first iteration
+    :param stop: iteration to stop before, default after the last one saved
+    :param stride: read every stride-th iteration
+    :return: (dict) "iterations", "present" (1 for iterations that were saved)
+             and one dense matrix per state, with a row per iteration and a
+             column per requested column. Permanences, potential pools and
+             connected synapses have a third axis for the inputs, inhibition
+             masks one for the columns. Input has one row of bits per
+             iteration, since it is not per column. Iterations whose
+             state a retention policy compacted away are not present.
+    """
+    ioClient = self._ioClient
+    if stop is None:
+      stop = ioClient.getMaxIteration(spId, kind="spac") + 1
+
+    # States kept in the column store are read straight from it.
+    indexed = [s for s in states if ioClient.hasColumnHistory(spId, s)]
+    if len(indexed) > 0:
+      out = ioClient.getColumnsHistory(
+        spId, columns, indexed, start, stop, stride
+      )
+    else:
+      iterations = np.arange(start, stop, stride)
+      out = {
+        "iterations": iterations,
+        "present": np.ones(len(iterations), dtype="uint8"),
+      }
+
+    # Anything else needs the SP loaded once per iteration, for all states and
+    # columns together.
+    remaining = [s for s in states if s not in indexed]
+    if len(remaining) == 0:
+      return out
+    kept, history = self._loadKeptColumns(
+      spId, out["iterations"].tolist(), remaining, columns
+    )
+    out.update(history)
+    out["present"] = out["present"] * kept
 
     return out
 
 
+  def close(self):
+    """
+    Stops the process pool.
+    """
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool.join()
+      self._pool = None
+
+
   def nuke(self):
     """
     Removes all traces of NuPIC History from Redis.
     :return:
     """
     self._ioClient.nuke(flush=True)
+
+
+
+def _extractColumns(ioClient, spId, iterations, states, columns):
+  out = {}
+  for row, iteration in enumerate(iterations):
+    spFacade = SpFacade(spId, ioClient, iteration=int(iteration))
+    spFacade.load()
+    snapshots = spFacade.getState(*states)
+    for state in states:
+      values = _denseColumns(spFacade, state, snapshots[state], columns)
+      if state not in out:
+        out[state] = np.zeros(
+          (len(iterations),) + values.shape, dtype=values.dtype
+        )
+      out[state][row] = values
+  return out
+
+
+
+def _extractColumnsInWorker(args):
+  # Runs in a pool process, with its own IO client over the same history.
+  ioClass, options, spId, iterations, states, columns = args
+  return _extractColumns(
+    ioClass(**options), spId, iterations, states, columns
+  )
+
+
+
+def _columnValue(state, values):
+  """
+  Turns one column's dense values back into what getColumnHistory returns:
+  1 or 0 for active columns, index lists for potential pools, connected
+  synapses and inhibition masks.
+  """
+  if state == SNAPS.ACT_COL:
+    return int(values)
+  elif state in [SNAPS.POT_POOLS, SNAPS.CON_SYN, SNAPS.INH_MASKS]:
+    return np.nonzero(values)[0].tolist()
+  return values
+
+
+
+def _denseColumns(spFacade, state, snapshot, columns):
+  """
+  Turns one iteration's snapshot into dense values for the requested columns.
+  """
+  numColumns = spFacade.getNumColumns()
+  numInputs = spFacade.getParams()["numInputs"]
+  if columns is None:
+    columns = np.arange(numColumns)
+  if state == SNAPS.INPUT:
+    out = np.zeros(numInputs, dtype="uint8")
+    out[snapshot["indices"]] = 1
+    return out
+  elif state == SNAPS.ACT_COL:
+    out = np.zeros(numColumns, dtype="uint8")
+    out[snapshot["indices"]] = 1
+    return out[columns]
+  elif state in [SNAPS.POT_POOLS, SNAPS.CON_SYN]:
+    # These are lists of indices per column.
+    out = np.zeros((len(columns), numInputs), dtype="uint8")
+    for i, column in enumerate(columns):
+      out[i, snapshot[column]] = 1
+    return out
+  elif state == SNAPS.INH_MASKS:
+    # Neighbors of every column, in CSR layout.
+    offsets = snapshot["offsets"]
+    indices = snapshot["indices"]
+    out = np.zeros((len(columns), numColumns), dtype="uint8")
+    for i, column in enumerate(columns):
+      out[i, indices[offsets[column]:offsets[column + 1]]] = 1
+    return out
+  return np.asarray(snapshot)[columns]
@@ -1,10 +1,16 @@
-import sys
+import bisect
 import os
+import shutil
+import threading
 import time
 import json
 import pickle
+import re
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import capnp
+import numpy as np
 
 cpp = True
 
@@ -13,16 +19,58 @@ if cpp:
 else:
   from nupic.research.spatial_pooler import SpatialPooler
 
-from nupic.proto import SpatialPoolerProto_capnp
+from nupic.bindings.algorithms import TemporalMemory
+from nupic.proto import SpatialPoolerProto_capnp, TemporalMemoryProto_capnp
+
+from nupic_history import SpSnapshots as SNAPS
+from nupic_history import TmSnapshots as TM_SNAPS
+from nupic_history.activity_index import ActivityIndex
+from nupic_history.column_store import ColumnStore
+from nupic_history.metrics import metrics
+from nupic_history.model_index import ModelIndex
+from nupic_history.retention import RetentionPolicy
+from nupic_history import sdr_log
+from nupic_history import snapshot_codecs
+from nupic_history.snapshot_cache import SnapshotCache
+from nupic_history.utils import (
+  LruCache, getPermanenceMatrix, getPotentialCsr
+)
+
+snapshot_codecs.registerCodec(snapshot_codecs.CapnpCodec(
+  "capnp-packed/sp", SpatialPoolerProto_capnp.SpatialPoolerProto, packed=True
+))
+snapshot_codecs.registerCodec(snapshot_codecs.CapnpCodec(
+  "capnp/sp", SpatialPoolerProto_capnp.SpatialPoolerProto, packed=False
+))
+snapshot_codecs.registerCodec(snapshot_codecs.CapnpCodec(
+  "capnp-packed/tm", TemporalMemoryProto_capnp.TemporalMemoryProto,
+  packed=True
+))
+
+# What a model id may be, see checkModelId().
+MODEL_ID = re.compile(r"^[A-Za-z0-9_-]+$")
 
 
 class FileIoClient(object):
+  """
+  Saves and loads model history as files, one directory per model id under the
+  working directory. Each model directory has a ModelIndex of the iterations
+  stored in it, so nothing ever scans the directories.
+  """
 
-  # File names.
+  # File names, inside each model's directory.
   SP_KEY = "htm_sp_{}_{}.npc"               # modelId, iteration
   SP_ITER = "htm_sp_{}_?.npc"               # modelId
+  SP_DELTA = "htm_spdelta_{}_{}.npc"        # modelId, iteration
+  SP_CONFIG = "htm_spconfig_{}.npc"         # modelId
+  SP_LEARN = "htm_splearn_{}.npc"           # modelId
+  # Encodings and active columns are now kept in SDR logs (see SdrLog). These
+  # files are only read, for history saved before the logs.
   ENCODING = "htm_encoding_{}_{}.npc"       # modelId, iteration
   SP_ACT_COL = "htm_spac_{}_{}.npc"        # modelId, iteration
+  TM_KEY = "htm_tm_{}_{}.npc"               # modelId, iteration
+  TM_STEP = "htm_tmstep_{}_{}.npc"          # modelId, iteration
+  CACHE_ENTRY = "htm_cached_{}.npc"         # modelId
   # MODEL_LIST = "model_list"
   # SP_PARAMS = "{}_sp_params"          # spid
   # TM_PARAMS = "{}_tm_params"          # tmid
@@ -32,135 +80,1210 @@ class FileIoClient(object):
   # COLUMN_VALS = "{}_{}_col-{}_{}"     # spid, iteration, column index,
   #                                     # storage type
 
-  def __init__(self, workingDir=None):
+  # Codec each snapshot kind is written with by default. See snapshot_codecs.
+  DEFAULT_CODECS = {
+    "sp": "capnp-packed/sp",
+    "spdelta": "zlib-pickle",
+    "tm": "capnp-packed/tm",
+    "tmstep": "msgpack",
+    "cached": "zlib-pickle",
+  }
+  # Codec files without a codec header were written with.
+  LEGACY_CODECS = {
+    "sp": "capnp/sp",
+  }
+
+  # SP history modes.
+  DELTA = "delta"     # keyframes, plus changed arrays for every iteration
+  REPLAY = "replay"   # keyframes only, in between is recomputed from inputs
+
+  def __init__(self, workingDir=None, keyframeInterval=1, historyMode=DELTA,
+               replayCacheSize=32, columnStates=None, writeQueue=None,
+               snapshotCodecs=None, snapshotCacheBytes=64 * 1024 * 1024):
+    """
+    :param workingDir: directory all history files are written into
+    :param keyframeInterval: default number of iterations between full SP
+                             keyframes. The default of 1 writes a full SP
+                             every iteration.
+    :param historyMode: default way iterations between keyframes are stored.
+                        DELTA writes the changed arrays for each one. REPLAY
+                        writes nothing and rebuilds them by running the saved
+                        encodings through the last keyframe.
+    :param replayCacheSize: how many replayed SP states to keep in memory
+    :param columnStates: SP states to also store column-major for fast column
+                         history (see ColumnStore, default all it supports
+                         but permanences)
+    :param writeQueue: optional WriteQueue. When given, saves only serialize on
+                       the calling thread and the disk writes happen behind it.
+                       Loads for a model wait for its queued writes first.
+    :param snapshotCodecs: (dict) codec names by snapshot kind, overriding
+                   DEFAULT_CODECS. Files remember their codec, so this can be
+                   changed without breaking existing history.
+    :param snapshotCacheBytes: max estimated bytes of facade snapshots shared
+                               across requests (see SnapshotCache)
+    """
     if workingDir is None:
       workingDir = "/tmp"
     self._workingDir = workingDir
+    self._options = {
+      "workingDir": workingDir,
+      "keyframeInterval": keyframeInterval,
+      "historyMode": historyMode,
+      "replayCacheSize": replayCacheSize,
+      "columnStates": columnStates,
+      "snapshotCodecs": snapshotCodecs,
+      "snapshotCacheBytes": snapshotCacheBytes,
+    }
+    self._defaultConfig = {
+      "keyframeInterval": keyframeInterval,
+      "historyMode": historyMode,
+    }
+    self._configs = {}
+    # Recently replayed SPs as packed capnp bytes, keyed by (modelId, iteration)
+    self._replayCache = LruCache(replayCacheSize)
+    self._snapshotCache = SnapshotCache(snapshotCacheBytes)
+    self._openStores(columnStates)
+    self._writeQueue = writeQueue
+    # Writes collected by batch() on each thread.
+    self._local = threading.local()
+    # Last SP arrays written for each model, keyed by model id. Deltas are
+    # computed against these: {modelId: (iteration, arrays)}
+    self._spBaselines = {}
+    # Last iteration a TM step was saved for, keyed by model id. A gap means
+    # the next save must be a keyframe.
+    self._tmLastSaved = {}
+    self._indexes = {}
+    self._indexLock = threading.Lock()
+    # Re-entrant lock per model id, see _modelLock().
+    self._modelLocks = {}
+    self._modelLocksLock = threading.Lock()
+    self._codecs = dict(self.DEFAULT_CODECS)
+    if snapshotCodecs is not None:
+      self._codecs.update(snapshotCodecs)
+    self._codecStats = snapshot_codecs.CodecStats()
+
+
+  def _openStores(self, columnStates):
+    """
+    Creates the column store, activity index and SDR logs history is kept in
+    besides snapshots.
+    """
+    self._columnStore = ColumnStore(self._workingDir, states=columnStates)
+    self._activityIndex = ActivityIndex(self._workingDir)
+    self._sdrLog = sdr_log.SdrLog(self._workingDir)
 
 
-  def _writeData(self, key, data):
-    path = self._workingDir + "/" + key
-    with open(path, "w") as fileout:
-      pickle.dump(data, fileout)
+  def _modelDir(self, id):
+    checkModelId(id)
+    return os.path.join(self._workingDir, id)
 
 
-  def _readData(self, key):
-    path = self._workingDir + "/" + key
-    with open(path, "r") as f:
-      return pickle.load(f)
+  def _path(self, id, key):
+    return os.path.join(self._modelDir(id), key)
 
 
-  def _writePrototype(self, key, proto):
-    path = self._workingDir + "/" + key
-    with open(path, "w") as fileout:
-      proto.write(fileout)
+  def _getIndex(self, id):
+    with self._indexLock:
+      if id not in self._indexes:
+        self._indexes[id] = ModelIndex(self._modelDir(id))
+      return self._indexes[id]
 
 
-  def saveEncoding(self, encoding, id, iteration):
-    start = time.time() * 1000
-    size = sys.getsizeof(encoding)
-    key = self.ENCODING.format(id, iteration)
-    self._writeData(key, encoding)
-    end = time.time() * 1000
-    print "\t{} input serialization of {} bytes into {} took {} ms".format(
-      id, size, key, (end - start)
+  def _modelLock(self, id):
+    """
+    :return: the re-entrant lock held while a model is compacted, and while it
+             is loaded or its config is changed, so neither happens halfway
+             through a compaction
+    """
+    with self._modelLocksLock:
+      if id not in self._modelLocks:
+        self._modelLocks[id] = threading.RLock()
+      return self._modelLocks[id]
+
+
+  def _ensureModelDir(self, id):
+    modelDir = self._modelDir(id)
+    if not os.path.isdir(modelDir):
+      os.makedirs(modelDir)
+
+
+  def _writeBytes(self, id, key, data):
+    self._ensureModelDir(id)
+    with open(self._path(id, key), "wb") as fileout:
+      fileout.write(data)
+
+
+  def _writeData(self, id, key, data):
+    self._writeBytes(id, key, pickle.dumps(data))
+
+
+  def _readBytes(self, id, key):
+    with open(self._path(id, key), "rb") as f:
+      return f.read()
+
+
+  def _deleteBytes(self, id, key):
+    os.unlink(self._path(id, key))
+
+
+  def _readData(self, id, key):
+    return pickle.loads(self._readBytes(id, key))
+
+
+  def _encode(self, id, kind, obj):
+    """
+    Encodes a snapshot with the codec configured for its kind, header included.
+    """
+    codec = snapshot_codecs.getCodec(self._codecs[kind])
+    with metrics.span("serialize." + kind, id):
+      return snapshot_codecs.timedPack(self._codecStats, kind, codec, obj)
+
+
+  def _readSnapshot(self, id, template, iteration):
+    """
+    Reads and decodes one iteration-addressed snapshot, whichever codec it was
+    written with.
+    """
+    kind = _kind(template)
+    with metrics.span("read." + kind, id):
+      data = self._readBytes(id, template.format(id, iteration))
+    return self._decodeSnapshot(id, kind, data)
+
+
+  def _readSnapshots(self, id, template, iterations):
+    """
+    :return: (list) decoded snapshots of one kind, one per iteration
+    """
+    return [
+      self._readSnapshot(id, template, iteration) for iteration in iterations
+    ]
+
+
+  def _decodeSnapshot(self, id, kind, data):
+    metrics.addBytes("read." + kind, len(data), id)
+    legacy = snapshot_codecs.getCodec(self.LEGACY_CODECS.get(kind, "pickle"))
+    with metrics.span("deserialize." + kind, id):
+      return snapshot_codecs.timedUnpack(self._codecStats, kind, data, legacy)
+
+
+  def getSnapshotCache(self):
+    """
+    :return: (SnapshotCache) snapshots shared by every facade on this client
+    """
+    return self._snapshotCache
+
+
+  def getCodecStats(self):
+    """
+    :return: (dict) per snapshot kind: codec, bytes before and after encoding,
+             compression ratio, and mean encode and decode times
+    """
+    return self._codecStats.getStats()
+
+
+  def _exists(self, id, key):
+    return os.path.exists(self._path(id, key))
+
+
+  def _writeSnapshot(self, id, template, iteration, data):
+    """
+    Writes one iteration-addressed snapshot and records it in the model index.
+    :param template: file name template, like SP_KEY
+    """
+    kind = _kind(template)
+    with metrics.span("write." + kind, id):
+      self._writeBytes(id, template.format(id, iteration), data)
+      self._getIndex(id).record(kind, iteration, len(data))
+    metrics.addBytes("written." + kind, len(data), id)
+
+
+  def _writeSdr(self, id, field, kind, iteration, data, bits):
+    """
+    Writes one iteration's SDR into its log and records it in the model index
+    under kind, like a snapshot file would be.
+    :param data: record from sdr_log.packSdr() or packIndices()
+    """
+    with metrics.span("write." + kind, id):
+      self._ensureModelDir(id)
+      self._sdrLog.write(id, field, iteration, data, bits)
+      self._getIndex(id).record(kind, iteration, len(data))
+    metrics.addBytes("written." + kind, len(data), id)
+
+
+  def _readSdr(self, id, field, kind, iteration):
+    """
+    :return: (numpy.ndarray) one iteration's SDR from its log, dense uint32,
+             or None if it is not in the log
+    """
+    with metrics.span("read." + kind, id):
+      bits = self._sdrLog.read(id, field, iteration)
+    if bits is None:
+      return None
+    return bits.astype("uint32")
+
+
+  def _deleteSnapshots(self, id, template, iterations):
+    """
+    Deletes iteration-addressed snapshots of one kind and drops them from the
+    model index.
+    :return: bytes they took
+    """
+    kind = _kind(template)
+    with metrics.span("delete." + kind, id):
+      for iteration in iterations:
+        path = self._path(id, template.format(id, iteration))
+        if os.path.exists(path):
+          os.unlink(path)
+      return self._getIndex(id).remove(kind, iterations)
+
+
+  def _hasSnapshot(self, id, template, iteration):
+    return self._getIndex(id).contains(_kind(template), iteration)
+
+
+  def _submit(self, id, write):
+    """
+    Runs a write now, or hands it to the write queue if there is one. Inside
+    batch() it is held until the batch ends instead. Anything the write needs
+    must already be serialized, because the caller is free to mutate its model
+    as soon as this returns.
+    """
+    writes = getattr(self._local, "batch", None)
+    if writes is not None:
+      writes.setdefault(id, []).append(write)
+    elif self._writeQueue is None:
+      self._runWrites(id, [write])
+    else:
+      self._writeQueue.put(id, lambda: self._runWrites(id, [write]))
+
+
+  def _runWrites(self, id, writes):
+    """
+    Runs writes for one model in order. Storage that can send many writes at
+    once hooks in here.
+    """
+    for write in writes:
+      write()
+
+
+  @contextmanager
+  def batch(self):
+    """
+    Holds the writes saved on this thread inside the block, and submits them
+    together at its end: one write queue task per model, and one round trip
+    for RedisIoClient. Wrap one compute's saves in it. Batches nest, the
+    outermost one submits. Loads inside the block do not see its writes.
+    """
+    if getattr(self._local, "batch", None) is not None:
+      yield
+      return
+    batch = self._local.batch = OrderedDict()
+    try:
+      yield
+    finally:
+      self._local.batch = None
+      for id, writes in batch.iteritems():
+        if self._writeQueue is None:
+          self._runWrites(id, writes)
+        else:
+          self._writeQueue.put(
+            id, lambda id=id, writes=writes: self._runWrites(id, writes)
+          )
+
+
+  def _awaitWrites(self, id=None):
+    if self._writeQueue is not None:
+      self._writeQueue.flush(id)
+
+
+  def flush(self, timeout=None, modelId=None):
+    """
+    Blocks until every queued write (or every one for modelId) has hit the
+    disk.
+    :return: False if the timeout ran out first
+    """
+    if self._writeQueue is None:
+      return True
+    return self._writeQueue.flush(modelId, timeout=timeout)
+
+
+  def getOptions(self):
+    """
+    :return: (dict) constructor arguments for another client reading the same
+             history, like one in a worker process. Leaves out the write queue.
+    """
+    return dict(self._options)
+
+
+  def _getConfig(self, modelId):
+    if modelId not in self._configs:
+      config = dict(self._defaultConfig)
+      key = self.SP_CONFIG.format(modelId)
+      if self._exists(modelId, key):
+        config.update(self._readData(modelId, key))
+      self._configs[modelId] = config
+    return self._configs[modelId]
+
+
+  def _updateConfig(self, modelId, **kwargs):
+    with self._modelLock(modelId):
+      config = self._getConfig(modelId)
+      config.update(kwargs)
+      self._writeData(modelId, self.SP_CONFIG.format(modelId), config)
+
+
+  def setKeyframeInterval(self, modelId, interval):
+    """
+    Sets how often a full SP keyframe is written for one model. Persisted so it
+    survives server restarts.
+    :param interval: (int) iterations between keyframes, at least 1
+    """
+    interval = int(interval)
+    if interval < 1:
+      raise ValueError("Keyframe interval must be at least 1.")
+    self._updateConfig(modelId, keyframeInterval=interval)
+
+
+  def getKeyframeInterval(self, modelId):
+    return self._getConfig(modelId)["keyframeInterval"]
+
+
+  def setHistoryMode(self, modelId, mode):
+    """
+    Sets how one model's SP iterations between keyframes are stored. Should be
+    set before the model's first save.
+    :param mode: (string) DELTA or REPLAY
+    """
+    if mode not in [self.DELTA, self.REPLAY]:
+      raise ValueError("Unknown SP history mode: {}".format(mode))
+    self._updateConfig(modelId, historyMode=mode)
+
+
+  def getHistoryMode(self, modelId):
+    return self._getConfig(modelId)["historyMode"]
+
+
+  def setRetentionPolicy(self, modelId, policy):
+    """
+    Sets how much of one model's history compact() keeps. Persisted so it
+    survives server restarts.
+    :param policy: (RetentionPolicy) or None to keep everything
+    """
+    self._updateConfig(
+      modelId, retention=None if policy is None else policy.toDict()
     )
 
 
+  def getRetentionPolicy(self, modelId):
+    """
+    :return: (RetentionPolicy) or None if the model keeps everything
+    """
+    retention = self._getConfig(modelId).get("retention")
+    if retention is None:
+      return None
+    return RetentionPolicy.fromDict(retention)
+
+
+  def isCompacted(self, modelId, iteration):
+    """
+    :return: whether compact() dropped the SP and TM state of an iteration.
+             Its SDRs are still there.
+    """
+    config = self._getConfig(modelId)
+    if iteration < config.get("sdrOnlyBefore", 0):
+      return True
+    if iteration < config.get("downsampledBefore", 0):
+      # Downsampled iterations that were kept all have SP keyframes.
+      return not self._hasSnapshot(modelId, self.SP_KEY, iteration)
+    return False
+
+
+  def _writeLearnFlag(self, id, iteration, learn):
+    # One byte per iteration, so replay knows which computes learned.
+    self._ensureModelDir(id)
+    path = self._path(id, self.SP_LEARN.format(id))
+    mode = "r+b" if os.path.exists(path) else "wb"
+    with open(path, mode) as fileout:
+      fileout.seek(iteration)
+      fileout.write("1" if learn else "0")
+
+
+  def _readLearnFlags(self, id):
+    path = self._path(id, self.SP_LEARN.format(id))
+    if not os.path.exists(path):
+      return ""
+    with open(path, "rb") as f:
+      return f.read()
+
+
+  def saveEncoding(self, encoding, id, iteration):
+    data = sdr_log.packSdr(encoding)
+    bits = len(encoding)
+    self._submit(id, lambda: self._writeSdr(
+      id, SNAPS.INPUT, _kind(self.ENCODING), iteration, data, bits
+    ))
+
+
   def saveActiveColumns(self, activeColumns, id, iteration):
-    start = time.time() * 1000
-    size = sys.getsizeof(activeColumns)
-    key = self.SP_ACT_COL.format(id, iteration)
-    self._writeData(key, activeColumns)
-    end = time.time() * 1000
-    print "\t{} activeColumns serialization of {} bytes into {} took {} ms".format(
-      id, size, key, (end - start)
-    )
+    data = sdr_log.packSdr(activeColumns)
+    bits = len(activeColumns)
+    indices = np.nonzero(activeColumns)[0]
+
+    def write():
+      self._writeSdr(
+        id, SNAPS.ACT_COL, _kind(self.SP_ACT_COL), iteration, data, bits
+      )
+      self._activityIndex.record(id, SNAPS.ACT_COL, iteration, indices)
+
+    self._submit(id, write)
 
 
-  def saveSpatialPooler(self, sp, id, iteration=None):
+  def saveSpatialPooler(self, sp, id, iteration=None, learn=True):
     """
+    Writes a full keyframe if this iteration falls on the model's keyframe
+    interval. In DELTA mode, other iterations only write what changed since the
+    previous iteration (or a keyframe if there is no baseline to diff against).
+    In REPLAY mode they write nothing but whether the compute learned.
+
     :param iteration: If not provided that means the SP is not running yet (-1).
+    :param learn: whether the compute that produced this state learned
     """
-    start = time.time() * 1000
-
     if iteration is None:
       iteration = -1
-    proto = SpatialPoolerProto_capnp.SpatialPoolerProto.new_message()
-    sp.write(proto)
-    key = self.SP_KEY.format(id, iteration)
-    self._writePrototype(key, proto)
-
-    end = time.time() * 1000
-    print "\t{} SP serialization into {} took {} ms".format(
-      id, key, (end - start)
-    )
+    mode = self.getHistoryMode(id)
+    isKeyframe = iteration <= 0 \
+                 or iteration % self.getKeyframeInterval(id) == 0
+
+    template = None
+    data = None
+    if mode == self.DELTA:
+      with metrics.span("sp.extract", id):
+        arrays = _extractSpArrays(sp)
+      baseline = self._spBaselines.get(id)
+      if baseline is None or baseline[0] != iteration - 1:
+        isKeyframe = True
+      if not isKeyframe:
+        template = self.SP_DELTA
+        data = self._encode(
+          id, "spdelta", _diffSpArrays(baseline[1], arrays)
+        )
+      self._spBaselines[id] = (iteration, arrays)
+
+    if isKeyframe:
+      proto = SpatialPoolerProto_capnp.SpatialPoolerProto.new_message()
+      sp.write(proto)
+      template = self.SP_KEY
+      data = self._encode(id, "sp", proto)
+
+    def write():
+      if mode == self.REPLAY and iteration >= 0:
+        self._writeLearnFlag(id, iteration, learn)
+      if template is not None:
+        self._writeSnapshot(id, template, iteration, data)
+
+    self._submit(id, write)
 
 
   def loadSpatialPooler(self, id, iteration=None):
-    start = time.time() * 1000
+    """
+    Rebuilds the SP at any stored iteration from the nearest keyframe at or
+    before it, plus either the deltas written since (DELTA mode) or a replay of
+    the encodings seen since (REPLAY mode).
+    """
+    with self._modelLock(id):
+      self._awaitWrites(id)
+      if iteration is None:
+        iteration = self.getMaxIteration(id, kind=_kind(self.SP_ACT_COL))
+      if self.getHistoryMode(id) == self.REPLAY:
+        return self._replaySpatialPooler(id, iteration)
 
-    if iteration is None:
-      iteration = self.getMaxIteration(id)
-    key = self.SP_KEY.format(id, iteration)
-    path = self._workingDir + "/" + key
-    with open(path, "r") as spFile:
-      proto = SpatialPoolerProto_capnp.SpatialPoolerProto.read(spFile)
+      start = time.time()
 
-    sp = SpatialPooler.read(proto)
+      # Walk back to the nearest keyframe, collecting deltas on the way.
+      deltaIterations = []
+      keyframe = iteration
+      while not self._hasSnapshot(id, self.SP_KEY, keyframe):
+        if not self._hasSnapshot(id, self.SP_DELTA, keyframe):
+          raise ValueError(
+            "No SP keyframe or delta for model {} at iteration {}.".format(
+              id, keyframe
+            )
+          )
+        deltaIterations.insert(0, keyframe)
+        keyframe -= 1
 
-    end = time.time() * 1000
-    print "\t{} SP de-serialization from {} took {} ms".format(
-      id, key, (end - start)
-    )
+      sp = self._readSpatialPooler(id, keyframe)
+
+      if len(deltaIterations) > 0:
+        deltas = self._readSnapshots(id, self.SP_DELTA, deltaIterations)
+        arrays = _extractSpArrays(sp)
+        touchedColumns = _applySpDeltas(arrays, deltas)
+        _restoreSpArrays(sp, arrays, touchedColumns)
+      if id not in self._spBaselines:
+        self._spBaselines[id] = (iteration, _extractSpArrays(sp))
+
+      metrics.observe("load.sp", (time.time() - start) * 1000, id)
+      return sp
+
+
+  def _readSpatialPooler(self, id, iteration):
+    return SpatialPooler.read(self._readSnapshot(id, self.SP_KEY, iteration))
+
+
+  def _replaySpatialPooler(self, id, iteration):
+    start = time.time()
+
+    # Start from whichever is closest: a replayed state still in memory, or a
+    # keyframe on disk. Scrubbing forward one iteration then costs one compute.
+    origin = iteration
+    sp = None
+    while sp is None:
+      if origin < -1:
+        raise ValueError(
+          "No SP keyframe for model {} at or before iteration {}.".format(
+            id, iteration
+          )
+        )
+      packed = self._replayCache.get((id, origin))
+      if packed is not None:
+        sp = SpatialPooler.read(
+          SpatialPoolerProto_capnp.SpatialPoolerProto.from_bytes_packed(packed)
+        )
+      elif self._hasSnapshot(id, self.SP_KEY, origin):
+        sp = self._readSpatialPooler(id, origin)
+      else:
+        origin -= 1
+
+    learnFlags = self._readLearnFlags(id)
+    columns = np.zeros(sp.getNumColumns(), dtype="uint32")
+    for i in xrange(origin + 1, iteration + 1):
+      encoding = np.asarray(self.loadEncoding(id, i), dtype="uint32")
+      learn = i >= len(learnFlags) or learnFlags[i] != "0"
+      sp.compute(encoding, learn, columns)
+
+    if origin != iteration:
+      proto = SpatialPoolerProto_capnp.SpatialPoolerProto.new_message()
+      sp.write(proto)
+      self._replayCache.put((id, iteration), proto.to_bytes_packed())
+
+    metrics.observe("replay.sp", (time.time() - start) * 1000, id)
     return sp
 
 
-  def loadEncoding(self, id, iteration):
-    start = time.time() * 1000
-    key = self.ENCODING.format(id, iteration)
-    encoding = self._readData(key)
-    size = sys.getsizeof(encoding)
-    end = time.time() * 1000
-    print "\t{} input de-serialization of {} bytes into {} took {} ms".format(
-      id, size, key, (end - start)
+  def saveTemporalMemory(self, tm, id, iteration, activeColumns, learn=True,
+                         reset=False):
+    """
+    Saves one TM compute. Every iteration gets a small step record with the
+    compute's input, its flags, and the resulting winner cells. The active and
+    predictive cells go into the model's SDR logs. Full TM keyframes (segments
+    and synapses) are written on the model's keyframe interval, and whenever
+    the previous iteration was not saved.
+
+    :param activeColumns: indices of the active columns the TM computed
+    :param learn: whether the compute learned
+    :param reset: whether the TM was reset since the previous compute
+    """
+    isKeyframe = iteration <= 0 \
+                 or iteration % self.getKeyframeInterval(id) == 0 \
+                 or self._tmLastSaved.get(id) != iteration - 1
+    self._tmLastSaved[id] = iteration
+
+    step = {
+      "activeColumns": np.asarray(activeColumns, dtype="uint32"),
+      "learn": bool(learn),
+      "reset": bool(reset),
+      "winnerCells": np.asarray(tm.getWinnerCells(), dtype="uint32"),
+    }
+    stepData = self._encode(id, "tmstep", step)
+    numCells = tm.numberOfCells()
+    activeCells = np.asarray(tm.getActiveCells(), dtype="uint32")
+    predictiveCells = np.asarray(tm.getPredictiveCells(), dtype="uint32")
+    activeData = sdr_log.packIndices(activeCells, numCells)
+    predictiveData = sdr_log.packIndices(predictiveCells, numCells)
+    keyframeData = None
+    if isKeyframe:
+      proto = TemporalMemoryProto_capnp.TemporalMemoryProto.new_message()
+      tm.write(proto)
+      keyframeData = self._encode(id, "tm", proto)
+
+    def write():
+      self._writeSnapshot(id, self.TM_STEP, iteration, stepData)
+      if keyframeData is not None:
+        self._writeSnapshot(id, self.TM_KEY, iteration, keyframeData)
+      self._writeSdr(
+        id, TM_SNAPS.ACT_CELLS, "tmac", iteration, activeData, numCells
+      )
+      self._writeSdr(
+        id, TM_SNAPS.PRD_CELLS, "tmpc", iteration, predictiveData, numCells
+      )
+      self._activityIndex.record(
+        id, TM_SNAPS.ACT_CELLS, iteration, activeCells
+      )
+      self._activityIndex.record(
+        id, TM_SNAPS.PRD_CELLS, iteration, predictiveCells
+      )
+
+    self._submit(id, write)
+
+
+  def loadTmStep(self, id, iteration):
+    """
+    :return: (dict) the step record saved for one TM compute, see
+             saveTemporalMemory, with its active and predictive cells
+    """
+    self._awaitWrites(id)
+    step = self._readSnapshot(id, self.TM_STEP, iteration)
+    # Steps saved before the SDR logs have their cells in the record.
+    if "activeCells" not in step:
+      step["activeCells"] = self._sdrLog.readIndices(
+        id, TM_SNAPS.ACT_CELLS, iteration
+      )
+      step["predictiveCells"] = self._sdrLog.readIndices(
+        id, TM_SNAPS.PRD_CELLS, iteration
+      )
+    return step
+
+
+  def loadTmCells(self, id, state, iteration):
+    """
+    :param state: TmSnapshots.ACT_CELLS or TmSnapshots.PRD_CELLS
+    :return: (numpy.ndarray) indices of the TM's active or predictive cells
+             after one compute
+    """
+    self._awaitWrites(id)
+    cells = self._sdrLog.readIndices(id, state, iteration)
+    if cells is None:
+      # Saved before the SDR logs, in the step record.
+      cells = self._readSnapshot(id, self.TM_STEP, iteration)[state]
+    return cells
+
+
+  def loadTemporalMemory(self, id, iteration=None):
+    """
+    Rebuilds the TM at any saved iteration, from the nearest keyframe at or
+    before it plus a replay of the steps saved since.
+    """
+    with self._modelLock(id):
+      self._awaitWrites(id)
+      if iteration is None:
+        iteration = self.getMaxIteration(id, kind=_kind(self.TM_STEP))
+      start = time.time()
+
+      origin = iteration
+      tm = None
+      while tm is None:
+        if origin < -1:
+          raise ValueError(
+            "No TM keyframe for model {} at or before iteration {}.".format(
+              id, iteration
+            )
+          )
+        packed = self._replayCache.get((id, "tm", origin))
+        if packed is not None:
+          tm = TemporalMemory.read(
+            TemporalMemoryProto_capnp.TemporalMemoryProto.from_bytes_packed(
+              packed
+            )
+          )
+        elif self._hasSnapshot(id, self.TM_KEY, origin):
+          tm = TemporalMemory.read(
+            self._readSnapshot(id, self.TM_KEY, origin)
+          )
+        else:
+          origin -= 1
+
+      steps = self._readSnapshots(
+        id, self.TM_STEP, range(origin + 1, iteration + 1)
+      )
+      for step in steps:
+        if step["reset"]:
+          tm.reset()
+        tm.compute(
+          np.array(step["activeColumns"], dtype="uint32"), learn=step["learn"]
+        )
+
+      if origin != iteration:
+        proto = TemporalMemoryProto_capnp.TemporalMemoryProto.new_message()
+        tm.write(proto)
+        self._replayCache.put((id, "tm", iteration), proto.to_bytes_packed())
+
+      metrics.observe("load.tm", (time.time() - start) * 1000, id)
+      return tm
+
+
+  def saveColumnHistory(self, sp, activeColumns, id, iteration):
+    """
+    Writes this iteration's column states into the column-major store, so
+    column history can be read back without loading any SPs.
+    :param activeColumns: dense array of active column bits
+    """
+    baseline = self._spBaselines.get(id)
+    if baseline is not None and baseline[0] == iteration:
+      arrays = baseline[1]
+    else:
+      arrays = _extractSpArrays(sp)
+    numColumns = sp.getNumColumns()
+    numInputs = sp.getNumInputs()
+    values = {
+      SNAPS.ACT_COL: np.nonzero(activeColumns)[0],
+      SNAPS.PERMS: arrays["permanences"],
+      SNAPS.OVERLAPS: np.array(sp.getOverlaps()),
+      SNAPS.ACT_DC: arrays["activeDutyCycles"],
+      SNAPS.OVP_DC: arrays["overlapDutyCycles"],
+      SNAPS.BST_FCTRS: arrays["boostFactors"],
+    }
+    potentialPools = None
+    if self._columnStore.needsPotentialPools(id):
+      potentialPools = getPotentialCsr(sp)
+
+    def write():
+      with metrics.span("write.colhist", id):
+        self._columnStore.write(
+          id, iteration, numColumns, numInputs, values, potentialPools
+        )
+
+    self._submit(id, write)
+
+
+  def hasColumnHistory(self, id, state):
+    return self._columnStore.contains(id, state)
+
+
+  def getColumnHistory(self, id, columnIndex, states, start, stop):
+    """
+    :return: (dict) one list per state of the column's values for iterations
+             [start, stop), read from the column-major store
+    """
+    self._awaitWrites(id)
+    return self._columnStore.read(id, columnIndex, states, start, stop)
+
+
+  def getColumnsHistory(self, id, columns, states, start, stop, stride=1):
+    """
+    :param columns: column indices, or None for every column
+    :return: (dict) one matrix per state of the columns' values for iterations
+             start, start + stride, ... below stop, read from the column-major
+             store in one pass. See ColumnStore.readMatrix.
+    """
+    self._awaitWrites(id)
+    return self._columnStore.readMatrix(
+      id, columns, states, start, stop, stride
     )
+
+
+  def hasActivityIndex(self, id, state):
+    self._awaitWrites(id)
+    return self._activityIndex.contains(id, state)
+
+
+  def getActiveIterations(self, id, state, index, start=0, stop=None):
+    """
+    :param state: activeColumns, activeCells or predictiveCells
+    :param index: column or cell index
+    :return: sorted iterations in [start, stop) the column or cell was active
+             (or predictive) in, from the activity index
+    """
+    self._awaitWrites(id)
+    return self._activityIndex.getIterations(id, state, index, start, stop)
+
+
+  def getActivity(self, id, state, indices, start=0, stop=None):
+    """
+    :return: (dict) per column or cell index: activation count, first and last
+             active iteration in [start, stop). See ActivityIndex.
+    """
+    self._awaitWrites(id)
+    return self._activityIndex.getActivity(id, state, indices, start, stop)
+
+
+  def getCoactivation(self, id, state, indices, start=0, stop=None):
+    """
+    :return: (numpy.ndarray) number of iterations in [start, stop) each pair
+             of indices was active together in
+    """
+    self._awaitWrites(id)
+    return self._activityIndex.getCoactivation(id, state, indices, start, stop)
+
+
+  def rebuildActivityIndex(self, id):
+    """
+    Rebuilds a model's activity index from its saved active columns and TM
+    steps, for history written before there was an index.
+    """
+    self._awaitWrites(id)
+    index = self._getIndex(id)
+    records = {}
+    spIterations = index.getIterations("spac")
+    if len(spIterations) > 0:
+      records[SNAPS.ACT_COL] = [
+        (iteration, np.nonzero(self.loadActiveColumns(id, iteration))[0])
+        for iteration in spIterations
+      ]
+    # TM steps of compacted iterations are gone, but their cells are still in
+    # the SDR log.
+    logged, _ = self._sdrLog.getRange(id, TM_SNAPS.ACT_CELLS, 0, None)
+    tmIterations = sorted(
+      set(index.getIterations("tmstep")) | set(np.nonzero(logged)[0].tolist())
+    )
+    if len(tmIterations) > 0:
+      for state in [TM_SNAPS.ACT_CELLS, TM_SNAPS.PRD_CELLS]:
+        records[state] = [
+          (iteration, self.loadTmCells(id, state, iteration))
+          for iteration in tmIterations
+        ]
+    self._activityIndex.rebuild(id, records)
+
+
+  def loadEncoding(self, id, iteration):
+    self._awaitWrites(id)
+    encoding = self._readSdr(id, SNAPS.INPUT, _kind(self.ENCODING), iteration)
+    if encoding is None:
+      return self._readSnapshot(id, self.ENCODING, iteration)
     return encoding
 
 
   def loadActiveColumns(self, id, iteration):
-    start = time.time() * 1000
-    key = self.SP_ACT_COL.format(id, iteration)
-    activeColumns = self._readData(key)
-    size = sys.getsizeof(activeColumns)
-    end = time.time() * 1000
-    print "\t{} activeColumns de-serialization of {} bytes into {} took {} ms".format(
-      id, size, key, (end - start)
+    self._awaitWrites(id)
+    activeColumns = self._readSdr(
+      id, SNAPS.ACT_COL, _kind(self.SP_ACT_COL), iteration
     )
+    if activeColumns is None:
+      return self._readSnapshot(id, self.SP_ACT_COL, iteration)
     return activeColumns
 
 
-  def getMaxIteration(self, modelId):
-    maxIteration = 0
-    # We will use active columns keys to find the max iteration.
-    keys = os.listdir(self._workingDir)
-    if len(keys) > 0:
-      maxIteration = max([int(key.split("_")[3].split(".")[0]) for key in keys])
+  def loadSdrRange(self, id, field, start, stop):
+    """
+    Reads a range of iterations straight out of a model's SDR log, without
+    copying or unpacking anything. History saved before the logs is not in
+    them.
+    :param field: SpSnapshots.INPUT, SpSnapshots.ACT_COL,
+                  TmSnapshots.ACT_CELLS or TmSnapshots.PRD_CELLS
+    :return: (present, packed) read-only views of iterations [start, stop),
+             cut short at the last one saved. present is 1 for each iteration
+             that was saved, packed holds its bits as np.packbits would.
+    """
+    self._awaitWrites(id)
+    return self._sdrLog.getRange(id, field, start, stop)
+
+
+  def saveCacheEntry(self, id, entry):
+    """
+    Saves an evicted model cache entry (packed SP and TM, classifier,
+    counters). Nothing is written to the model's history.
+    """
+    key = self.CACHE_ENTRY.format(id)
+    data = self._encode(id, "cached", entry)
+    self._submit(id, lambda: self._writeBytes(id, key, data))
+
+
+  def hasCacheEntry(self, id):
+    self._awaitWrites(id)
+    return self._exists(id, self.CACHE_ENTRY.format(id))
+
+
+  def loadCacheEntry(self, id):
+    self._awaitWrites(id)
+    data = self._readBytes(id, self.CACHE_ENTRY.format(id))
+    return snapshot_codecs.timedUnpack(
+      self._codecStats, "cached", data, snapshot_codecs.getCodec("pickle")
+    )
+
+
+  def deleteCacheEntry(self, id):
+    self._awaitWrites(id)
+    self._deleteBytes(id, self.CACHE_ENTRY.format(id))
+
+
+  def getMaxIteration(self, modelId, kind=None):
+    """
+    :param kind: only count snapshots of this kind, like "spac" or "tmstep"
+    :return: highest saved iteration, 0 if there is none
+    """
+    self._awaitWrites(modelId)
+    maxIteration = self._getIndex(modelId).getMaxIteration(kind)
+    if maxIteration is None:
+      maxIteration = 0
     return maxIteration
 
 
+  def hasIteration(self, modelId, iteration):
+    """
+    :return: whether any snapshot is stored for the model at this iteration
+    """
+    self._awaitWrites(modelId)
+    return self._getIndex(modelId).containsIteration(iteration)
+
+
+  def getModelIndex(self, modelId):
+    """
+    :return: (dict) iterations, snapshot kinds and bytes stored for a model
+    """
+    self._awaitWrites(modelId)
+    return self._getIndex(modelId).getSummary()
+
+
+  def listModels(self):
+    """
+    :return: ids of every model with history in the working directory
+    """
+    return [
+      name for name in os.listdir(self._workingDir)
+      if os.path.isdir(os.path.join(self._workingDir, name))
+    ]
+
+
+  def hasModel(self, modelId):
+    """
+    :return: whether a model has history
+    :raises ValueError: if modelId is not a valid model id
+    """
+    return os.path.isdir(self._modelDir(modelId))
+
+
+  def compact(self, modelId):
+    """
+    Applies a model's retention policy (see RetentionPolicy) to the iterations
+    that have aged out since the last time. Iterations kept in the downsampled
+    range get SP and TM keyframes if they do not have them yet, then the SP and
+    TM state of every other old iteration is deleted, along with column store
+    segments that only hold SDR-only iterations.
+
+    Nothing at or after the last keyframe the oldest full-fidelity iteration
+    loads from is touched, so the model can keep computing while this runs on
+    another thread. Loads of the model and changes to its config wait for it
+    to finish (see _modelLock()).
+
+    :return: (int) bytes reclaimed, net of the keyframes written
+    """
+    with self._modelLock(modelId):
+      policy = self.getRetentionPolicy(modelId)
+      if policy is None:
+        return 0
+      index = self._getIndex(modelId)
+      latest = index.getMaxIteration()
+      if latest is None:
+        return 0
+
+      cutoff = _lastAtOrBefore(
+        index.getIterations(_kind(self.SP_KEY)), latest - policy.keepLast + 1
+      )
+      tmSteps = index.getIterations(_kind(self.TM_STEP))
+      if cutoff is not None and len(tmSteps) > 0 and tmSteps[0] < cutoff:
+        cutoff = _lastAtOrBefore(
+          index.getIterations(_kind(self.TM_KEY)), cutoff
+        )
+      if cutoff is None:
+        return 0
+      config = self._getConfig(modelId)
+      downsampledBefore = config.get("downsampledBefore", 0)
+      sdrOnlyBefore = config.get("sdrOnlyBefore", 0)
+      newSdrOnlyBefore = sdrOnlyBefore
+      if policy.sdrOnlyAfter is not None:
+        newSdrOnlyBefore = max(
+          sdrOnlyBefore, min(cutoff, latest - policy.sdrOnlyAfter + 1)
+        )
+      newDownsampledBefore = downsampledBefore
+      if policy.every > 1:
+        newDownsampledBefore = max(downsampledBefore, cutoff)
+
+      # Keyframes for the iterations that are kept, while everything they are
+      # rebuilt from is still there.
+      reclaimed = 0
+      first = max(downsampledBefore, newSdrOnlyBefore)
+      first += -first % policy.every
+      computed = set(index.getIterations(_kind(self.SP_ACT_COL)))
+      spKeyframes = index.getIterations(_kind(self.SP_KEY))
+      tmSteps = set(tmSteps)
+      for iteration in xrange(first, newDownsampledBefore, policy.every):
+        if iteration in computed and iteration > spKeyframes[0] \
+            and not self._hasSnapshot(modelId, self.SP_KEY, iteration):
+          sp = self.loadSpatialPooler(modelId, iteration)
+          proto = SpatialPoolerProto_capnp.SpatialPoolerProto.new_message()
+          sp.write(proto)
+          data = self._encode(modelId, "sp", proto)
+          self._writeSnapshot(modelId, self.SP_KEY, iteration, data)
+          reclaimed -= len(data)
+        if iteration in tmSteps \
+            and not self._hasSnapshot(modelId, self.TM_KEY, iteration):
+          tm = self.loadTemporalMemory(modelId, iteration)
+          proto = TemporalMemoryProto_capnp.TemporalMemoryProto.new_message()
+          tm.write(proto)
+          data = self._encode(modelId, "tm", proto)
+          self._writeSnapshot(modelId, self.TM_KEY, iteration, data)
+          reclaimed -= len(data)
+
+      # From here on, readers treat the old iterations as gone.
+      self._updateConfig(
+        modelId, downsampledBefore=newDownsampledBefore,
+        sdrOnlyBefore=newSdrOnlyBefore
+      )
+
+      for template in [self.SP_KEY, self.SP_DELTA, self.TM_KEY, self.TM_STEP]:
+        dropped = []
+        for iteration in index.getIterations(_kind(template)):
+          if iteration >= newDownsampledBefore \
+              and iteration >= newSdrOnlyBefore:
+            break
+          if iteration < newSdrOnlyBefore or template == self.SP_DELTA \
+              or iteration % policy.every != 0:
+            dropped.append(iteration)
+        reclaimed += self._deleteSnapshots(modelId, template, dropped)
+      reclaimed += self._columnStore.dropStates(
+        modelId, [s for s in ColumnStore.STATES if s != SNAPS.ACT_COL],
+        sdrOnlyBefore, newSdrOnlyBefore
+      )
+
+      if reclaimed > 0:
+        metrics.addBytes("compacted", reclaimed, modelId)
+      return reclaimed
+
+
+  def delete(self, modelId):
+    """
+    Removes all history of one model.
+    """
+    self._awaitWrites(modelId)
+    self._configs.pop(modelId, None)
+    self._spBaselines.pop(modelId, None)
+    self._tmLastSaved.pop(modelId, None)
+    with self._indexLock:
+      self._indexes.pop(modelId, None)
+    self._replayCache.clear()
+    self._columnStore.reset()
+    self._activityIndex.forget(modelId)
+    self._sdrLog.forget(modelId)
+    self._snapshotCache.forget(modelId)
+    self._deleteModel(modelId)
+
+
+  def _deleteModel(self, modelId):
+    shutil.rmtree(self._modelDir(modelId), ignore_errors=True)
+
+
   def nuke(self):
+    self._awaitWrites()
+    self._configs = {}
+    self._spBaselines = {}
+    self._tmLastSaved = {}
+    with self._indexLock:
+      self._indexes = {}
+    self._replayCache.clear()
+    self._columnStore.reset()
+    self._activityIndex.reset()
+    self._sdrLog.reset()
+    self._snapshotCache.clear()
+    self._deleteAllModels()
+
+
+  def _deleteAllModels(self):
     folder = self._workingDir
     for f in os.listdir(folder):
       p = os.path.join(folder, f)
       try:
-        if os.path.isfile(p):
+        if os.path.isdir(p):
+          shutil.rmtree(p)
+        elif os.path.isfile(p):
           os.unlink(p)
       except Exception as e:
         print(e)
 
 
 
+def checkModelId(modelId):
+  """
+  Model ids name directories and Redis keys, so only letters, digits, "_" and
+  "-" are allowed.
+  :raises ValueError: if modelId is anything else
+  """
+  if not isinstance(modelId, basestring) or MODEL_ID.match(modelId) is None:
+    raise ValueError("Invalid model id: {!r}".format(modelId))
+
+
+
+def _kind(template):
+  # "htm_spdelta_{}_{}.npc" -> "spdelta"
+  return template.split("_")[1]
+
+
+def _lastAtOrBefore(iterations, iteration):
+  """
+  :param iterations: sorted iterations
+  :return: the last of them at or before iteration, or None
+  """
+  position = bisect.bisect_right(iterations, iteration)
+  return iterations[position - 1] if position > 0 else None
+
+
+# SP arrays that change from one iteration to the next, and are therefore kept
+# in deltas between keyframes. Everything else in the SP is either static after
+# creation or is a scalar stored with each delta.
+SP_DELTA_ARRAYS = [
+  "permanences",
+  "activeDutyCycles",
+  "overlapDutyCycles",
+  "minOverlapDutyCycles",
+  "boostFactors",
+]
+
+
+def _extractSpArrays(sp):
+  numColumns = sp.getNumColumns()
+  arrays = {}
+  arrays["permanences"] = getPermanenceMatrix(sp)
+  for name in SP_DELTA_ARRAYS[1:]:
+    values = np.zeros(numColumns, dtype="float32")
+    getattr(sp, "get" + name[:1].upper() + name[1:])(values)
+    arrays[name] = values
+  arrays["iterationNum"] = sp.getIterationNum()
+  arrays["iterationLearnNum"] = sp.getIterationLearnNum()
+  arrays["inhibitionRadius"] = sp.getInhibitionRadius()
+  return arrays
+
+
+def _diffSpArrays(before, after):
+  delta = {
+    "iterationNum": after["iterationNum"],
+    "iterationLearnNum": after["iterationLearnNum"],
+    "inhibitionRadius": after["inhibitionRadius"],
+  }
+  for name in SP_DELTA_ARRAYS:
+    changed = np.nonzero(before[name] != after[name])
+    delta[name] = {
+      "indices": [np.asarray(i, dtype="uint32") for i in changed],
+      "values": after[name][changed],
+    }
+  return delta
+
+
+def _applySpDeltas(arrays, deltas):
+  """
+  Applies deltas in order onto arrays in place.
+  :return: (set) column indices whose permanences were touched
+  """
+  touchedColumns = set()
+  for delta in deltas:
+    for name in SP_DELTA_ARRAYS:
+      changed = tuple(delta[name]["indices"])
+      arrays[name][changed] = delta[name]["values"]
+    touchedColumns.update(delta["permanences"]["indices"][0].tolist())
+    for name in ["iterationNum", "iterationLearnNum", "inhibitionRadius"]:
+      arrays[name] = delta[name]
+  return touchedColumns
+
+
+def _restoreSpArrays(sp, arrays, touchedColumns):
+  permanences = arrays["permanences"]
+  for colIndex in touchedColumns:
+    sp.setPermanence(colIndex, permanences[colIndex])
+  for name in SP_DELTA_ARRAYS[1:]:
+    getattr(sp, "set" + name[:1].upper() + name[1:])(arrays[name])
+  sp.setIterationNum(arrays["iterationNum"])
+  sp.setIterationLearnNum(arrays["iterationLearnNum"])
+  sp.setInhibitionRadius(arrays["inhibitionRadius"])
+
+
+
       # def saveInput(self, id, input, step):
   #   compressedInput = compressSdr(input)
   #   size = sys.getsizeof(compressedInput)
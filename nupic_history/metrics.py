@@ -0,0 +1,201 @@
+import bisect
+import threading
+import time
+
+
+# Upper bounds of histogram buckets, in ms. The last bucket takes the rest.
+BUCKETS_MS = [
+  0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500,
+  5000, 10000,
+]
+
+
+
+class Histogram(object):
+  """
+  Latency histogram over fixed buckets, so recording costs a bisect and a few
+  additions, and memory does not grow with the number of samples.
+  """
+
+  def __init__(self):
+    self.counts = [0] * (len(BUCKETS_MS) + 1)
+    self.count = 0
+    self.totalMs = 0.0
+    self.maxMs = 0.0
+
+
+  def observe(self, ms):
+    self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+    self.count += 1
+    self.totalMs += ms
+    if ms > self.maxMs:
+      self.maxMs = ms
+
+
+  def quantile(self, q):
+    """
+    :return: upper bound of the bucket the q quantile falls in (the max for the
+             last bucket), None without samples
+    """
+    if self.count == 0:
+      return None
+    rank = q * self.count
+    seen = 0
+    for i, count in enumerate(self.counts):
+      seen += count
+      if seen >= rank and count > 0:
+        return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.maxMs
+    return self.maxMs
+
+
+  def getStats(self):
+    return {
+      "count": self.count,
+      "totalMs": self.totalMs,
+      "meanMs": self.totalMs / max(self.count, 1),
+      "maxMs": self.maxMs,
+      "p50Ms": self.quantile(0.5),
+      "p90Ms": self.quantile(0.9),
+      "p99Ms": self.quantile(0.99),
+      "buckets": dict(
+        (str(bound), count)
+        for bound, count in zip(BUCKETS_MS + ["inf"], self.counts)
+        if count > 0
+      ),
+    }
+
+
+
+class _Span(object):
+
+  __slots__ = ["_metrics", "_stage", "_modelId", "_start"]
+
+  def __init__(self, metrics, stage, modelId):
+    self._metrics = metrics
+    self._stage = stage
+    self._modelId = modelId
+
+
+  def __enter__(self):
+    self._start = time.time()
+    return self
+
+
+  def __exit__(self, *exc):
+    self._metrics.observe(
+      self._stage, (time.time() - self._start) * 1000, self._modelId
+    )
+
+
+
+class Metrics(object):
+  """
+  Latency histograms per stage, overall and per model, plus byte counters.
+  Stages are timed with span():
+
+    with metrics.span("sp.compute", modelId):
+      ...
+
+  Spans on a thread between beginRequest() and serverTiming() are also summed
+  up per stage for that request, for a Server-Timing header.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._stages = {}
+    self._models = {}
+    self._bytes = {}
+    self._modelBytes = {}
+
+
+  def span(self, stage, modelId=None):
+    return _Span(self, stage, modelId)
+
+
+  def observe(self, stage, ms, modelId=None):
+    with self._lock:
+      histogram = self._stages.get(stage)
+      if histogram is None:
+        histogram = self._stages[stage] = Histogram()
+      histogram.observe(ms)
+      if modelId is not None:
+        stages = self._models.setdefault(modelId, {})
+        histogram = stages.get(stage)
+        if histogram is None:
+          histogram = stages[stage] = Histogram()
+        histogram.observe(ms)
+    timings = getattr(self._local, "timings", None)
+    if timings is not None:
+      timings[stage] = timings.get(stage, 0.0) + ms
+
+
+  def addBytes(self, counter, size, modelId=None):
+    """
+    Adds to a byte counter, like "written.sp" or "response".
+    """
+    with self._lock:
+      self._bytes[counter] = self._bytes.get(counter, 0) + size
+      if modelId is not None:
+        counters = self._modelBytes.setdefault(modelId, {})
+        counters[counter] = counters.get(counter, 0) + size
+
+
+  def beginRequest(self):
+    self._local.timings = {}
+
+
+  def serverTiming(self):
+    """
+    Ends the current thread's request.
+    :return: Server-Timing header value for the stages it went through
+    """
+    timings = getattr(self._local, "timings", None) or {}
+    self._local.timings = None
+    return ", ".join(
+      "{};dur={:.3f}".format(stage, ms)
+      for stage, ms in sorted(timings.iteritems())
+    )
+
+
+  def forgetModel(self, modelId):
+    with self._lock:
+      self._models.pop(modelId, None)
+      self._modelBytes.pop(modelId, None)
+
+
+  def reset(self):
+    with self._lock:
+      self._stages = {}
+      self._models = {}
+      self._bytes = {}
+      self._modelBytes = {}
+
+
+  def getStats(self):
+    """
+    :return: (dict) "stages" (histogram per stage), "bytes" (counters), and
+             "models" (the same two, per model)
+    """
+    with self._lock:
+      models = {}
+      for modelId in set(self._models.keys() + self._modelBytes.keys()):
+        models[modelId] = {
+          "stages": dict(
+            (stage, histogram.getStats())
+            for stage, histogram in self._models.get(modelId, {}).iteritems()
+          ),
+          "bytes": dict(self._modelBytes.get(modelId, {})),
+        }
+      return {
+        "stages": dict(
+          (stage, histogram.getStats())
+          for stage, histogram in self._stages.iteritems()
+        ),
+        "bytes": dict(self._bytes),
+        "models": models,
+      }
+
+
+# The server's metrics. Instrumented code records into this.
+metrics = Metrics()
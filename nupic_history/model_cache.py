@@ -0,0 +1,310 @@
+import threading
+from collections import OrderedDict
+
+from nupic.bindings.algorithms import SpatialPooler, TemporalMemory
+from nupic.proto import SpatialPoolerProto_capnp, TemporalMemoryProto_capnp
+
+from nupic_history.sp_facade import SpFacade
+from nupic_history.tm_facade import TmFacade
+
+
+class ModelCache(object):
+  """
+  Bounded cache of live models, each entry being a dict like:
+
+    {
+      "sp": SpFacade,
+      "save": bool,
+      "tm": TmFacade,            (once a TM has been added)
+      "classifier": classifier,
+      "recordsSeen": int,
+    }
+
+  When there are more than maxModels entries, or their estimated size goes
+  over maxBytes, the least recently used entries are persisted through the IO
+  client and dropped from memory. They are reloaded transparently the next time
+  they are asked for, so callers can treat this like a dict.
+
+  It is safe to use from many threads. Besides its own lock, it hands out one
+  lock per model (see lock()), which callers hold while they compute on or
+  otherwise mutate that model. Different models compute in parallel. A model
+  is never evicted while its lock is held.
+  """
+
+  def __init__(self, ioClient, maxModels=None, maxBytes=None):
+    """
+    :param ioClient: IO client evicted models are persisted through
+    :param maxModels: max number of models in memory, None for no limit
+    :param maxBytes: max estimated bytes of models in memory, None for no limit
+    """
+    self._ioClient = ioClient
+    self._maxModels = maxModels
+    self._maxBytes = maxBytes
+    self._entries = OrderedDict()
+    self._sizes = {}
+    self._lock = threading.RLock()
+    self._modelLocks = {}
+    self._stats = {
+      "hits": 0,
+      "misses": 0,
+      "evictions": 0,
+      "reloads": 0,
+    }
+
+
+  def __contains__(self, modelId):
+    with self._lock:
+      if modelId in self._entries:
+        return True
+    return self._ioClient.hasCacheEntry(modelId)
+
+
+  def __getitem__(self, modelId):
+    with self._lock:
+      entry = self._entries.pop(modelId, None)
+      if entry is not None:
+        self._stats["hits"] += 1
+        self._entries[modelId] = entry
+    if entry is None:
+      # Reloading can be slow, so only this model waits for it.
+      with self.lock(modelId):
+        with self._lock:
+          entry = self._entries.get(modelId)
+        if entry is None:
+          if not self._ioClient.hasCacheEntry(modelId):
+            raise KeyError(modelId)
+          entry = self._reload(modelId)
+          with self._lock:
+            self._stats["misses"] += 1
+            self._entries[modelId] = entry
+            self._sizes[modelId] = 0
+    self._resize(modelId, entry)
+    self._enforceBudget(keep=modelId)
+    return entry
+
+
+  def __setitem__(self, modelId, entry):
+    with self._lock:
+      if modelId in self._entries:
+        del self._entries[modelId]
+      self._entries[modelId] = entry
+      self._sizes[modelId] = 0
+    self._resize(modelId, entry)
+    self._enforceBudget(keep=modelId)
+
+
+  def __len__(self):
+    return len(self._entries)
+
+
+  def lock(self, modelId):
+    """
+    :return: the re-entrant lock to hold while computing on a model
+    """
+    with self._lock:
+      if modelId not in self._modelLocks:
+        self._modelLocks[modelId] = threading.RLock()
+      return self._modelLocks[modelId]
+
+
+  def keys(self):
+    """
+    :return: ids of the models in memory
+    """
+    with self._lock:
+      return self._entries.keys()
+
+
+  def clear(self):
+    """
+    Drops every model from memory without persisting anything.
+    """
+    with self._lock:
+      self._entries.clear()
+      self._sizes.clear()
+
+
+  def discard(self, modelId):
+    """
+    Drops one model from memory without persisting it.
+    """
+    with self._lock:
+      self._entries.pop(modelId, None)
+      self._sizes.pop(modelId, None)
+
+
+  def evict(self, modelId):
+    """
+    Persists a model through the IO client and drops it from memory. Waits for
+    anyone computing on it to finish first.
+    """
+    with self.lock(modelId):
+      with self._lock:
+        entry = self._entries.pop(modelId, None)
+        self._sizes.pop(modelId, None)
+      if entry is not None:
+        self._spill(modelId, entry)
+
+
+  def _spill(self, modelId, entry):
+    # The SP and TM are spilled as they are in memory, so nothing is written
+    # to the model's history, which models created with save=False must not
+    # have.
+    sp = entry["sp"]
+    spilled = dict(
+      (key, value) for key, value in entry.iteritems()
+      if key not in ["sp", "tm"]
+    )
+    spilled["sp"] = {
+      "sp": _writeProto(sp._sp, SpatialPoolerProto_capnp.SpatialPoolerProto),
+      "input": sp._input,
+      "activeColumns": sp._activeColumns,
+      "learn": sp._learn,
+    }
+    if "tm" in entry:
+      tm = entry["tm"]
+      spilled["tm"] = {
+        "tm": _writeProto(
+          tm._tm, TemporalMemoryProto_capnp.TemporalMemoryProto
+        ),
+        "iteration": tm.getIteration(),
+        "input": tm._input,
+        "learn": tm._learn,
+        "resetPending": tm._resetPending,
+        "resetBefore": tm._resetBefore,
+      }
+    self._ioClient.saveCacheEntry(modelId, spilled)
+    with self._lock:
+      self._stats["evictions"] += 1
+    print "Evicted model {} from memory".format(modelId)
+
+
+  def getStats(self):
+    """
+    :return: (dict) hit, miss, eviction and reload counters, plus current size
+    """
+    with self._lock:
+      stats = dict(self._stats)
+      stats["models"] = len(self._entries)
+      stats["bytes"] = sum(self._sizes.values())
+    stats["maxModels"] = self._maxModels
+    stats["maxBytes"] = self._maxBytes
+    return stats
+
+
+  def _reload(self, modelId):
+    ioClient = self._ioClient
+    entry = ioClient.loadCacheEntry(modelId)
+    spilled = entry["sp"]
+    sp = SpatialPooler.read(_readProto(
+      spilled["sp"], SpatialPoolerProto_capnp.SpatialPoolerProto
+    ))
+    # Loaded by id so that what the snapshot cache holds for the model is kept.
+    spFacade = SpFacade(modelId, ioClient, iteration=sp.getIterationNum())
+    spFacade._sp = sp
+    spFacade._input = spilled["input"]
+    spFacade._activeColumns = spilled["activeColumns"]
+    spFacade._learn = spilled["learn"]
+    entry["sp"] = spFacade
+    if "tm" in entry:
+      spilled = entry["tm"]
+      tm = TemporalMemory.read(_readProto(
+        spilled["tm"], TemporalMemoryProto_capnp.TemporalMemoryProto
+      ))
+      tmFacade = TmFacade(
+        tm, ioClient, modelId=modelId, iteration=spilled["iteration"]
+      )
+      tmFacade._input = spilled["input"]
+      tmFacade._learn = spilled["learn"]
+      tmFacade._resetPending = spilled["resetPending"]
+      tmFacade._resetBefore = spilled["resetBefore"]
+      entry["tm"] = tmFacade
+    ioClient.deleteCacheEntry(modelId)
+    with self._lock:
+      self._stats["reloads"] += 1
+    print "Reloaded model {} into memory".format(modelId)
+    return entry
+
+
+  def _isOverBudget(self):
+    if self._maxModels is not None and len(self._entries) > self._maxModels:
+      return True
+    if self._maxBytes is not None \
+        and sum(self._sizes.values()) > self._maxBytes:
+      return True
+    return False
+
+
+  def _resize(self, modelId, entry):
+    # Models grow as they learn, so re-estimate whenever one is used. Sizing
+    # reads the model, so it is skipped while someone is computing on it.
+    modelLock = self.lock(modelId)
+    if not modelLock.acquire(False):
+      return
+    try:
+      size = _estimateBytes(entry)
+    finally:
+      modelLock.release()
+    with self._lock:
+      if modelId in self._sizes:
+        self._sizes[modelId] = size
+
+
+  def _enforceBudget(self, keep):
+    # Evicts least recently used models that nobody is computing on.
+    skipped = set()
+    while True:
+      with self._lock:
+        if not self._isOverBudget():
+          return
+        victim = None
+        for modelId in self._entries:
+          if modelId != keep and modelId not in skipped:
+            victim = modelId
+            break
+        if victim is None:
+          return
+        modelLock = self.lock(victim)
+        if not modelLock.acquire(False):
+          skipped.add(victim)
+          continue
+        entry = self._entries.pop(victim)
+        self._sizes.pop(victim, None)
+      try:
+        self._spill(victim, entry)
+      finally:
+        modelLock.release()
+
+
+
+def _writeProto(model, protoType):
+  """
+  :return: (str) packed capnp bytes of an SP or TM
+  """
+  proto = protoType.new_message()
+  model.write(proto)
+  return proto.to_bytes_packed()
+
+
+
+def _readProto(data, protoType):
+  return protoType.from_bytes_packed(data)
+
+
+
+def _estimateBytes(entry):
+  """
+  Rough in-memory size of a cache entry, from the sizes of its SP and TM.
+  """
+  size = 0
+  sp = entry.get("sp")
+  if sp is not None and hasattr(sp, "_sp"):
+    params = sp.getParams()
+    # Permanences and potential pools in the SP, plus the facade's cached
+    # permanence matrix.
+    size += params["numColumns"] * params["numInputs"] * 12
+  tmFacade = entry.get("tm")
+  if tmFacade is not None and hasattr(tmFacade, "_tm"):
+    connections = tmFacade._tm.connections
+    size += connections.numSynapses() * 16 + connections.numSegments() * 32
+  return size
@@ -0,0 +1,158 @@
+import os
+import threading
+
+
+class ModelIndex(object):
+  """
+  Persistent index of the iteration-addressed snapshots stored for one model:
+  which iterations are present, of which kinds, and how many bytes each takes.
+  It is kept in memory and in an append-only log in the model's directory, so
+  nothing ever needs to list the directory to answer questions about it.
+
+  Snapshot file names are "htm_{kind}_{modelId}_{iteration}.npc". If a model
+  directory has no log yet, the index is rebuilt once from those names.
+  """
+
+  LOG = "htm_index.log"
+
+  def __init__(self, modelDir):
+    self._modelDir = modelDir
+    self._lock = threading.Lock()
+    self._snapshots = {}
+    self._maxIteration = None
+    self._maxIterationByKind = {}
+    self._bytes = 0
+    logPath = os.path.join(modelDir, self.LOG)
+    if os.path.exists(logPath):
+      with open(logPath, "r") as log:
+        for line in log:
+          kind, iteration, size = line.split()
+          self._add(kind, int(iteration), int(size))
+    elif os.path.isdir(modelDir):
+      self._rebuild()
+
+
+  def _add(self, kind, iteration, size):
+    kinds = self._snapshots.setdefault(iteration, {})
+    self._bytes += size - kinds.get(kind, 0)
+    kinds[kind] = size
+    if self._maxIteration is None or iteration > self._maxIteration:
+      self._maxIteration = iteration
+    kindMax = self._maxIterationByKind.get(kind)
+    if kindMax is None or iteration > kindMax:
+      self._maxIterationByKind[kind] = iteration
+
+
+  def _rebuild(self):
+    lines = []
+    for name in os.listdir(self._modelDir):
+      parts = name.split(".")[0].split("_")
+      if len(parts) != 4 or parts[0] != "htm":
+        continue
+      try:
+        iteration = int(parts[3])
+      except ValueError:
+        continue
+      size = os.path.getsize(os.path.join(self._modelDir, name))
+      self._add(parts[1], iteration, size)
+      lines.append("{} {} {}\n".format(parts[1], iteration, size))
+    with open(os.path.join(self._modelDir, self.LOG), "w") as log:
+      log.writelines(lines)
+
+
+  def record(self, kind, iteration, size):
+    """
+    Adds (or replaces) one snapshot. Call after it has been written.
+    """
+    with self._lock:
+      self._add(kind, iteration, size)
+      with open(os.path.join(self._modelDir, self.LOG), "a") as log:
+        log.write("{} {} {}\n".format(kind, iteration, size))
+
+
+  def remove(self, kind, iterations):
+    """
+    Drops snapshots of one kind, and rewrites the log without them. Call after
+    they have been deleted.
+    :return: bytes the dropped snapshots took
+    """
+    with self._lock:
+      removed = 0
+      for iteration in iterations:
+        kinds = self._snapshots.get(iteration)
+        if kinds is None or kind not in kinds:
+          continue
+        removed += kinds.pop(kind)
+        if len(kinds) == 0:
+          del self._snapshots[iteration]
+      if removed == 0:
+        return 0
+      self._bytes -= removed
+      self._maxIteration = max(self._snapshots) if self._snapshots else None
+      kindIterations = [
+        snapshotIteration
+        for snapshotIteration, snapshotKinds in self._snapshots.iteritems()
+        if kind in snapshotKinds
+      ]
+      if len(kindIterations) > 0:
+        self._maxIterationByKind[kind] = max(kindIterations)
+      else:
+        self._maxIterationByKind.pop(kind, None)
+      logPath = os.path.join(self._modelDir, self.LOG)
+      with open(logPath + ".tmp", "w") as log:
+        for iteration in sorted(self._snapshots):
+          for snapshotKind, size in self._snapshots[iteration].iteritems():
+            log.write("{} {} {}\n".format(snapshotKind, iteration, size))
+      os.rename(logPath + ".tmp", logPath)
+      return removed
+
+
+  def contains(self, kind, iteration):
+    kinds = self._snapshots.get(iteration)
+    return kinds is not None and kind in kinds
+
+
+  def containsIteration(self, iteration):
+    return iteration in self._snapshots
+
+
+  def getMaxIteration(self, kind=None):
+    """
+    :return: highest iteration with a snapshot of kind (or of any kind), or
+             None if there are none
+    """
+    if kind is None:
+      return self._maxIteration
+    return self._maxIterationByKind.get(kind)
+
+
+  def getIterations(self, kind=None):
+    """
+    :return: sorted iterations that have a snapshot of kind (or of any kind)
+    """
+    with self._lock:
+      return sorted([
+        iteration for iteration, kinds in self._snapshots.iteritems()
+        if kind is None or kind in kinds
+      ])
+
+
+  def getSummary(self):
+    """
+    :return: (dict) iteration range, plus snapshot counts and bytes per kind
+    """
+    with self._lock:
+      kinds = {}
+      for snapshots in self._snapshots.itervalues():
+        for kind, size in snapshots.iteritems():
+          summary = kinds.setdefault(kind, {"count": 0, "bytes": 0})
+          summary["count"] += 1
+          summary["bytes"] += size
+      iterations = self._snapshots.keys()
+      return {
+        "iterations": len(iterations),
+        "firstIteration": min(iterations) if iterations else None,
+        "lastIteration": self._maxIteration,
+        "kinds": kinds,
+        "bytes": self._bytes,
+      }
@@ -0,0 +1,917 @@
+import threading
+
+import numpy as np
+import redis
+
+from nupic_history import SpSnapshots as SNAPS
+from nupic_history.activity_index import ActivityIndex
+from nupic_history.column_store import ColumnStore, _potentialColumns
+from nupic_history.io_client import FileIoClient, _kind, checkModelId
+from nupic_history.metrics import metrics
+from nupic_history.sdr_log import SdrLog
+
+
+class RedisIoClient(FileIoClient):
+  """
+  Saves and loads model history in Redis, with the same interface as
+  FileIoClient. Every key of a model starts with "{prefix}:{modelId}:" and is
+  listed in the model's key set, so deleting a model (or all of them) never
+  needs KEYS or SCAN:
+
+    {prefix}:models                    set of model ids
+    {prefix}:{id}:keys                 set of the model's other keys
+    {prefix}:{id}:snap:{kind}          hash of snapshots by iteration
+    {prefix}:{id}:index[:{kind}]       sorted sets of saved iterations
+    {prefix}:{id}:sizes:{kind}         hash of snapshot sizes by iteration
+    {prefix}:{id}:blobs                hash of config and cache entries
+    {prefix}:{id}:splearn              learn flag per iteration, a byte each
+    {prefix}:{id}:sdr:{field}          hash of SDR log records by iteration
+    {prefix}:{id}:col:{state}:{column}:{segment}
+                                       column history, an iteration each at a
+                                       fixed offset
+    {prefix}:{id}:act:{state}:{index}  sorted set of active iterations
+
+  The writes of one batch(), or of one save outside of a batch, go out as one
+  pipeline. Reads of many iterations, like the deltas or TM steps since a
+  keyframe, SDR ranges and column history, are one round trip each.
+  """
+
+  def __init__(self, url="redis://localhost:6379/0", prefix="htm", **kwargs):
+    """
+    :param url: Redis server to keep history in
+    :param prefix: first part of every key, so several clients (like
+                   frontserver.py's shards) can share a server
+    :param kwargs: as for FileIoClient, except workingDir
+    """
+    self._redis = redis.StrictRedis.from_url(url)
+    self._prefix = prefix
+    # Keys already added to their model's key set by this client.
+    self._registered = set()
+    self._registerLock = threading.Lock()
+    FileIoClient.__init__(self, **kwargs)
+    self._options.pop("workingDir")
+    self._options.update(url=url, prefix=prefix)
+
+
+  def _openStores(self, columnStates):
+    self._columnStore = _RedisColumnStore(self, states=columnStates)
+    self._activityIndex = _RedisActivityIndex(self)
+    self._sdrLog = _RedisSdrLog(self)
+
+
+  def _key(self, id, *parts):
+    checkModelId(id)
+    return ":".join([self._prefix, id] + [str(part) for part in parts])
+
+
+  def _modelsKey(self):
+    return "{}:models".format(self._prefix)
+
+
+  def _connection(self):
+    """
+    :return: the pipeline of the writes being run on this thread, or the
+             client itself outside of them
+    """
+    pipeline = getattr(self._local, "pipeline", None)
+    return self._redis if pipeline is None else pipeline
+
+
+  def _writeKey(self, id, *parts):
+    """
+    :return: a model's key, added to its key set along with every write until
+             one of them has gone through
+    """
+    key = self._key(id, *parts)
+    with self._registerLock:
+      if key in self._registered:
+        return key
+    connection = self._connection()
+    connection.sadd(self._key(id, "keys"), key)
+    connection.sadd(self._modelsKey(), id)
+
+    def register():
+      with self._registerLock:
+        self._registered.add(key)
+
+    self._afterWrite(register)
+    return key
+
+
+  def _afterWrite(self, callback):
+    """
+    Runs callback once the writes issued so far on this thread have gone
+    through: right away outside of a pipeline, else after it is executed.
+    Nothing should be cached as written before then.
+    """
+    callbacks = getattr(self._local, "afterWrite", None)
+    if callbacks is None:
+      callback()
+    else:
+      callbacks.append(callback)
+
+
+  def _runWrites(self, id, writes):
+    pipeline = self._redis.pipeline(transaction=False)
+    self._local.pipeline = pipeline
+    self._local.afterWrite = callbacks = []
+    try:
+      for write in writes:
+        write()
+    finally:
+      self._local.pipeline = None
+      self._local.afterWrite = None
+    with metrics.span("write.redis", id):
+      pipeline.execute()
+    for callback in callbacks:
+      callback()
+
+
+  def _getIndex(self, id):
+    with self._indexLock:
+      if id not in self._indexes:
+        self._indexes[id] = _RedisModelIndex(self, id)
+      return self._indexes[id]
+
+
+  def _ensureModelDir(self, id):
+    # Models are registered by the first key written for them.
+    pass
+
+
+  def _writeBytes(self, id, key, data):
+    self._connection().hset(self._writeKey(id, "blobs"), key, data)
+
+
+  def _readBytes(self, id, key):
+    data = self._redis.hget(self._key(id, "blobs"), key)
+    if data is None:
+      raise IOError("No {} for model {}.".format(key, id))
+    return data
+
+
+  def _deleteBytes(self, id, key):
+    self._redis.hdel(self._key(id, "blobs"), key)
+
+
+  def _exists(self, id, key):
+    return self._redis.hexists(self._key(id, "blobs"), key)
+
+
+  def _writeSnapshot(self, id, template, iteration, data):
+    kind = _kind(template)
+    with metrics.span("write." + kind, id):
+      self._connection().hset(self._writeKey(id, "snap", kind), iteration, data)
+      self._getIndex(id).record(kind, iteration, len(data))
+    metrics.addBytes("written." + kind, len(data), id)
+
+
+  def _readSnapshot(self, id, template, iteration):
+    return self._readSnapshots(id, template, [iteration])[0]
+
+
+  def _readSnapshots(self, id, template, iterations):
+    kind = _kind(template)
+    iterations = list(iterations)
+    if len(iterations) == 0:
+      return []
+    with metrics.span("read." + kind, id):
+      values = self._redis.hmget(self._key(id, "snap", kind), iterations)
+    out = []
+    for iteration, data in zip(iterations, values):
+      if data is None:
+        raise IOError(
+          "No {} snapshot for model {} at iteration {}.".format(
+            kind, id, iteration
+          )
+        )
+      out.append(self._decodeSnapshot(id, kind, data))
+    return out
+
+
+  def _deleteSnapshots(self, id, template, iterations):
+    kind = _kind(template)
+    iterations = list(iterations)
+    with metrics.span("delete." + kind, id):
+      key = self._key(id, "snap", kind)
+      pipeline = self._redis.pipeline(transaction=False)
+      for i in xrange(0, len(iterations), 1024):
+        pipeline.hdel(key, *iterations[i:i + 1024])
+      pipeline.execute()
+      return self._getIndex(id).remove(kind, iterations)
+
+
+  def _writeLearnFlag(self, id, iteration, learn):
+    self._connection().setrange(
+      self._writeKey(id, "splearn"), iteration, "1" if learn else "0"
+    )
+
+
+  def _readLearnFlags(self, id):
+    return self._redis.get(self._key(id, "splearn")) or ""
+
+
+  def listModels(self):
+    return sorted(self._redis.smembers(self._modelsKey()))
+
+
+  def hasModel(self, modelId):
+    checkModelId(modelId)
+    return self._redis.sismember(self._modelsKey(), modelId)
+
+
+  def _deleteModel(self, modelId):
+    keysKey = self._key(modelId, "keys")
+    keys = list(self._redis.smembers(keysKey))
+    pipeline = self._redis.pipeline(transaction=False)
+    for i in xrange(0, len(keys), 1024):
+      pipeline.delete(*keys[i:i + 1024])
+    pipeline.delete(keysKey)
+    pipeline.srem(self._modelsKey(), modelId)
+    pipeline.execute()
+    modelPrefix = self._key(modelId) + ":"
+    with self._registerLock:
+      self._registered = set(
+        key for key in self._registered if not key.startswith(modelPrefix)
+      )
+
+
+  def _deleteAllModels(self):
+    for modelId in self.listModels():
+      self._deleteModel(modelId)
+    with self._registerLock:
+      self._registered = set()
+
+
+
+class _RedisModelIndex(object):
+  """
+  ModelIndex kept in Redis: a sorted set of the iterations saved, overall and
+  per snapshot kind, and a hash of snapshot sizes per kind.
+  """
+
+  def __init__(self, client, modelId):
+    self._client = client
+    self._redis = client._redis
+    self._id = modelId
+
+
+  def record(self, kind, iteration, size):
+    client = self._client
+    connection = client._connection()
+    connection.zadd(client._writeKey(self._id, "index"), iteration, iteration)
+    connection.zadd(
+      client._writeKey(self._id, "index", kind), iteration, iteration
+    )
+    connection.hset(client._writeKey(self._id, "sizes", kind), iteration, size)
+    connection.sadd(client._writeKey(self._id, "kinds"), kind)
+
+
+  def _indexKey(self, kind=None):
+    if kind is None:
+      return self._client._key(self._id, "index")
+    return self._client._key(self._id, "index", kind)
+
+
+  def remove(self, kind, iterations):
+    iterations = list(iterations)
+    if len(iterations) == 0:
+      return 0
+    sizesKey = self._client._key(self._id, "sizes", kind)
+    sizes = self._redis.hmget(sizesKey, iterations)
+    removed = [i for i, size in zip(iterations, sizes) if size is not None]
+    if len(removed) == 0:
+      return 0
+    pipeline = self._redis.pipeline(transaction=False)
+    for i in xrange(0, len(removed), 1024):
+      chunk = removed[i:i + 1024]
+      pipeline.zrem(self._indexKey(kind), *chunk)
+      pipeline.hdel(sizesKey, *chunk)
+    pipeline.execute()
+
+    # Iterations left with no snapshot of any kind leave the overall index.
+    kinds = self._redis.smembers(self._client._key(self._id, "kinds"))
+    pipeline = self._redis.pipeline(transaction=False)
+    for otherKind in kinds:
+      for iteration in removed:
+        pipeline.zscore(self._indexKey(otherKind), iteration)
+    scores = pipeline.execute()
+    orphans = [
+      iteration for position, iteration in enumerate(removed)
+      if all(
+        scores[k * len(removed) + position] is None
+        for k in xrange(len(kinds))
+      )
+    ]
+    if len(orphans) > 0:
+      self._redis.zrem(self._indexKey(), *orphans)
+    return sum(int(size) for size in sizes if size is not None)
+
+
+  def contains(self, kind, iteration):
+    return self._redis.zscore(self._indexKey(kind), iteration) is not None
+
+
+  def containsIteration(self, iteration):
+    return self._redis.zscore(self._indexKey(), iteration) is not None
+
+
+  def getMaxIteration(self, kind=None):
+    last = self._redis.zrevrange(self._indexKey(kind), 0, 0)
+    return int(last[0]) if len(last) > 0 else None
+
+
+  def getIterations(self, kind=None):
+    return [int(i) for i in self._redis.zrange(self._indexKey(kind), 0, -1)]
+
+
+  def getSummary(self):
+    kinds = sorted(self._redis.smembers(self._client._key(self._id, "kinds")))
+    pipeline = self._redis.pipeline(transaction=False)
+    pipeline.zcard(self._indexKey())
+    pipeline.zrange(self._indexKey(), 0, 0)
+    pipeline.zrevrange(self._indexKey(), 0, 0)
+    for kind in kinds:
+      pipeline.hvals(self._client._key(self._id, "sizes", kind))
+    results = pipeline.execute()
+    numIterations, first, last = results[:3]
+    summary = {}
+    for kind, sizes in zip(kinds, results[3:]):
+      summary[kind] = {
+        "count": len(sizes),
+        "bytes": sum(int(size) for size in sizes),
+      }
+    return {
+      "iterations": numIterations,
+      "firstIteration": int(first[0]) if len(first) > 0 else None,
+      "lastIteration": int(last[0]) if len(last) > 0 else None,
+      "kinds": summary,
+      "bytes": sum(kind["bytes"] for kind in summary.itervalues()),
+    }
+
+
+
+class _RedisSdrLog(object):
+  """
+  SdrLog kept in Redis: the same records, in a hash per model and field keyed
+  by iteration. Ranges come back as copies, not views.
+  """
+
+  FIELDS = SdrLog.FIELDS
+
+  def __init__(self, client):
+    self._client = client
+    self._redis = client._redis
+    self._bits = {}
+
+
+  def _getBits(self, modelId, field):
+    if field not in self.FIELDS:
+      raise ValueError("{} cannot be kept in an SDR log.".format(field))
+    key = (modelId, field)
+    if key not in self._bits:
+      bits = self._redis.hget(self._client._key(modelId, "sdrbits"), field)
+      if bits is None:
+        return None
+      self._bits[key] = int(bits)
+    return self._bits[key]
+
+
+  def write(self, modelId, field, iteration, data, bits):
+    client = self._client
+    connection = client._connection()
+    logBits = self._getBits(modelId, field)
+    if logBits is None:
+      connection.hset(client._writeKey(modelId, "sdrbits"), field, bits)
+
+      def cache():
+        self._bits[(modelId, field)] = bits
+
+      client._afterWrite(cache)
+    elif logBits != bits:
+      raise ValueError(
+        "Model {} {} log holds {} bit SDRs, not {}.".format(
+          modelId, field, logBits, bits
+        )
+      )
+    connection.hset(client._writeKey(modelId, "sdr", field), iteration, data)
+
+
+  def getRange(self, modelId, field, start, stop):
+    bits = self._getBits(modelId, field)
+    if bits is None:
+      return np.zeros(0, dtype="uint8"), np.zeros((0, 0), dtype="uint8")
+    key = self._client._key(modelId, "sdr", field)
+    if stop is None:
+      stop = max([int(i) for i in self._redis.hkeys(key)] or [-1]) + 1
+    iterations = range(start, stop)
+    values = self._redis.hmget(key, iterations) if len(iterations) > 0 else []
+    written = [i for i, data in enumerate(values) if data is not None]
+    numRecords = written[-1] + 1 if len(written) > 0 else 0
+    records = np.zeros((numRecords, 1 + (bits + 7) // 8), dtype="uint8")
+    for i in written:
+      records[i] = np.frombuffer(values[i], dtype="uint8")
+    return records[:, 0], records[:, 1:]
+
+
+  def read(self, modelId, field, iteration):
+    bits = self._getBits(modelId, field)
+    if bits is None:
+      return None
+    data = self._redis.hget(self._client._key(modelId, "sdr", field), iteration)
+    if data is None:
+      return None
+    return np.unpackbits(np.frombuffer(data, dtype="uint8", offset=1))[:bits]
+
+
+  def readIndices(self, modelId, field, iteration):
+    bits = self.read(modelId, field, iteration)
+    if bits is None:
+      return None
+    return np.nonzero(bits)[0].astype("uint32")
+
+
+  def contains(self, modelId, field, iteration):
+    return self._redis.hexists(
+      self._client._key(modelId, "sdr", field), iteration
+    )
+
+
+  def forget(self, modelId):
+    for key in self._bits.keys():
+      if key[0] == modelId:
+        del self._bits[key]
+
+
+  def reset(self):
+    self._bits = {}
+
+
+
+class _RedisColumnStore(object):
+  """
+  ColumnStore kept in Redis, laid out column-major like the file store: one
+  string per state, column and segment of iterations, with each iteration's
+  value at a fixed offset in it. Writing an iteration is one script call per
+  state, and reading a column's history is one GETRANGE per segment, which
+  only moves that column's bytes. A bitmap records the iterations written.
+
+  Active columns are a bit per iteration, permanences the column's potential
+  synapses as float32, everything else one number per iteration.
+  """
+
+  STATES = ColumnStore.STATES
+  DEFAULT_STATES = ColumnStore.DEFAULT_STATES
+  _DTYPES = ColumnStore._DTYPES
+
+  # KEYS: model key set
+  # ARGV: column key prefix and suffix, slot in the segment, row of all
+  #       columns' values, then each column's width in bytes, or one width
+  #       for all of them
+  _SET_ROW_SCRIPT = """
+    local row = ARGV[4]
+    local slot = tonumber(ARGV[3])
+    local uniform = #ARGV == 5
+    local width = tonumber(ARGV[5])
+    local numColumns = #ARGV - 4
+    if uniform then
+      numColumns = math.floor(#row / width)
+    end
+    local position = 1
+    for column = 0, numColumns - 1 do
+      if not uniform then
+        width = tonumber(ARGV[5 + column])
+      end
+      if width > 0 then
+        local key = ARGV[1] .. column .. ARGV[2]
+        if redis.call("EXISTS", key) == 0 then
+          redis.call("SADD", KEYS[1], key)
+        end
+        redis.call(
+          "SETRANGE", key, slot * width,
+          string.sub(row, position, position + width - 1)
+        )
+      end
+      position = position + width
+    end
+  """
+
+  # KEYS: model key set
+  # ARGV: column key prefix and suffix, slot in the segment, a byte per
+  #       column, 1 if it is active
+  _SET_BITS_SCRIPT = """
+    local slot = tonumber(ARGV[3])
+    for column = 0, #ARGV[4] - 1 do
+      local key = ARGV[1] .. column .. ARGV[2]
+      if redis.call("EXISTS", key) == 0 then
+        redis.call("SADD", KEYS[1], key)
+      end
+      redis.call("SETBIT", key, slot, string.byte(ARGV[4], column + 1))
+    end
+  """
+
+  def __init__(self, client, states=None, segmentSize=256):
+    if states is None:
+      states = self.DEFAULT_STATES
+    for state in states:
+      if state not in self.STATES:
+        raise ValueError("{} cannot be stored by column.".format(state))
+    if segmentSize % 8 != 0:
+      raise ValueError("Column store segment size must be a multiple of 8.")
+    self._client = client
+    self._redis = client._redis
+    self._states = states
+    self._segmentSize = segmentSize
+    self._metas = {}
+    self._setRow = self._redis.register_script(self._SET_ROW_SCRIPT)
+    self._setBits = self._redis.register_script(self._SET_BITS_SCRIPT)
+
+
+  def getMeta(self, modelId):
+    if modelId not in self._metas:
+      values = self._redis.hgetall(self._client._key(modelId, "colmeta"))
+      if len(values) == 0:
+        return None
+      meta = {
+        "numColumns": int(values["numColumns"]),
+        "numInputs": int(values["numInputs"]),
+        "segmentSize": int(values["segmentSize"]),
+        "states": values["states"].split(","),
+      }
+      for name in ["potentialOffsets", "potentialInputs"]:
+        if name in values:
+          meta[name] = np.frombuffer(values[name], dtype="uint32")
+      self._metas[modelId] = meta
+    return self._metas[modelId]
+
+
+  def _createMeta(self, modelId, numColumns, numInputs, potentialPools):
+    meta = {
+      "numColumns": numColumns,
+      "numInputs": numInputs,
+      "segmentSize": self._segmentSize,
+      "states": list(self._states),
+    }
+    values = {
+      "numColumns": numColumns,
+      "numInputs": numInputs,
+      "segmentSize": self._segmentSize,
+      "states": ",".join(self._states),
+    }
+    if SNAPS.PERMS in self._states:
+      if potentialPools is None:
+        raise ValueError(
+          "Permanences cannot be stored without the potential pools."
+        )
+      offsets, inputs = [
+        np.asarray(array, dtype="uint32") for array in potentialPools
+      ]
+      meta.update(potentialOffsets=offsets, potentialInputs=inputs)
+      values.update(
+        potentialOffsets=offsets.tostring(), potentialInputs=inputs.tostring()
+      )
+    self._client._connection().hmset(
+      self._client._writeKey(modelId, "colmeta"), values
+    )
+
+    def cache():
+      self._metas[modelId] = meta
+
+    self._client._afterWrite(cache)
+    return meta
+
+
+  def reset(self):
+    self._metas = {}
+
+
+  def contains(self, modelId, state):
+    meta = self.getMeta(modelId)
+    if meta is None or state not in meta["states"]:
+      return False
+    return state != SNAPS.PERMS or "potentialOffsets" in meta
+
+
+  def needsPotentialPools(self, modelId):
+    return SNAPS.PERMS in self._states and self.getMeta(modelId) is None
+
+
+  def _columnKey(self, modelId, state, column, segment):
+    return self._client._key(modelId, "col", state, column, segment)
+
+
+  def _width(self, meta, state, column):
+    """
+    :return: bytes one iteration of a column takes, for all but active columns
+    """
+    if state == SNAPS.PERMS:
+      offsets = meta["potentialOffsets"]
+      return int(offsets[column + 1] - offsets[column]) * 4
+    return np.dtype(self._DTYPES[state]).itemsize
+
+
+  def write(self, modelId, iteration, numColumns, numInputs, values,
+            potentialPools=None):
+    if iteration < 0:
+      return
+    meta = self.getMeta(modelId)
+    if meta is None:
+      meta = self._createMeta(
+        modelId, numColumns, numInputs, potentialPools
+      )
+    client = self._client
+    connection = client._connection()
+    keysKey = client._key(modelId, "keys")
+    segment, slot = divmod(iteration, meta["segmentSize"])
+    suffix = ":{}".format(segment)
+    for state in meta["states"]:
+      if state not in values:
+        continue
+      prefix = client._key(modelId, "col", state) + ":"
+      if state == SNAPS.ACT_COL:
+        dense = np.zeros(meta["numColumns"], dtype="uint8")
+        dense[np.asarray(values[state], dtype="uint32")] = 1
+        self._setBits(
+          keys=[keysKey], args=[prefix, suffix, slot, dense.tostring()],
+          client=connection
+        )
+        continue
+      if state == SNAPS.PERMS:
+        row = np.asarray(values[state], dtype="float32")[
+          _potentialColumns(meta), meta["potentialInputs"]
+        ]
+        widths = (np.diff(meta["potentialOffsets"]) * 4).tolist()
+      else:
+        row = np.asarray(values[state], dtype=self._DTYPES[state])
+        widths = [row.itemsize]
+      self._setRow(
+        keys=[keysKey], args=[prefix, suffix, slot, row.tostring()] + widths,
+        client=connection
+      )
+    connection.setbit(client._writeKey(modelId, "colpresent"), iteration, 1)
+
+
+  def dropStates(self, modelId, states, start, stop):
+    """
+    See ColumnStore.dropStates.
+    """
+    meta = self.getMeta(modelId)
+    if meta is None:
+      return 0
+    segmentSize = meta["segmentSize"]
+    keys = [
+      self._columnKey(modelId, state, column, segment)
+      for segment in xrange(start // segmentSize, stop // segmentSize)
+      for state in states
+      for column in xrange(meta["numColumns"])
+    ]
+    if len(keys) == 0:
+      return 0
+    pipeline = self._redis.pipeline(transaction=False)
+    for key in keys:
+      pipeline.strlen(key)
+    dropped = sum(pipeline.execute())
+    keysKey = self._client._key(modelId, "keys")
+    pipeline = self._redis.pipeline(transaction=False)
+    for i in xrange(0, len(keys), 1024):
+      pipeline.delete(*keys[i:i + 1024])
+      pipeline.srem(keysKey, *keys[i:i + 1024])
+    pipeline.execute()
+    return dropped
+
+
+  def _gather(self, modelId, columns, states, iterations):
+    """
+    :return: (present, values, found) for the columns at each iteration.
+             present is 1 where every state was found, values has a matrix
+             per state, in the dtype it is stored as, and found has a mask
+             per state of the rows that are still there.
+    """
+    meta = self.getMeta(modelId)
+    segmentSize = meta["segmentSize"]
+    present = np.zeros(len(iterations), dtype="uint8")
+    values = {}
+    for state in states:
+      shape = (len(iterations), len(columns))
+      if state == SNAPS.PERMS:
+        shape += (meta["numInputs"],)
+      values[state] = np.zeros(shape, dtype=self._DTYPES[state])
+    found = dict(
+      (state, np.zeros(len(iterations), dtype="bool")) for state in states
+    )
+    if len(iterations) == 0:
+      return present, values, found
+
+    # The window of each segment the iterations fall in, as [first, last]
+    # slots in it.
+    segments = iterations // segmentSize
+    windows = []
+    for segment in np.unique(segments):
+      rows = np.nonzero(segments == segment)[0]
+      slots = iterations[rows] - segment * segmentSize
+      windows.append((int(segment), rows, slots, int(slots[0]), int(slots[-1])))
+
+    firstByte = int(iterations.min()) // 8
+    pipeline = self._redis.pipeline(transaction=False)
+    pipeline.getrange(
+      self._client._key(modelId, "colpresent"), firstByte,
+      int(iterations.max()) // 8
+    )
+    reads = []
+    for state in states:
+      for i, column in enumerate(columns):
+        width = 0 if state == SNAPS.ACT_COL else \
+          self._width(meta, state, column)
+        for window in windows:
+          segment, _, _, first, last = window
+          key = self._columnKey(modelId, state, column, segment)
+          if state == SNAPS.ACT_COL:
+            pipeline.getrange(key, first // 8, last // 8)
+          elif width > 0:
+            pipeline.getrange(key, first * width, (last + 1) * width - 1)
+          else:
+            # No potential synapses, so nothing is stored.
+            continue
+          reads.append((state, i, column, width, window))
+    results = pipeline.execute()
+
+    presentBits = np.unpackbits(np.frombuffer(results[0], dtype="uint8"))
+    positions = iterations - firstByte * 8
+    inRange = positions < len(presentBits)
+    written = np.zeros(len(iterations), dtype="bool")
+    written[inRange] = presentBits[positions[inRange]] != 0
+    present[written] = 1
+    for state in states:
+      found[state] = written.copy()
+
+    for (state, i, column, width, window), data in zip(reads, results[1:]):
+      segment, rows, slots, first, last = window
+      if len(data) == 0:
+        # Dropped by dropStates(), or never written.
+        found[state][rows] = False
+        continue
+      if state == SNAPS.ACT_COL:
+        bits = np.unpackbits(np.frombuffer(data, dtype="uint8"))
+        offsets = slots - (first // 8) * 8
+        inData = offsets < len(bits)
+        values[state][rows[inData], i] = bits[offsets[inData]]
+        continue
+      numSlots = last - first + 1
+      data += "\0" * (numSlots * width - len(data))
+      window = np.frombuffer(data, dtype=self._DTYPES[state])
+      window = window.reshape(numSlots, -1)[slots - first]
+      if state == SNAPS.PERMS:
+        offsets = meta["potentialOffsets"]
+        inputs = meta["potentialInputs"][offsets[column]:offsets[column + 1]]
+        values[state][rows[:, None], i, inputs] = window
+      else:
+        values[state][rows, i] = window[:, 0]
+
+    for state in states:
+      values[state][~found[state]] = 0
+      present[~found[state]] = 0
+    return present, values, found
+
+
+  def read(self, modelId, columnIndex, states, start, stop):
+    """
+    See ColumnStore.read.
+    """
+    _, values, found = self._gather(
+      modelId, [columnIndex], states, np.arange(start, stop)
+    )
+    out = {}
+    for state in states:
+      column = values[state][:, 0].tolist()
+      out[state] = [
+        value if isFound else None
+        for value, isFound in zip(column, found[state])
+      ]
+    return out
+
+
+  def readMatrix(self, modelId, columns, states, start, stop, stride=1):
+    """
+    See ColumnStore.readMatrix.
+    """
+    if columns is None:
+      columns = np.arange(self.getMeta(modelId)["numColumns"])
+    columns = np.asarray(columns, dtype="int64")
+    iterations = np.arange(start, stop, stride)
+    present, out, _ = self._gather(modelId, columns, states, iterations)
+    out["iterations"] = iterations
+    out["present"] = present
+    return out
+
+
+
+class _RedisActivityIndex(ActivityIndex):
+  """
+  ActivityIndex kept in Redis: a sorted set of iterations per column or cell,
+  plus a hash of each iteration's active indices, so saving an iteration again
+  replaces it. Nothing is kept in memory.
+  """
+
+  # KEYS: records hash, model key set
+  # ARGV: key of an index's sorted set without the index, iteration, indices
+  _RECORD_SCRIPT = """
+    local old = redis.call("HGET", KEYS[1], ARGV[2])
+    if old then
+      for index in string.gmatch(old, "%d+") do
+        redis.call("ZREM", ARGV[1] .. index, ARGV[2])
+      end
+    end
+    for i = 3, #ARGV do
+      local key = ARGV[1] .. ARGV[i]
+      redis.call("ZADD", key, ARGV[2], ARGV[2])
+      redis.call("SADD", KEYS[2], key)
+    end
+    redis.call("HSET", KEYS[1], ARGV[2], table.concat(ARGV, " ", 3))
+  """
+
+  def __init__(self, client):
+    self._client = client
+    self._redis = client._redis
+    self._record = self._redis.register_script(self._RECORD_SCRIPT)
+
+
+  def _indexKey(self, modelId, state, index=""):
+    return self._client._key(modelId, "act", state, index)
+
+
+  def record(self, modelId, state, iteration, indices):
+    if state not in self.STATES:
+      raise ValueError("{} is not in the activity index.".format(state))
+    client = self._client
+    indices = np.unique(np.asarray(indices, dtype="uint32"))
+    connection = client._connection()
+    self._record(
+      keys=[
+        client._writeKey(modelId, "actrecords", state),
+        client._key(modelId, "keys"),
+      ],
+      args=[self._indexKey(modelId, state), iteration] + indices.tolist(),
+      client=connection
+    )
+    connection.sadd(client._writeKey(modelId, "actstates"), state)
+
+
+  def rebuild(self, modelId, records):
+    client = self._client
+    keysKey = client._key(modelId, "keys")
+    for state in records:
+      recordsKey = client._key(modelId, "actrecords", state)
+      indexPrefix = self._indexKey(modelId, state)
+      keys = [
+        key for key in self._redis.smembers(keysKey)
+        if key.startswith(indexPrefix)
+      ]
+      pipeline = self._redis.pipeline(transaction=False)
+      for i in xrange(0, len(keys), 1024):
+        pipeline.delete(*keys[i:i + 1024])
+        pipeline.srem(keysKey, *keys[i:i + 1024])
+      pipeline.delete(recordsKey)
+      pipeline.execute()
+
+    def write():
+      for state, stateRecords in records.iteritems():
+        for iteration, indices in stateRecords:
+          self.record(modelId, state, iteration, indices)
+
+    client._runWrites(modelId, [write])
+
+
+  def contains(self, modelId, state):
+    return self._redis.sismember(
+      self._client._key(modelId, "actstates"), state
+    )
+
+
+  def _range(self, stop):
+    return "+inf" if stop is None else "({}".format(stop)
+
+
+  def getIterations(self, modelId, state, index, start=0, stop=None):
+    return self._getIterationsOf(modelId, state, [index], start, stop)[0]
+
+
+  def _getIterationsOf(self, modelId, state, indices, start, stop):
+    if state not in self.STATES:
+      raise ValueError("{} is not in the activity index.".format(state))
+    pipeline = self._redis.pipeline(transaction=False)
+    for index in indices:
+      pipeline.zrangebyscore(
+        self._indexKey(modelId, state, index), start, self._range(stop)
+      )
+    return [
+      np.array([int(i) for i in iterations], dtype="uint32")
+      for iterations in pipeline.execute()
+    ]
+
+
+  def forget(self, modelId):
+    pass
+
+
+  def reset(self):
+    pass
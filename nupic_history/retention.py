@@ -0,0 +1,164 @@
+import threading
+import time
+
+
+class RetentionPolicy(object):
+  """
+  How much of a model's history to keep, by age: how many iterations behind
+  the model's latest one an iteration is.
+
+  - Iterations younger than keepLast keep everything.
+  - Older ones keep their SP and TM state only every "every"-th iteration, as
+    keyframes, so each one left still loads directly.
+  - Iterations at least sdrOnlyAfter old keep no SP or TM state at all.
+
+  SDRs (encodings, active columns, active and predictive cells) and the
+  activity index are always kept, for every iteration. They are small, and
+  the SDR logs are fixed-width anyway.
+  """
+
+  def __init__(self, keepLast, every=1, sdrOnlyAfter=None):
+    """
+    :param keepLast: (int) iterations kept at full fidelity, at least 1
+    :param every: (int) keep every this many older iterations' state
+    :param sdrOnlyAfter: (int) age beyond which only SDRs are kept, or None to
+                         keep downsampled state forever. Not below keepLast.
+    """
+    keepLast = int(keepLast)
+    every = int(every)
+    if keepLast < 1:
+      raise ValueError("Retention must keep at least the last iteration.")
+    if every < 1:
+      raise ValueError("Retention downsampling must keep every 1 or more.")
+    if sdrOnlyAfter is not None:
+      sdrOnlyAfter = int(sdrOnlyAfter)
+      if sdrOnlyAfter < keepLast:
+        raise ValueError(
+          "Retention cannot drop state younger than keepLast iterations."
+        )
+    self.keepLast = keepLast
+    self.every = every
+    self.sdrOnlyAfter = sdrOnlyAfter
+
+
+  def toDict(self):
+    return {
+      "keepLast": self.keepLast,
+      "every": self.every,
+      "sdrOnlyAfter": self.sdrOnlyAfter,
+    }
+
+
+  @staticmethod
+  def fromDict(values):
+    return RetentionPolicy(
+      values["keepLast"], every=values.get("every", 1),
+      sdrOnlyAfter=values.get("sdrOnlyAfter")
+    )
+
+
+
+class Compactor(object):
+  """
+  Background thread that applies every model's retention policy, through
+  FileIoClient.compact(), every "interval" seconds. It only ever touches
+  iterations older than the ones being computed, and takes no model cache
+  locks, so compute requests carry on while it runs. History loads of the
+  model being compacted wait for it.
+  """
+
+  def __init__(self, ioClient, interval=60):
+    """
+    :param ioClient: IO client models are saved through
+    :param interval: seconds between compaction runs
+    """
+    self._ioClient = ioClient
+    self._interval = interval
+    self._wake = threading.Event()
+    self._stopped = False
+    self._lock = threading.Lock()
+    self._stats = {
+      "runs": 0,
+      "running": False,
+      "lastRun": None,
+      "lastRunMs": None,
+      "reclaimedBytes": 0,
+      "models": {},
+      "errors": 0,
+      "lastError": None,
+    }
+    self._thread = threading.Thread(target=self._run, name="compactor")
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def _run(self):
+    while not self._stopped:
+      self._wake.wait(self._interval)
+      self._wake.clear()
+      if self._stopped:
+        return
+      self.compactAll()
+
+
+  def compactAll(self):
+    """
+    Compacts every model with a retention policy, on the calling thread.
+    :return: (int) bytes reclaimed
+    """
+    start = time.time()
+    with self._lock:
+      self._stats["running"] = True
+    reclaimed = 0
+    for modelId in self._ioClient.listModels():
+      try:
+        modelReclaimed = self._ioClient.compact(modelId)
+      except Exception as e:
+        # A model deleted mid-run, or history that cannot be loaded. Leave it
+        # for the next run.
+        print "Compacting model {} failed: {}".format(modelId, e)
+        with self._lock:
+          self._stats["errors"] += 1
+          self._stats["lastError"] = "{}: {}".format(modelId, e)
+        continue
+      reclaimed += modelReclaimed
+      if modelReclaimed > 0:
+        with self._lock:
+          models = self._stats["models"]
+          models[modelId] = models.get(modelId, 0) + modelReclaimed
+    with self._lock:
+      self._stats["runs"] += 1
+      self._stats["running"] = False
+      self._stats["lastRun"] = start
+      self._stats["lastRunMs"] = (time.time() - start) * 1000
+      self._stats["reclaimedBytes"] += reclaimed
+    return reclaimed
+
+
+  def runSoon(self):
+    """
+    Starts a compaction run on the background thread now, instead of at the
+    end of the current interval.
+    """
+    self._wake.set()
+
+
+  def forgetModel(self, modelId):
+    with self._lock:
+      self._stats["models"].pop(modelId, None)
+
+
+  def getStats(self):
+    """
+    :return: (dict) runs, duration of the last one, and bytes reclaimed in
+             total and per model
+    """
+    with self._lock:
+      stats = dict(self._stats)
+      stats["models"] = dict(self._stats["models"])
+    return stats
+
+
+  def stop(self):
+    self._stopped = True
+    self._wake.set()
@@ -0,0 +1,228 @@
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+from nupic_history import SpSnapshots as SP_SNAPS
+from nupic_history import TmSnapshots as TM_SNAPS
+
+
+class SdrLog(object):
+  """
+  Append-only logs of fixed-width SDR records, one file per model and field,
+  kept in the model's directory. They replace a tiny file per iteration for
+  each encoding and set of active columns or cells.
+
+  Each file starts with a header (magic, bits per SDR). Then comes one record
+  per iteration, at a fixed offset: a byte that is 1 if the iteration was
+  written, then the SDR's bits packed 8 to a byte (np.packbits order).
+  Iterations never written read as absent.
+
+  Files are read through mmap, so one iteration, or a range of them, is a
+  zero-copy NumPy view of the packed records.
+  """
+
+  # File names.
+  LOG = "htm_sdrlog_{}_{}.npc"  # modelId, field
+
+  FIELDS = [
+    SP_SNAPS.INPUT,
+    SP_SNAPS.ACT_COL,
+    TM_SNAPS.ACT_CELLS,
+    TM_SNAPS.PRD_CELLS,
+  ]
+
+  MAGIC = "NHSL"
+  _HEADER = struct.Struct("<4sI")
+
+  def __init__(self, workingDir):
+    """
+    :param workingDir: directory model directories are in
+    """
+    self._workingDir = workingDir
+    self._lock = threading.Lock()
+    self._logs = {}
+
+
+  def _path(self, modelId, field):
+    return os.path.join(
+      self._workingDir, modelId, self.LOG.format(modelId, field)
+    )
+
+
+  def _get(self, modelId, field, bits=None):
+    """
+    :param bits: SDR width, to create the log if it does not exist
+    :return: (_Log) or None if there is no log and no width to create it with
+    """
+    if field not in self.FIELDS:
+      raise ValueError("{} cannot be kept in an SDR log.".format(field))
+    key = (modelId, field)
+    log = self._logs.get(key)
+    if log is not None:
+      return log
+    path = self._path(modelId, field)
+    if os.path.exists(path):
+      with open(path, "rb") as f:
+        magic, logBits = self._HEADER.unpack(f.read(self._HEADER.size))
+      if magic != self.MAGIC:
+        raise ValueError("{} is not an SDR log.".format(path))
+    elif bits is not None:
+      logBits = bits
+      with open(path, "wb") as f:
+        f.write(self._HEADER.pack(self.MAGIC, logBits))
+    else:
+      return None
+    log = self._logs[key] = _Log(path, logBits, self._HEADER.size)
+    return log
+
+
+  def write(self, modelId, field, iteration, data, bits):
+    """
+    Writes one iteration's record, appending to the log or replacing the
+    record if the iteration was written before.
+    :param data: record from packSdr() or packIndices()
+    :param bits: SDR width
+    """
+    with self._lock:
+      log = self._get(modelId, field, bits)
+      if log.bits != bits:
+        raise ValueError(
+          "Model {} {} log holds {} bit SDRs, not {}.".format(
+            modelId, field, log.bits, bits
+          )
+        )
+      log.write(iteration, data)
+
+
+  def getRange(self, modelId, field, start, stop):
+    """
+    :return: (present, packed) zero-copy views of iterations [start, stop),
+             cut short at the last one written: present has a 1 for each
+             iteration that was written, packed has its bits. Both are empty
+             if there is no log.
+    """
+    with self._lock:
+      log = self._get(modelId, field)
+      if log is None:
+        return np.zeros(0, dtype="uint8"), np.zeros((0, 0), dtype="uint8")
+      records = log.view(stop)
+    records = records[min(start, len(records)):stop]
+    return records[:, 0], records[:, 1:]
+
+
+  def read(self, modelId, field, iteration):
+    """
+    :return: (numpy.ndarray) one iteration's SDR, uint8 bits, or None if it
+             was never written
+    """
+    present, packed = self.getRange(modelId, field, iteration, iteration + 1)
+    if len(present) == 0 or present[0] == 0:
+      return None
+    with self._lock:
+      bits = self._logs[(modelId, field)].bits
+    return np.unpackbits(packed[0])[:bits]
+
+
+  def readIndices(self, modelId, field, iteration):
+    """
+    :return: (numpy.ndarray) one iteration's on-bit indices, uint32, or None
+    """
+    bits = self.read(modelId, field, iteration)
+    if bits is None:
+      return None
+    return np.nonzero(bits)[0].astype("uint32")
+
+
+  def contains(self, modelId, field, iteration):
+    present, _ = self.getRange(modelId, field, iteration, iteration + 1)
+    return len(present) > 0 and present[0] == 1
+
+
+  def forget(self, modelId):
+    """
+    Closes a model's logs, before its directory is deleted.
+    """
+    with self._lock:
+      for key in self._logs.keys():
+        if key[0] == modelId:
+          self._logs.pop(key).close()
+
+
+  def reset(self):
+    with self._lock:
+      for log in self._logs.values():
+        log.close()
+      self._logs = {}
+
+
+
+class _Log(object):
+  """
+  One open SDR log file: an unbuffered handle for writes, and a read-only map
+  that is replaced by a bigger one when records are read past its end.
+  """
+
+  def __init__(self, path, bits, headerSize):
+    self.path = path
+    self.bits = bits
+    self.recordSize = 1 + (bits + 7) // 8
+    self._headerSize = headerSize
+    self._file = None
+    self._records = np.zeros((0, self.recordSize), dtype="uint8")
+
+
+  def write(self, iteration, data):
+    if self._file is None:
+      self._file = open(self.path, "r+b", 0)
+    self._file.seek(self._headerSize + iteration * self.recordSize)
+    self._file.write(data)
+
+
+  def view(self, stop):
+    """
+    :return: records as a (numRecords, recordSize) view of the file, mapped
+             again if it has grown and stop is past the old end
+    """
+    if stop is None or stop > len(self._records):
+      size = os.path.getsize(self.path)
+      numRecords = (size - self._headerSize) // self.recordSize
+      if numRecords > len(self._records):
+        with open(self.path, "rb") as f:
+          mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Views handed out earlier keep the old map alive until they are
+        # dropped, so it is never closed here.
+        self._records = np.frombuffer(
+          mapped, dtype="uint8", count=numRecords * self.recordSize,
+          offset=self._headerSize
+        ).reshape(numRecords, self.recordSize)
+    return self._records
+
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+
+
+def packSdr(sdr):
+  """
+  :param sdr: dense SDR, 1s and 0s
+  :return: (str) log record for it
+  """
+  bits = np.asarray(sdr) != 0
+  return "\x01" + np.packbits(bits).tostring()
+
+
+def packIndices(indices, bits):
+  """
+  :param indices: on-bit indices of an SDR
+  :param bits: SDR width
+  :return: (str) log record for it
+  """
+  dense = np.zeros(bits, dtype="bool")
+  dense[np.asarray(indices, dtype="uint32")] = True
+  return packSdr(dense)
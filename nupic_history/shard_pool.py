@@ -0,0 +1,250 @@
+import httplib
+import os
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+import ujson as json
+
+
+# Environment variables workers are configured through.
+WORKING_DIR_ENV = "NUPIC_HISTORY_WORKING_DIR"
+SHARD_ENV = "NUPIC_HISTORY_SHARD"
+
+
+def shardFor(modelId, numShards):
+  """
+  Stable across processes and restarts, unlike hash().
+  :return: index of the shard that owns a model
+  """
+  return (zlib.crc32(modelId) & 0xffffffff) % numShards
+
+
+
+class ShardPool(object):
+  """
+  Runs N webserver worker processes on consecutive ports and forwards requests
+  to them. Each worker has its own model cache, and its own FileIoClient
+  directory under the working directory, so every model lives in exactly one
+  worker: the one shardFor() picks for its id.
+  """
+
+  def __init__(self, numShards, basePort=8100, workingDir="./working",
+               script="webserver.py", timeout=60):
+    """
+    :param numShards: number of worker processes
+    :param basePort: port of the first worker, the others follow it
+    :param workingDir: directory the workers' directories are created in
+    :param script: web server script each worker runs
+    :param timeout: seconds to wait on a worker before giving up
+    """
+    if numShards < 1:
+      raise ValueError("Shard pool needs at least one shard.")
+    self._numShards = numShards
+    self._basePort = basePort
+    self._workingDir = workingDir
+    self._script = script
+    self._timeout = timeout
+    self._processes = [None] * numShards
+    self._lock = threading.Lock()
+    self._stats = [
+      {
+        "requests": 0,
+        "inFlight": 0,
+        "errors": 0,
+        "totalMs": 0.0,
+        "maxMs": 0.0,
+        "lastError": None,
+        "restarts": 0,
+      }
+      for _ in xrange(numShards)
+    ]
+
+
+  def getNumShards(self):
+    return self._numShards
+
+
+  def getPort(self, shard):
+    return self._basePort + shard
+
+
+  def getShardDir(self, shard):
+    return os.path.join(self._workingDir, "shard-{}".format(shard))
+
+
+  def shardFor(self, modelId):
+    return shardFor(modelId, self._numShards)
+
+
+  def start(self):
+    """
+    Starts every worker that is not running.
+    """
+    for shard in xrange(self._numShards):
+      process = self._processes[shard]
+      if process is not None and process.poll() is None:
+        continue
+      if process is not None:
+        self._stats[shard]["restarts"] += 1
+      shardDir = self.getShardDir(shard)
+      if not os.path.isdir(shardDir):
+        os.makedirs(shardDir)
+      env = dict(os.environ)
+      env[WORKING_DIR_ENV] = shardDir
+      env[SHARD_ENV] = str(shard)
+      self._processes[shard] = subprocess.Popen(
+        [sys.executable, self._script, str(self.getPort(shard))], env=env
+      )
+      print "Started shard {} on port {} (pid {})".format(
+        shard, self.getPort(shard), self._processes[shard].pid
+      )
+
+
+  def stop(self):
+    for process in self._processes:
+      if process is not None and process.poll() is None:
+        process.terminate()
+    for process in self._processes:
+      if process is not None:
+        process.wait()
+
+
+  def forward(self, shard, method, path, body=None, headers=None,
+              stream=False):
+    """
+    Sends one request to a worker.
+    :param path: path plus query string
+    :param stream: if true, the body comes back as a generator of chunks
+    :return: (status line, headers as (name, value) pairs, body)
+    """
+    with self._lock:
+      self._stats[shard]["inFlight"] += 1
+    start = time.time()
+    error = None
+    streaming = False
+    try:
+      connection = httplib.HTTPConnection(
+        "localhost", self.getPort(shard), timeout=self._timeout
+      )
+      connection.request(method, path, body, headers or {})
+      response = connection.getresponse()
+      status = "{} {}".format(response.status, response.reason)
+      responseHeaders = [
+        (name, value) for name, value in response.getheaders()
+        if name.lower() not in ["content-length", "transfer-encoding",
+                                "connection", "date", "server"]
+      ]
+      if stream:
+        connection.sock.settimeout(None)
+        streaming = True
+        return status, responseHeaders, self._stream(
+          connection, response, shard, start
+        )
+      responseBody = response.read()
+      connection.close()
+      return status, responseHeaders, responseBody
+    except Exception as e:
+      error = e
+      raise
+    finally:
+      if not streaming:
+        self._record(shard, start, error)
+
+
+  def _stream(self, connection, response, shard, start):
+    # Chunks are passed on whole, as the worker sent them (one per event), so
+    # events go out as soon as they arrive rather than when a buffer fills
+    # up. httplib's own read() waits for as many bytes as it is asked for.
+    # The request is only recorded as done once the stream ends.
+    fp = response.fp
+    error = None
+    try:
+      if not response.chunked:
+        for line in iter(fp.readline, ""):
+          yield line
+        return
+      while True:
+        size = int(fp.readline().split(";")[0], 16)
+        if size == 0:
+          return
+        chunk = fp.read(size)
+        # The line break after the chunk.
+        fp.readline()
+        yield chunk
+    except Exception as e:
+      error = e
+      raise
+    finally:
+      connection.close()
+      self._record(shard, start, error)
+
+
+  def _record(self, shard, start, error):
+    elapsedMs = (time.time() - start) * 1000
+    with self._lock:
+      stats = self._stats[shard]
+      stats["inFlight"] -= 1
+      stats["requests"] += 1
+      stats["totalMs"] += elapsedMs
+      stats["maxMs"] = max(stats["maxMs"], elapsedMs)
+      if error is not None:
+        stats["errors"] += 1
+        stats["lastError"] = str(error)
+
+
+  def broadcast(self, method, path, body=None, headers=None):
+    """
+    Sends the same request to every worker.
+    :return: one (status, headers, body) per shard, or the error raised
+    """
+    out = []
+    for shard in xrange(self._numShards):
+      try:
+        out.append(self.forward(shard, method, path, body, headers))
+      except Exception as e:
+        out.append(e)
+    return out
+
+
+  def getHealth(self):
+    """
+    :return: (list) per shard: port, directory, whether its process is alive,
+             front-side request counters and latency, and the worker's own
+             cache and write queue stats if it answers
+    """
+    out = []
+    for shard in xrange(self._numShards):
+      process = self._processes[shard]
+      with self._lock:
+        health = dict(self._stats[shard])
+      health["shard"] = shard
+      health["port"] = self.getPort(shard)
+      health["workingDir"] = self.getShardDir(shard)
+      health["pid"] = process.pid if process is not None else None
+      health["alive"] = process is not None and process.poll() is None
+      health["meanMs"] = health["totalMs"] / max(health["requests"], 1)
+      health["cache"] = None
+      health["writes"] = None
+      if health["alive"]:
+        try:
+          health["cache"] = self._getJson(shard, "/_cache/")
+          health["writes"] = self._getJson(shard, "/_writes/")
+        except Exception as e:
+          health["lastError"] = str(e)
+      out.append(health)
+    return out
+
+
+  def _getJson(self, shard, path):
+    # Health checks use a short timeout, and are not counted as requests.
+    connection = httplib.HTTPConnection(
+      "localhost", self.getPort(shard), timeout=2
+    )
+    try:
+      connection.request("GET", path)
+      return json.loads(connection.getresponse().read())
+    finally:
+      connection.close()
@@ -0,0 +1,154 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SnapshotCache(object):
+  """
+  Snapshots shared by every facade on the same IO client, so a snapshot built
+  once for one request is there for the next, and for facades built for
+  history lookups that are thrown away after one use.
+
+  Snapshots of an iteration are keyed by (model id, iteration, snapshot name)
+  and evicted least recently used first, once their estimated size goes over
+  maxBytes. Static snapshots (potential pools, inhibition masks, params) are
+  pinned per model instead: they are kept until the model is forgotten, and
+  do not count against maxBytes. A pin can carry a version, like the
+  inhibition radius masks were built for, and is only returned for the same
+  version.
+  """
+
+  def __init__(self, maxBytes=64 * 1024 * 1024):
+    """
+    :param maxBytes: max estimated bytes of iteration snapshots kept
+    """
+    self._maxBytes = maxBytes
+    self._entries = OrderedDict()
+    self._sizes = {}
+    self._bytes = 0
+    self._pinned = {}
+    self._lock = threading.Lock()
+    self._stats = {
+      "hits": 0,
+      "misses": 0,
+      "evictions": 0,
+    }
+
+
+  def get(self, modelId, iteration, name):
+    """
+    :return: the cached snapshot, or None
+    """
+    key = (modelId, iteration, name)
+    with self._lock:
+      value = self._entries.pop(key, None)
+      if value is None:
+        self._stats["misses"] += 1
+        return None
+      self._entries[key] = value
+      self._stats["hits"] += 1
+      return value
+
+
+  def put(self, modelId, iteration, name, value):
+    key = (modelId, iteration, name)
+    size = estimateBytes(value)
+    if size > self._maxBytes:
+      return
+    with self._lock:
+      if key in self._entries:
+        del self._entries[key]
+        self._bytes -= self._sizes.pop(key)
+      self._entries[key] = value
+      self._sizes[key] = size
+      self._bytes += size
+      while self._bytes > self._maxBytes:
+        oldest, _ = self._entries.popitem(last=False)
+        self._bytes -= self._sizes.pop(oldest)
+        self._stats["evictions"] += 1
+
+
+  def getPinned(self, modelId, name, version=None):
+    """
+    :return: the pinned snapshot if it was pinned with this version, or None
+    """
+    with self._lock:
+      pinned = self._pinned.get((modelId, name))
+    if pinned is None or pinned[0] != version:
+      return None
+    return pinned[1]
+
+
+  def pin(self, modelId, name, value, version=None):
+    with self._lock:
+      self._pinned[(modelId, name)] = (version, value)
+
+
+  def forget(self, modelId, names=None):
+    """
+    Drops a model's snapshots, pinned ones included.
+    :param names: only drop these snapshots, default all of them
+    """
+    with self._lock:
+      for key in self._entries.keys():
+        if key[0] == modelId and (names is None or key[2] in names):
+          del self._entries[key]
+          self._bytes -= self._sizes.pop(key)
+      for key in self._pinned.keys():
+        if key[0] == modelId and (names is None or key[1] in names):
+          del self._pinned[key]
+
+
+  def discard(self, modelId, iteration, names=None):
+    """
+    Drops a model's snapshots of one iteration.
+    :param names: only drop these snapshots, default all of them
+    """
+    with self._lock:
+      for key in self._entries.keys():
+        if key[:2] == (modelId, iteration) \
+            and (names is None or key[2] in names):
+          del self._entries[key]
+          self._bytes -= self._sizes.pop(key)
+
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._sizes.clear()
+      self._bytes = 0
+      self._pinned.clear()
+
+
+  def getStats(self):
+    """
+    :return: (dict) hit, miss and eviction counters, plus current size
+    """
+    with self._lock:
+      stats = dict(self._stats)
+      stats["snapshots"] = len(self._entries)
+      stats["bytes"] = self._bytes
+      stats["pinned"] = len(self._pinned)
+      pinned = self._pinned.values()
+    stats["pinnedBytes"] = sum(estimateBytes(value) for _, value in pinned)
+    stats["maxBytes"] = self._maxBytes
+    return stats
+
+
+
+def estimateBytes(value):
+  """
+  Rough in-memory size of a snapshot: exact for NumPy arrays, estimated for
+  lists and dicts of them.
+  """
+  if isinstance(value, np.ndarray):
+    return value.nbytes
+  elif isinstance(value, dict):
+    return sum(estimateBytes(item) for item in value.itervalues())
+  elif isinstance(value, (list, tuple)):
+    if len(value) > 0 and isinstance(value[0], (list, tuple, dict, np.ndarray)):
+      return sum(estimateBytes(item) for item in value)
+    # A pointer plus a boxed number per item.
+    return 32 * len(value)
+  return 32
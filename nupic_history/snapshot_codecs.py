@@ -0,0 +1,330 @@
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from nupic_history import wire
+
+try:
+  import lz4.frame
+except ImportError:
+  lz4 = None
+
+
+# Every encoded file starts with MAGIC, one byte giving the length of the codec
+# name, and the codec name itself. Files without it were written before codecs
+# existed, and are read with whichever legacy codec the caller says.
+MAGIC = "NHC\x01"
+
+_codecs = {}
+
+
+class Codec(object):
+  """
+  Turns one kind of snapshot into bytes and back. Subclasses set a unique name,
+  which is what file headers record.
+  """
+
+  name = None
+
+  def accepts(self, obj):
+    """
+    :return: whether this codec can encode obj losslessly
+    """
+    return True
+
+
+  def encode(self, obj):
+    """
+    :return: (bytes, size of obj before encoding)
+    """
+    raise NotImplementedError()
+
+
+  def decode(self, data):
+    raise NotImplementedError()
+
+
+
+class PickleCodec(Codec):
+
+  name = "pickle"
+
+  def encode(self, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return data, len(data)
+
+
+  def decode(self, data):
+    return pickle.loads(data)
+
+
+
+class ZlibCodec(Codec):
+  """
+  Compresses the output of another codec. Meant for permanence data.
+  """
+
+  def __init__(self, inner, level=1):
+    self._inner = inner
+    self._level = level
+    self.name = "zlib-" + inner.name
+
+
+  def accepts(self, obj):
+    return self._inner.accepts(obj)
+
+
+  def encode(self, obj):
+    data, rawSize = self._inner.encode(obj)
+    return zlib.compress(data, self._level), rawSize
+
+
+  def decode(self, data):
+    return self._inner.decode(zlib.decompress(data))
+
+
+
+class Lz4Codec(Codec):
+  """
+  Like ZlibCodec, but faster and compressing less. Needs the lz4 package.
+  """
+
+  def __init__(self, inner):
+    self._inner = inner
+    self.name = "lz4-" + inner.name
+
+
+  def accepts(self, obj):
+    return self._inner.accepts(obj)
+
+
+  def encode(self, obj):
+    data, rawSize = self._inner.encode(obj)
+    return lz4.frame.compress(data), rawSize
+
+
+  def decode(self, data):
+    return self._inner.decode(lz4.frame.decompress(data))
+
+
+
+class SdrCodec(Codec):
+  """
+  Stores a dense binary array as its length and the indices of its on bits,
+  as uint16 when they fit and uint32 otherwise. Decodes to a dense uint32
+  array, which is what SDR snapshots are saved as.
+  """
+
+  name = "sdr"
+
+  def accepts(self, obj):
+    array = np.asarray(obj)
+    return array.ndim == 1 and np.all((array == 0) | (array == 1))
+
+
+  def encode(self, obj):
+    array = np.asarray(obj)
+    indices = np.nonzero(array)[0]
+    dtype = "<u2" if len(array) <= 0x10000 else "<u4"
+    header = struct.pack("<IB", len(array), np.dtype(dtype).itemsize)
+    return header + indices.astype(dtype).tobytes(), array.nbytes
+
+
+  def decode(self, data):
+    length, width = struct.unpack_from("<IB", data)
+    dtype = "<u2" if width == 2 else "<u4"
+    out = np.zeros(length, dtype="uint32")
+    out[np.frombuffer(data, dtype=dtype, offset=5)] = 1
+    return out
+
+
+
+class MsgpackCodec(Codec):
+  """
+  Msgpack with NumPy arrays as typed arrays (see wire.py). Meant for small
+  per-iteration records of sparse indices and flags.
+  """
+
+  name = "msgpack"
+
+  def encode(self, obj):
+    data = wire.encode(obj, wire.MSGPACK)
+    return data, len(data)
+
+
+  def decode(self, data):
+    return wire.decode(data, wire.MSGPACK)
+
+
+
+class CapnpCodec(Codec):
+  """
+  Writes a capnp message builder, packed or not, and reads it back as a reader
+  of the given schema.
+  """
+
+  def __init__(self, name, schema, packed=True):
+    self.name = name
+    self._schema = schema
+    self._packed = packed
+
+
+  def encode(self, proto):
+    try:
+      rawSize = proto.total_size.word_count * 8
+    except AttributeError:
+      rawSize = None
+    if self._packed:
+      data = proto.to_bytes_packed()
+    else:
+      data = proto.to_bytes()
+    if rawSize is None:
+      rawSize = len(data)
+    return data, rawSize
+
+
+  def decode(self, data):
+    if self._packed:
+      return self._schema.from_bytes_packed(data)
+    return self._schema.from_bytes(data)
+
+
+
+def registerCodec(codec):
+  """
+  Makes a codec available for writing, and for reading files that name it.
+  """
+  _codecs[codec.name] = codec
+
+
+def getCodec(name):
+  if name not in _codecs:
+    raise ValueError("Unknown snapshot codec: {}".format(name))
+  return _codecs[name]
+
+
+def pack(codec, obj):
+  """
+  :return: (header + encoded obj, size of obj before encoding)
+  """
+  payload, rawSize = codec.encode(obj)
+  header = MAGIC + chr(len(codec.name)) + codec.name
+  return header + payload, rawSize
+
+
+def readCodecName(data):
+  """
+  :return: name of the codec that wrote data, or None if it has no header
+  """
+  if not data.startswith(MAGIC):
+    return None
+  nameLength = ord(data[len(MAGIC)])
+  start = len(MAGIC) + 1
+  return data[start:start + nameLength]
+
+
+def unpack(data, legacy):
+  """
+  :param legacy: codec to read data with if it has no header
+  """
+  name = readCodecName(data)
+  if name is None:
+    return legacy.decode(data)
+  start = len(MAGIC) + 1 + len(name)
+  return getCodec(name).decode(data[start:])
+
+
+registerCodec(PickleCodec())
+registerCodec(ZlibCodec(PickleCodec()))
+registerCodec(SdrCodec())
+registerCodec(MsgpackCodec())
+if lz4 is not None:
+  registerCodec(Lz4Codec(PickleCodec()))
+
+
+
+class CodecStats(object):
+  """
+  Thread-safe counters of bytes in and out, and time spent, per snapshot kind.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._kinds = {}
+
+
+  def _get(self, kind, codecName):
+    if kind not in self._kinds:
+      self._kinds[kind] = {
+        "codec": codecName,
+        "encodes": 0,
+        "rawBytes": 0,
+        "encodedBytes": 0,
+        "encodeMs": 0.0,
+        "decodes": 0,
+        "decodeMs": 0.0,
+      }
+    return self._kinds[kind]
+
+
+  def recordEncode(self, kind, codecName, rawSize, encodedSize, seconds):
+    with self._lock:
+      stats = self._get(kind, codecName)
+      stats["codec"] = codecName
+      stats["encodes"] += 1
+      stats["rawBytes"] += rawSize
+      stats["encodedBytes"] += encodedSize
+      stats["encodeMs"] += seconds * 1000
+
+
+  def recordDecode(self, kind, codecName, seconds):
+    with self._lock:
+      stats = self._get(kind, codecName)
+      stats["decodes"] += 1
+      stats["decodeMs"] += seconds * 1000
+
+
+  def getStats(self):
+    """
+    :return: (dict) per snapshot kind: codec, compression ratio (raw bytes over
+             encoded bytes) and mean encode and decode time in ms
+    """
+    out = {}
+    with self._lock:
+      for kind, stats in self._kinds.iteritems():
+        stats = dict(stats)
+        stats["ratio"] = float(stats["rawBytes"]) \
+          / max(stats["encodedBytes"], 1)
+        stats["meanEncodeMs"] = stats["encodeMs"] / max(stats["encodes"], 1)
+        stats["meanDecodeMs"] = stats["decodeMs"] / max(stats["decodes"], 1)
+        out[kind] = stats
+    return out
+
+
+def timedPack(stats, kind, codec, obj):
+  """
+  Like pack(), but falls back to pickle if codec cannot take obj, and records
+  the encode in stats.
+  """
+  if not codec.accepts(obj):
+    codec = getCodec(PickleCodec.name)
+  start = time.time()
+  data, rawSize = pack(codec, obj)
+  stats.recordEncode(kind, codec.name, rawSize, len(data), time.time() - start)
+  return data
+
+
+def timedUnpack(stats, kind, data, legacy):
+  """
+  Like unpack(), recording the decode in stats.
+  """
+  start = time.time()
+  obj = unpack(data, legacy)
+  stats.recordDecode(
+    kind, readCodecName(data) or legacy.name, time.time() - start
+  )
+  return obj
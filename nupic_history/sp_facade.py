@@ -1,17 +1,27 @@
 import uuid
-import multiprocessing
-import time
 
 import numpy as np
 
 from nupic_history import SpSnapshots as SNAPS
-from nupic_history.utils import compressSdr
-from nupic.math import topology
+from nupic_history.io_client import checkModelId
+from nupic_history.metrics import metrics
+from nupic_history.utils import (
+  compressSdr, getNeighborhoodCsr, getPermanenceMatrix, getPotentialMatrix,
+  nonzeroByRow
+)
+
+# Same tolerance the SP uses when deciding whether a synapse is connected.
+PERMANENCE_EPSILON = 0.000001
+
+# Snapshots that never change for a model, pinned in the snapshot cache.
+STATIC_SNAPSHOTS = [SNAPS.POT_POOLS, SNAPS.INH_MASKS]
+# Name the SP params are pinned under.
+PARAMS = "spParams"
 
 
 class SpFacade(object):
 
-  def __init__(self, sp, ioClient, iteration=None):
+  def __init__(self, sp, ioClient, iteration=None, modelId=None):
     """
     A wrapper around the HTM Spatial Pooler that can save SP state to Redis for
     each compute cycle. Adds a "save=" kwarg to compute().
@@ -19,25 +29,34 @@ class SpFacade(object):
     :param sp: Either an instance of Spatial Pooler or a string model id
     :param ioClient: Instantiated IO client
     :param iteration: what iteration to resurrect the SP at
+    :param modelId: id for a new SP, instead of a generated one. Letters,
+                    digits, "_" and "-" only.
     """
     self._ioClient = ioClient
+    self._snapshotCache = ioClient.getSnapshotCache()
     if isinstance(sp, basestring):
       # Loading SP by id from IO.
       self._id = sp
       # Get the latest by default.
       if iteration is None:
-        iteration = ioClient.getMaxIteration(self._id)
+        iteration = ioClient.getMaxIteration(self._id, kind="spac")
       self._iteration = iteration
     else:
       # New facade using given fresh SP.
       self._sp = sp
-      self._id = str(uuid.uuid4()).split('-')[0]
+      if modelId is None:
+        modelId = str(uuid.uuid4()).split('-')[0]
+      checkModelId(modelId)
+      self._id = modelId
+      # Nothing cached under this id can be about this new SP.
+      self._snapshotCache.forget(modelId)
       self._input = self._getZeroedInput()
       self._activeColumns = self._getZeroedColumns()
       self._iteration = sp.getIterationNum()
+    self._learn = True
     self._state = None
-    self._potentialPools = None
-    self._inhibitionMasks = None
+    # (iteration, permanence matrix) shared by all snapshots derived from it.
+    self._permanences = None
 
 
   def __str__(self):
@@ -50,12 +69,19 @@ class SpFacade(object):
     ioClient = self._ioClient
     id = self.getId()
     iteration = self.getIteration()
-    ioClient.saveEncoding(self._input, id, iteration)
-    ioClient.saveActiveColumns(self._activeColumns, id, iteration)
-    ioClient.saveSpatialPooler(self._sp, id, iteration)
+    with ioClient.batch():
+      ioClient.saveEncoding(self._input, id, iteration)
+      ioClient.saveActiveColumns(self._activeColumns, id, iteration)
+      ioClient.saveSpatialPooler(self._sp, id, iteration, learn=self._learn)
+      ioClient.saveColumnHistory(self._sp, self._activeColumns, id, iteration)
 
 
   def load(self):
+    """
+    Restores the SP at this facade's iteration. Depending on the model's
+    history mode, the IO client may rebuild it from a keyframe plus deltas, or
+    by replaying saved encodings from the last keyframe.
+    """
     ioClient = self._ioClient
     id = self.getId()
     iteration = self.getIteration()
@@ -63,6 +89,7 @@ class SpFacade(object):
     self._sp = ioClient.loadSpatialPooler(
       id, iteration=iteration
     )
+    self._permanences = None
     if iteration == 0:
       self._input = self._getZeroedInput()
       print "loading zeroed AC"
@@ -104,6 +131,9 @@ class SpFacade(object):
     Utility to collect the SP params used at creation into a dict.
     :return: [dict] parameters
     """
+    params = self._snapshotCache.getPinned(self._id, PARAMS)
+    if params is not None:
+      return params
     sp = self._sp
     if sp is None:
       params =self._ioClient.getSpParams(self.getId())
@@ -124,34 +154,33 @@ class SpFacade(object):
         "dutyCyclePeriod": sp.getDutyCyclePeriod(),
         "boostStrength": sp.getBoostStrength(),
       }
+    self._snapshotCache.pin(self._id, PARAMS, params)
     return params
 
 
-  def compute(self, encoding, learn=False, save=False, multiprocess=False):
+  def compute(self, encoding, learn=False, save=False):
     """
     Pass-through to Spatial Pooler's compute() function, with the addition of
-    the save option.
+    the save option. If the IO client has a write queue, saving only costs the
+    serialization here and the disk writes happen behind it.
     :param encoding: encoding to pass to the sp
     :param learn: whether sp will learn on this compute cycle
+    :param save: whether to save this cycle's state through the IO client
     """
     sp = self._sp
     columns = self._getZeroedColumns()
     encoding = np.asarray(encoding, dtype="uint32")
 
-    start = time.time()
-    sp.compute(encoding, learn, columns)
-    end = time.time()
-    print("\tSP compute took %g seconds" % (end - start))
+    with metrics.span("sp.compute", self._id):
+      sp.compute(encoding, learn, columns)
 
     self._input = encoding
     self._activeColumns = columns
+    self._learn = learn
     self._state = None
+    self._permanences = None
     if save:
-      if multiprocess:
-        p = multiprocessing.Process(target=self.save)
-        p.start()
-      else:
-        self.save()
+      self.save()
 
 
   def getState(self, *args, **kwargs):
@@ -231,19 +260,33 @@ class SpFacade(object):
     return np.asarray(zeros, dtype=dtype)
 
 
+  def _getPermanenceMatrix(self):
+    # Extracted once per iteration, no matter how many snapshots need it.
+    iteration = self.getIteration()
+    if self._permanences is None or self._permanences[0] != iteration:
+      self._permanences = (iteration, getPermanenceMatrix(self._sp))
+    return self._permanences[1]
+
+
   def _getSnapshot(self, name, iteration=None, columnIndex=None):
     # Use the cache if we can.
     if name in self._state and iteration == self._iteration:
       return self._state[name]
-    else:
+    # Then the snapshot cache shared with other facades. Static snapshots are
+    # pinned there by their conjure functions.
+    cacheable = name not in STATIC_SNAPSHOTS and iteration is not None
+    result = None
+    if cacheable:
+      result = self._snapshotCache.get(self._id, iteration, name)
+    if result is None:
       funcName = "_conjure{}".format(name[:1].upper() + name[1:])
       func = getattr(self, funcName)
-      _start = time.time()
-      result = func(iteration=iteration, columnIndex=columnIndex)
-      _end = time.time()
-      print "\t\t{}: {} seconds".format(funcName, (_end - _start))
-      self._state[name] = result
-      return result
+      with metrics.span("sp.conjure." + name, self._id):
+        result = func(iteration=iteration, columnIndex=columnIndex)
+      if cacheable:
+        self._snapshotCache.put(self._id, iteration, name, result)
+    self._state[name] = result
+    return result
 
 
   # None of the "_conjureXXX" functions below are directly called. They are all
@@ -265,86 +308,66 @@ class SpFacade(object):
 
 
   def _conjureOverlaps(self, **kwargs):
-    return self._sp.getOverlaps().tolist()
+    return np.asarray(self._sp.getOverlaps())
 
 
   def _conjurePotentialPools(self, **kwargs):
-    # These only need to be fetched from the SP once.
-    if self._potentialPools:
-      return self._potentialPools
-    sp = self._sp
-    out = []
-    for colIndex in range(0, sp.getNumColumns()):
-      columnPool = self._getZeroedInput()
-      columnPoolIndices = []
-      sp.getPotential(colIndex, columnPool)
-      for i, pool in enumerate(columnPool):
-        if np.asscalar(pool) == 1.0:
-          columnPoolIndices.append(i)
-      out.append(columnPoolIndices)
-    self._potentialPools = out
-    return out
+    # These only need to be fetched from the SP once per model.
+    pools = self._snapshotCache.getPinned(self._id, SNAPS.POT_POOLS)
+    if pools is None:
+      pools = nonzeroByRow(getPotentialMatrix(self._sp))
+      self._snapshotCache.pin(self._id, SNAPS.POT_POOLS, pools)
+    return pools
 
 
   def _conjureConnectedSynapses(self, **kwargs):
-    columns = []
-    sp = self._sp
-    zeros = self._getZeroedInput()
-    for colIndex in range(0, sp.getNumColumns()):
-      connectedSynapses = zeros.copy()
-      sp.getConnectedSynapses(colIndex, connectedSynapses)
-      columns.append(np.nonzero(connectedSynapses)[0].tolist())
-    return columns
+    permanences = self._getPermanenceMatrix()
+    threshold = self._sp.getSynPermConnected() - PERMANENCE_EPSILON
+    return nonzeroByRow(permanences >= threshold)
 
 
   def _conjurePermanences(self, **kwargs):
-    out = []
-    numColumns = self.getNumColumns()
-    sp = self._sp
-    zeros = self._getZeroedInput(dtype="float32")
-    for colIndex in range(0, numColumns):
-      perms = zeros.copy()
-      sp.getPermanence(colIndex, perms)
-      out.append(np.around(perms, decimals=2).tolist())
-    return out
+    return np.around(self._getPermanenceMatrix(), decimals=2)
 
 
   def _conjureActiveDutyCycles(self, **kwargs):
     sp = self._sp
     dutyCycles = self._getZeroedColumns(dtype="float32")
     sp.getActiveDutyCycles(dutyCycles)
-    return dutyCycles.tolist()
+    return dutyCycles
 
 
   def _conjureBoostFactors(self, **kwargs):
     sp = self._sp
     boostFactors = self._getZeroedColumns(dtype="float32")
     sp.getBoostFactors(boostFactors)
-    return boostFactors.tolist()
+    return boostFactors
 
 
   def _conjureOverlapDutyCycles(self, **kwargs):
     sp = self._sp
     dutyCycles = self._getZeroedColumns()
     sp.getOverlapDutyCycles(dutyCycles)
-    return dutyCycles.tolist()
+    return dutyCycles
 
 
   def _conjureInhibitionMasks(self, **kwargs):
-    # These only need to be fetched from the SP once.
-    if self._inhibitionMasks:
-      return self._inhibitionMasks
-    out = []
-    numColumns = self.getNumColumns()
-    for colIndex in xrange(numColumns):
-      out.append(self._getInhibitionMask(colIndex))
-    self._inhibitionMasks = out
-    return out
-
-
-  def _getInhibitionMask(self, colIndex):
-    sp = self._sp
-    return topology.neighborhood(
-      colIndex, sp.getInhibitionRadius(), sp.getColumnDimensions()
-    ).tolist()
+    # These only change with the inhibition radius, so they are pinned for the
+    # radius they were built for.
+    radius = self._sp.getInhibitionRadius()
+    masks = self._snapshotCache.getPinned(
+      self._id, SNAPS.INH_MASKS, version=radius
+    )
+    if masks is not None:
+      return masks
+    dimensions = np.asarray(self._sp.getColumnDimensions(), dtype="uint32")
+    offsets, indices = getNeighborhoodCsr(radius, dimensions)
+    masks = {
+      "radius": radius,
+      "dimensions": dimensions,
+      "offsets": offsets,
+      "indices": indices,
+    }
+    self._snapshotCache.pin(self._id, SNAPS.INH_MASKS, masks, version=radius)
+    return masks
 
@@ -0,0 +1,157 @@
+import threading
+import time
+import Queue
+
+
+class StreamSession(object):
+  """
+  Long-lived compute session for one model. Records submitted to it are run
+  one at a time, in order, on the session's own thread, and their results are
+  queued for a client to read as a stream.
+
+  At most "window" records may be in flight, counting from when they are
+  submitted until their results have been read. A client that stops reading
+  therefore stops the producers too: submit() waits for room for up to
+  "timeout" seconds and then raises a RuntimeError.
+  """
+
+  def __init__(self, modelId, compute, window=16):
+    """
+    :param modelId: model this session computes for
+    :param compute: callable taking one record and returning its results
+    :param window: max records submitted but not yet read
+    """
+    if window < 1:
+      raise ValueError("Stream window must be at least 1.")
+    self._modelId = modelId
+    self._compute = compute
+    self._window = window
+    self._inFlight = 0
+    self._nextSeq = 0
+    self._closed = False
+    self._room = threading.Condition(threading.Lock())
+    self._inputs = Queue.Queue()
+    self._outputs = Queue.Queue()
+    self._stats = {
+      "submitted": 0,
+      "computed": 0,
+      "failed": 0,
+      "delivered": 0,
+      "rejected": 0,
+      "totalComputeMs": 0.0,
+    }
+    self._thread = threading.Thread(target=self._work)
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def getModelId(self):
+    return self._modelId
+
+
+  def isClosed(self):
+    return self._closed
+
+
+  def submit(self, records, timeout=None):
+    """
+    Queues records behind any already submitted. Either all of them fit in the
+    window or none are queued.
+    :param timeout: seconds to wait for room, None to fail right away
+    :return: sequence numbers of the records, which their results carry
+    """
+    count = len(records)
+    if count > self._window:
+      raise ValueError(
+        "Cannot submit {} records to a window of {}.".format(
+          count, self._window
+        )
+      )
+    deadline = time.time() + (timeout or 0)
+    with self._room:
+      while self._inFlight + count > self._window:
+        remaining = deadline - time.time()
+        if self._closed or remaining <= 0:
+          self._stats["rejected"] += count
+          raise RuntimeError(
+            "Stream for model {} has {} of {} records in flight.".format(
+              self._modelId, self._inFlight, self._window
+            )
+          )
+        self._room.wait(remaining)
+      if self._closed:
+        raise RuntimeError(
+          "Stream for model {} is closed.".format(self._modelId)
+        )
+      self._inFlight += count
+      seqs = range(self._nextSeq, self._nextSeq + count)
+      self._nextSeq += count
+      self._stats["submitted"] += count
+      for seq, record in zip(seqs, records):
+        self._inputs.put((seq, record))
+    return seqs
+
+
+  def next(self, timeout=None):
+    """
+    Takes the next result off the stream, freeing its slot in the window.
+    :return: (dict) "seq" plus either "result" or "error", or None if nothing
+             came within the timeout or the session is closed
+    """
+    try:
+      event = self._outputs.get(True, timeout)
+    except Queue.Empty:
+      return None
+    if event is None:
+      return None
+    with self._room:
+      self._inFlight -= 1
+      self._stats["delivered"] += 1
+      self._room.notify_all()
+    return event
+
+
+  def close(self):
+    """
+    Stops the session. Records not computed yet are dropped, and anyone
+    waiting on next() gets None.
+    """
+    with self._room:
+      self._closed = True
+      self._room.notify_all()
+    self._inputs.put(None)
+
+
+  def getStats(self):
+    """
+    :return: (dict) window use and record counters
+    """
+    with self._room:
+      stats = dict(self._stats)
+      stats["inFlight"] = self._inFlight
+    stats["window"] = self._window
+    stats["closed"] = self._closed
+    stats["meanComputeMs"] = stats["totalComputeMs"] \
+      / max(stats["computed"] + stats["failed"], 1)
+    return stats
+
+
+  def _work(self):
+    while True:
+      item = self._inputs.get()
+      if item is None or self._closed:
+        self._outputs.put(None)
+        return
+      seq, record = item
+      start = time.time()
+      try:
+        event = {"seq": seq, "result": self._compute(record)}
+        failed = False
+      except Exception as e:
+        print "Stream compute for model {} failed: {}".format(self._modelId, e)
+        event = {"seq": seq, "error": str(e)}
+        failed = True
+      with self._room:
+        self._stats["failed" if failed else "computed"] += 1
+        self._stats["totalComputeMs"] += (time.time() - start) * 1000
+      self._outputs.put(event)
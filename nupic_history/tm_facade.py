@@ -1,20 +1,34 @@
 import uuid
-import multiprocessing
-import time
 import numpy as np
 
 from nupic_history import TmSnapshots as SNAPS
+from nupic_history.metrics import metrics
+from nupic_history.utils import getSegmentCsr
+
+# Name the TM params are pinned under in the snapshot cache.
+PARAMS = "tmParams"
 
 class TmFacade(object):
 
   def __init__(self, tm, ioClient, modelId=None, iteration=None):
+    """
+    A wrapper around the HTM Temporal Memory that can save TM state for each
+    compute cycle. Adds a "save=" kwarg to compute().
+
+    :param tm: Either an instance of Temporal Memory or a string model id
+    :param ioClient: Instantiated IO client
+    :param modelId: id of the SP this TM sits on, if any
+    :param iteration: what iteration to resurrect the TM at, or for a new TM,
+                      the iteration it starts at (the SP's, so the two line up)
+    """
     self._ioClient = ioClient
+    self._snapshotCache = ioClient.getSnapshotCache()
     if isinstance(tm, basestring):
       # Loading TM by id from IO.
       self._id = tm
       # Get the latest by default.
       if iteration is None:
-        iteration = ioClient.getMaxIteration(self._id)
+        iteration = ioClient.getMaxIteration(self._id, kind="tmstep")
       self._iteration = iteration
     else:
       if modelId is not None:
@@ -25,11 +39,19 @@ class TmFacade(object):
         # New facade using given fresh TM
         self._tm = tm
         self._id = str(uuid.uuid4()).split('-')[0]
-      self._iteration = 0
-
+      if iteration is None:
+        iteration = 0
+      self._iteration = iteration
+      # Nothing cached for a TM under this id can be about this one.
+      self._snapshotCache.forget(self._id, SNAPS.listValues() + [PARAMS])
+
+    self._learn = True
+    # Whether reset() was called since the last compute, and whether the last
+    # compute came after one. Saved with each step so loads can replay it.
+    self._resetPending = False
+    self._resetBefore = False
     self._state = None
     self._input = None
-    self._save = None
 
 
   def __str__(self):
@@ -42,7 +64,10 @@ class TmFacade(object):
     ioClient = self._ioClient
     id = self.getId()
     iteration = self.getIteration()
-    ioClient.saveTemporalMemory(self._tm, id, iteration)
+    ioClient.saveTemporalMemory(
+      self._tm, id, iteration, self._input, learn=self._learn,
+      reset=self._resetBefore
+    )
 
 
   def load(self):
@@ -53,6 +78,7 @@ class TmFacade(object):
     self._tm = ioClient.loadTemporalMemory(
       id, iteration=iteration
     )
+    self._state = None
 
 
   def getId(self):
@@ -73,47 +99,46 @@ class TmFacade(object):
     return self._iteration
 
 
-  def compute(self, activeColumns, learn=True, multiprocess=True):
+  def getInput(self):
+    """
+    :return: active columns of the last compute
+    """
+    return self._input
+
+
+  def compute(self, activeColumns, learn=True, save=False):
     """
     Pass-through to Temporal Memory's compute() function, with the addition of
-    the save option.
+    the save option. Writes go through the IO client's write queue if it has
+    one.
     :param activeColumns: (set) indices of on bits
     :param learn: whether tm will learn on this compute cycle
+    :param save: whether to save this cycle's state through the IO client
     """
     tm = self._tm
-    tm.compute(activeColumns, learn=learn)
+    with metrics.span("tm.compute", self._id):
+      tm.compute(activeColumns, learn=learn)
+    self._iteration += 1
     self._input = activeColumns
+    self._learn = learn
+    self._resetBefore = self._resetPending
+    self._resetPending = False
     self._state = None
-    if multiprocess:
-      p = multiprocessing.Process(target=self.save)
-      p.start()
-    else:
+    if save:
       self.save()
 
 
   def reset(self):
     """
-    Just a pass-through to the TM.reset() function.
+    Pass-through to the TM.reset() function. The reset is saved along with the
+    next compute.
     """
     self._tm.reset()
-
-
-  def save(self):
-    """
-    Saves the current state of the TM to Redis.
-    """
-    if self._save is not None and len(self._save) > 0:
-      if not self.isActive():
-        raise RuntimeError("Cannot save an inactive TM Facade.")
-      if self.getInput() is None:
-        raise ValueError(
-          "Cannot save TM state because it has never seen input.")
-      modelId = self.getId()
-      params = self.getParams()
-      iteration = self.getIteration()
-      state = self.getState(*self._save)
-      print "Saving state of TM..."
-      self._ioClient.saveTmState(modelId, params, iteration, state)
+    self._resetPending = True
+    # The reset cleared the TM's cells and segments, so nothing cached for this
+    # iteration matches it anymore.
+    self._state = None
+    self._snapshotCache.discard(self._id, self._iteration, SNAPS.listValues())
 
 
   def getParams(self):
@@ -121,6 +146,9 @@ class TmFacade(object):
     Utility to collect the SP params used at creation into a dict.
     :return: [dict] parameters
     """
+    params = self._snapshotCache.getPinned(self._id, PARAMS)
+    if params is not None:
+      return params
     tm = self._tm
     if tm is None:
       params =self._ioClient.getTmParams(self.getId())
@@ -139,11 +167,17 @@ class TmFacade(object):
         "maxSynapsesPerSegment": tm.connections.maxSynapsesPerSegment,
         "columnDimensions": tm.getColumnDimensions(),
       }
+    self._snapshotCache.pin(self._id, PARAMS, params)
     return params
 
 
   def getState(self, *args, **kwargs):
-
+    """
+    Returns the requested state of the temporal memory, at its current
+    iteration or, with iteration=, at any saved one. Active and predictive
+    cells of past iterations come straight from the saved steps, segments need
+    the TM rebuilt at that iteration.
+    """
     iteration = None
     if "iteration" in kwargs:
       iteration = kwargs["iteration"]
@@ -160,38 +194,32 @@ class TmFacade(object):
     return out
 
 
-  def _segmentToDict(self, segment, connections):
-    return {
-      "cell": connections.cellForSegment(segment),
-      "synapses": [
-        self._synapseToDict(s, connections)
-        for s in connections.synapsesForSegment(segment)
-      ],
-    }
+  def _isCurrent(self, iteration):
+    return iteration is None or iteration == self._iteration
 
 
-  def _synapseToDict(self, synapse, connections):
-    synapseData = connections.dataForSynapse(synapse)
-    return {
-      "presynapticCell": synapseData.presynapticCell,
-      "permanence": synapseData.permanence,
-    }
+  def _getTm(self, iteration):
+    if self._isCurrent(iteration):
+      return self._tm
+    return self._ioClient.loadTemporalMemory(self.getId(), iteration=iteration)
 
 
   def _getSnapshot(self, name, iteration=None):
-    # Use the cache if we can.
-    if name in self._state and iteration == self._iteration:
-      print "** Using Cache"
+    # Use the cache if we can, then the snapshot cache shared with other
+    # facades.
+    if name in self._state and self._isCurrent(iteration):
       return self._state[name]
-    else:
+    cacheIteration = self._iteration if iteration is None else iteration
+    result = self._snapshotCache.get(self._id, cacheIteration, name)
+    if result is None:
       funcName = "_conjure{}".format(name[:1].upper() + name[1:])
       func = getattr(self, funcName)
-      _start = time.time()
-      result = func(iteration=iteration)
-      _end = time.time()
-      print "\t\t{}: {} seconds".format(funcName, (_end - _start))
+      with metrics.span("tm.conjure." + name, self._id):
+        result = func(iteration=iteration)
+      self._snapshotCache.put(self._id, cacheIteration, name, result)
+    if self._isCurrent(iteration):
       self._state[name] = result
-      return result
+    return result
 
 
   # None of the "_conjureXXX" functions below are directly called. They are all
@@ -204,23 +232,31 @@ class TmFacade(object):
   # iteration in the past is specified, Redis will be the data source.
 
 
-  def _conjureActiveCells(self, **kwargs):
-    return self._tm.getActiveCells().tolist()
+  def _conjureActiveCells(self, iteration=None, **kwargs):
+    if self._isCurrent(iteration):
+      cells = self._tm.getActiveCells()
+    else:
+      cells = self._ioClient.loadTmCells(
+        self.getId(), SNAPS.ACT_CELLS, iteration
+      )
+    return np.asarray(cells, dtype="uint32")
 
 
-  def _conjurePredictiveCells(self, **kwargs):
-    return self._tm.getPredictiveCells().tolist()
+  def _conjurePredictiveCells(self, iteration=None, **kwargs):
+    if self._isCurrent(iteration):
+      cells = self._tm.getPredictiveCells()
+    else:
+      cells = self._ioClient.loadTmCells(
+        self.getId(), SNAPS.PRD_CELLS, iteration
+      )
+    return np.asarray(cells, dtype="uint32")
 
 
-  def _conjureActiveSegments(self, **kwargs):
-    return [
-      self._segmentToDict(c, self._tm.connections)
-      for c in self._tm.getActiveSegments()
-    ]
+  def _conjureActiveSegments(self, iteration=None, **kwargs):
+    tm = self._getTm(iteration)
+    return getSegmentCsr(tm.connections, tm.getActiveSegments())
 
 
-  def _conjureMatchingSegments(self, **kwargs):
-    return [
-      self._segmentToDict(c, self._tm.connections)
-      for c in self._tm.getMatchingSegments()
-    ]
+  def _conjureMatchingSegments(self, iteration=None, **kwargs):
+    tm = self._getTm(iteration)
+    return getSegmentCsr(tm.connections, tm.getMatchingSegments())
@@ -1,10 +1,13 @@
+import threading
+from collections import OrderedDict
+
 import numpy as np
 
 
 def compressSdr(sdr):
   return {
     "length": len(sdr),
-    "indices": [i for i, bit in enumerate(sdr) if bit]
+    "indices": np.nonzero(sdr)[0].astype("uint32")
   }
 
 
@@ -14,3 +17,169 @@ def decompressSdr(sdr, name):
   for index in sdr[name]["indices"]:
     out[index] = 1
   return out
+
+
+
+def getPermanenceMatrix(sp, out=None):
+  """
+  Reads every column's permanences into one (numColumns, numInputs) float32
+  array in a single pass, instead of one array per column.
+  """
+  numColumns = sp.getNumColumns()
+  if out is None:
+    out = np.zeros((numColumns, sp.getNumInputs()), dtype="float32")
+  for colIndex in xrange(numColumns):
+    sp.getPermanence(colIndex, out[colIndex])
+  return out
+
+
+def getPotentialMatrix(sp):
+  """
+  Reads every column's potential pool into one (numColumns, numInputs) uint32
+  array of 1s and 0s.
+  """
+  numColumns = sp.getNumColumns()
+  out = np.zeros((numColumns, sp.getNumInputs()), dtype="uint32")
+  for colIndex in xrange(numColumns):
+    sp.getPotential(colIndex, out[colIndex])
+  return out
+
+
+def getPotentialCsr(sp):
+  """
+  Every column's potential pool in CSR layout: column i's inputs are at
+  [offsets[i], offsets[i + 1]) in inputs, in ascending order.
+
+  :return: (offsets, inputs), both uint32. offsets has one more item than
+           there are columns.
+  """
+  rows, inputs = np.nonzero(getPotentialMatrix(sp))
+  offsets = np.zeros(sp.getNumColumns() + 1, dtype="uint32")
+  offsets[1:] = np.cumsum(np.bincount(rows, minlength=sp.getNumColumns()))
+  return offsets, inputs.astype("uint32")
+
+
+
+def nonzeroByRow(matrix):
+  """
+  :return: list with the indices of the non-zero values in each row of matrix
+  """
+  rows, columns = np.nonzero(matrix)
+  counts = np.bincount(rows, minlength=matrix.shape[0])
+  return [
+    indices.tolist() for indices in np.split(columns, np.cumsum(counts)[:-1])
+  ]
+
+
+def getSegmentCsr(connections, segments):
+  """
+  Reads segments and their synapses out of TM connections as parallel arrays
+  in CSR layout. The synapses of segment i are at
+  [synapseOffsets[i], synapseOffsets[i + 1]) in presynapticCells and
+  permanences.
+
+  The Connections bindings have no bulk accessor for synapse data, so this
+  still makes one dataForSynapse() call per synapse. Only the response shape
+  is columnar. Ask for segments sparingly on big trained TMs.
+
+  :return: (dict) "cells" (uint32, cell of each segment), "synapseOffsets"
+           (uint32, one more than there are segments), "presynapticCells"
+           (uint32) and "permanences" (float32)
+  """
+  cells = np.zeros(len(segments), dtype="uint32")
+  offsets = np.zeros(len(segments) + 1, dtype="uint32")
+  presynapticCells = []
+  permanences = []
+  for i, segment in enumerate(segments):
+    cells[i] = connections.cellForSegment(segment)
+    for synapse in connections.synapsesForSegment(segment):
+      synapseData = connections.dataForSynapse(synapse)
+      presynapticCells.append(synapseData.presynapticCell)
+      permanences.append(synapseData.permanence)
+    offsets[i + 1] = len(presynapticCells)
+  return {
+    "cells": cells,
+    "synapseOffsets": offsets,
+    "presynapticCells": np.array(presynapticCells, dtype="uint32"),
+    "permanences": np.array(permanences, dtype="float32"),
+  }
+
+
+
+def getNeighborhoodCsr(radius, dimensions):
+  """
+  Every column's neighborhood, in one vectorized pass: the columns within
+  radius along each dimension, without wrapping around, which is what
+  topology.neighborhood() returns for one column. Column i's neighbors are at
+  [offsets[i], offsets[i + 1]) in indices, in ascending order.
+
+  :return: (offsets, indices), both uint32. offsets has one more item than
+           there are columns.
+  """
+  dimensions = [int(size) for size in dimensions]
+  numColumns = int(np.prod(dimensions))
+  coordinates = np.indices(dimensions).reshape(len(dimensions), numColumns)
+  strides = np.cumprod([1] + dimensions[:0:-1])[::-1]
+  # Expands each column's neighbors one dimension at a time, outermost first,
+  # so they come out grouped by column and sorted.
+  owners = np.arange(numColumns)
+  values = np.zeros(numColumns, dtype="int64")
+  for dim, size in enumerate(dimensions):
+    low = np.maximum(coordinates[dim] - radius, 0)
+    high = np.minimum(coordinates[dim] + radius, size - 1)
+    lengths = (high - low + 1)[owners]
+    starts = np.cumsum(lengths) - lengths
+    owners = np.repeat(owners, lengths)
+    steps = np.arange(len(owners)) - np.repeat(starts, lengths)
+    values = np.repeat(values, lengths) + (low[owners] + steps) * strides[dim]
+  offsets = np.zeros(numColumns + 1, dtype="uint32")
+  offsets[1:] = np.cumsum(np.bincount(owners, minlength=numColumns))
+  return offsets, values.astype("uint32")
+
+
+
+class LruCache(object):
+  """
+  Small least-recently-used cache. Holds at most maxSize items, dropping the
+  least recently read or written one when full. Safe to use from many threads.
+  """
+
+  def __init__(self, maxSize):
+    self._maxSize = maxSize
+    self._items = OrderedDict()
+    self._lock = threading.Lock()
+
+
+  def __contains__(self, key):
+    with self._lock:
+      return key in self._items
+
+
+  def __len__(self):
+    with self._lock:
+      return len(self._items)
+
+
+  def get(self, key, default=None):
+    with self._lock:
+      if key not in self._items:
+        return default
+      value = self._items.pop(key)
+      self._items[key] = value
+      return value
+
+
+  def put(self, key, value):
+    with self._lock:
+      if key in self._items:
+        del self._items[key]
+      elif self._maxSize <= 0:
+        return
+      elif len(self._items) >= self._maxSize:
+        self._items.popitem(last=False)
+      self._items[key] = value
+
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
@@ -0,0 +1,168 @@
+import msgpack
+import numpy as np
+import ujson as json
+
+
+# Request body formats for SDRs.
+CSV = "text/plain"                          # "0,1,1,0,..." (the default)
+SDR_INDICES = "application/x-sdr-indices"   # little-endian uint32 on-bits
+SDR_PACKED = "application/x-sdr-packed"     # dense bits, np.packbits order
+
+# Response formats.
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+
+def _mediaType(header):
+  if header is None:
+    return ""
+  return header.split(";")[0].strip().lower()
+
+
+def isBinarySdr(contentType):
+  return _mediaType(contentType) in [SDR_INDICES, SDR_PACKED]
+
+
+def decodeSdr(data, contentType, length):
+  """
+  Decodes a request body into a dense SDR.
+  :param contentType: request Content-Type header
+  :param length: number of bits in the SDR. Binary formats do not carry it.
+  :return: dense uint32 array of 1s and 0s
+  :raises ValueError: if the body is malformed or does not fit the length
+  """
+  mediaType = _mediaType(contentType)
+  if mediaType == SDR_INDICES:
+    indices = _decodeIndices(data)
+    if len(indices) > 0 and indices.max() >= length:
+      raise ValueError(
+        "SDR index {} is out of range for {} bits.".format(
+          indices.max(), length
+        )
+      )
+    dense = np.zeros(length, dtype="uint32")
+    dense[indices] = 1
+    return dense
+  elif mediaType == SDR_PACKED:
+    if len(data) != (length + 7) // 8:
+      raise ValueError(
+        "Packed SDR of {} bits must be {} bytes, got {}.".format(
+          length, (length + 7) // 8, len(data)
+        )
+      )
+    bits = np.unpackbits(np.frombuffer(data, dtype="uint8"))[:length]
+    return bits.astype("uint32")
+  bits = _decodeCsv(data)
+  if len(bits) != length or np.any(bits > 1):
+    raise ValueError(
+      "SDR must be {} comma-separated 0s and 1s.".format(length)
+    )
+  return bits
+
+
+def decodeSdrIndices(data, contentType):
+  """
+  Decodes a request body of on-bit indices. Comma-separated bodies are taken as
+  indices as well, packed bodies are converted.
+  :return: uint32 array of on-bit indices
+  :raises ValueError: if the body is malformed
+  """
+  mediaType = _mediaType(contentType)
+  if mediaType == SDR_INDICES:
+    return _decodeIndices(data)
+  elif mediaType == SDR_PACKED:
+    bits = np.unpackbits(np.frombuffer(data, dtype="uint8"))
+    return np.nonzero(bits)[0].astype("uint32")
+  return _decodeCsv(data)
+
+
+def _decodeIndices(data):
+  if len(data) % 4 != 0:
+    raise ValueError(
+      "SDR indices body of {} bytes is not whole uint32s.".format(len(data))
+    )
+  return np.frombuffer(data, dtype="<u4").astype("uint32")
+
+
+def _decodeCsv(data):
+  # Every value must parse, rather than stopping quietly at the first one that
+  # does not.
+  if len(data) == 0:
+    return np.array([], dtype="uint32")
+  values = [int(value) for value in data.split(",")]
+  if min(values) < 0:
+    raise ValueError("SDR values must not be negative.")
+  return np.array(values, dtype="uint32")
+
+
+def negotiate(accept):
+  """
+  Picks the response format from an Accept header. JSON unless msgpack is
+  asked for.
+  """
+  if accept is not None:
+    for mediaType in accept.split(","):
+      mediaType = _mediaType(mediaType)
+      if mediaType in [MSGPACK, "application/x-msgpack"]:
+        return MSGPACK
+  return JSON
+
+
+def encode(payload, contentType):
+  """
+  Serializes a response. NumPy arrays are kept as arrays until here: JSON turns
+  them into lists, msgpack sends them as typed arrays, which are maps of
+  "dtype" (numpy type string, always little-endian), "shape" and "data" (raw
+  bytes).
+  :return: serialized string
+  """
+  if contentType == MSGPACK:
+    return msgpack.packb(payload, default=_packNumpy, use_bin_type=True)
+  return json.dumps(_toJsonable(payload))
+
+
+def decode(data, contentType):
+  """
+  Deserializes a JSON or msgpack request body. Typed arrays in msgpack bodies
+  come back as NumPy arrays.
+  """
+  if _mediaType(contentType) in [MSGPACK, "application/x-msgpack"]:
+    return msgpack.unpackb(data, object_hook=_unpackNumpy, encoding="utf-8")
+  return json.loads(data)
+
+
+def _unpackNumpy(obj):
+  if len(obj) == 3 and "dtype" in obj and "shape" in obj and "data" in obj:
+    return np.frombuffer(obj["data"], dtype=obj["dtype"])\
+      .reshape(obj["shape"])
+  return obj
+
+
+def _packNumpy(obj):
+  if isinstance(obj, np.ndarray):
+    littleEndian = np.ascontiguousarray(
+      obj, dtype=obj.dtype.newbyteorder("<")
+    )
+    return {
+      "dtype": littleEndian.dtype.str,
+      "shape": list(littleEndian.shape),
+      "data": littleEndian.tobytes(),
+    }
+  if isinstance(obj, np.generic):
+    return obj.item()
+  if isinstance(obj, (set, frozenset)):
+    return sorted(obj)
+  raise TypeError("Cannot serialize {}".format(type(obj)))
+
+
+def _toJsonable(obj):
+  if isinstance(obj, np.ndarray):
+    return obj.tolist()
+  if isinstance(obj, np.generic):
+    return obj.item()
+  if isinstance(obj, dict):
+    return dict((key, _toJsonable(value)) for key, value in obj.iteritems())
+  if isinstance(obj, (list, tuple)) and len(obj) > 0 \
+      and isinstance(obj[0], (np.ndarray, np.generic, dict, list, tuple)):
+    return [_toJsonable(value) for value in obj]
+  return obj
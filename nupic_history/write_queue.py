@@ -0,0 +1,159 @@
+import threading
+import time
+import Queue
+
+
+class WriteQueue(object):
+  """
+  Long-lived pool of writer threads fed by bounded queues. IO clients hand it
+  writes that are already serialized, so the compute path only pays for
+  serialization, never for disk IO.
+
+  Every write for one model goes to the same writer, so writes land on disk in
+  the order they were queued for that model. When a writer's queue is full,
+  put() blocks (back-pressure on the compute path) for up to "timeout" seconds
+  before giving up with a RuntimeError.
+  """
+
+  def __init__(self, workers=2, maxDepth=256, timeout=None):
+    """
+    :param workers: number of writer threads
+    :param maxDepth: max queued writes per writer before put() blocks
+    :param timeout: seconds put() may block on a full queue, None for forever
+    """
+    if workers < 1:
+      raise ValueError("Write queue needs at least one worker.")
+    self._timeout = timeout
+    self._maxDepth = maxDepth
+    self._lock = threading.Lock()
+    self._idle = threading.Condition(self._lock)
+    self._pending = {}
+    self._stats = {
+      "queued": 0,
+      "written": 0,
+      "failed": 0,
+      "totalWaitMs": 0.0,
+      "maxWaitMs": 0.0,
+      "totalWriteMs": 0.0,
+      "maxWriteMs": 0.0,
+      "lastError": None,
+    }
+    self._queues = [Queue.Queue(maxsize=maxDepth) for _ in xrange(workers)]
+    self._threads = []
+    for queue in self._queues:
+      thread = threading.Thread(target=self._work, args=(queue,))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+
+  def put(self, modelId, write):
+    """
+    Queues a write behind any others for the same model.
+    :param write: callable doing the actual IO
+    """
+    queue = self._queues[hash(modelId) % len(self._queues)]
+    with self._lock:
+      self._pending[modelId] = self._pending.get(modelId, 0) + 1
+      self._stats["queued"] += 1
+    try:
+      queue.put((modelId, write, time.time()), True, self._timeout)
+    except Queue.Full:
+      self._done(modelId)
+      raise RuntimeError(
+        "Write queue is full, dropped write for model {}.".format(modelId)
+      )
+
+
+  def flush(self, modelId=None, timeout=None):
+    """
+    Blocks until queued writes have finished, either for one model or for all
+    of them.
+    :return: False if the timeout ran out first
+    """
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+    with self._idle:
+      while self._countPending(modelId) > 0:
+        if deadline is None:
+          self._idle.wait()
+        else:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            return False
+          self._idle.wait(remaining)
+    return True
+
+
+  def close(self):
+    """
+    Drains the queue and stops the writers.
+    """
+    self.flush()
+    for queue in self._queues:
+      queue.put(None)
+    for thread in self._threads:
+      thread.join()
+
+
+  def getStats(self):
+    """
+    :return: (dict) queue depth and write latency counters
+    """
+    with self._lock:
+      stats = dict(self._stats)
+      stats["pendingModels"] = len(self._pending)
+    finished = stats["written"] + stats["failed"]
+    stats["depth"] = sum([q.qsize() for q in self._queues])
+    stats["workerDepths"] = [q.qsize() for q in self._queues]
+    stats["maxDepth"] = self._maxDepth * len(self._queues)
+    stats["meanWaitMs"] = stats["totalWaitMs"] / max(finished, 1)
+    stats["meanWriteMs"] = stats["totalWriteMs"] / max(finished, 1)
+    return stats
+
+
+  def _countPending(self, modelId):
+    if modelId is None:
+      return sum(self._pending.values())
+    return self._pending.get(modelId, 0)
+
+
+  def _done(self, modelId):
+    with self._idle:
+      self._pending[modelId] -= 1
+      if self._pending[modelId] == 0:
+        del self._pending[modelId]
+      self._idle.notify_all()
+
+
+  def _work(self, queue):
+    while True:
+      item = queue.get()
+      if item is None:
+        queue.task_done()
+        return
+      modelId, write, queuedAt = item
+      start = time.time()
+      failed = None
+      try:
+        write()
+      except Exception as e:
+        failed = e
+        print "Write for model {} failed: {}".format(modelId, e)
+      end = time.time()
+      waitMs = (start - queuedAt) * 1000
+      writeMs = (end - start) * 1000
+      with self._lock:
+        stats = self._stats
+        if failed is None:
+          stats["written"] += 1
+        else:
+          stats["failed"] += 1
+          stats["lastError"] = str(failed)
+        stats["totalWaitMs"] += waitMs
+        stats["maxWaitMs"] = max(stats["maxWaitMs"], waitMs)
+        stats["totalWriteMs"] += writeMs
+        stats["maxWriteMs"] = max(stats["maxWriteMs"], writeMs)
+      self._done(modelId)
+      queue.task_done()
@@ -1,4 +1,5 @@
-import time
+import multiprocessing
+import os
 import ujson as json
 import uuid
 
@@ -14,32 +15,224 @@ else:
 
 from nupic.bindings.algorithms import TemporalMemory as TM
 
-from nupic_history import NupicHistory
+from nupic_history import NupicHistory, wire
 from nupic_history import SpSnapshots as SP_SNAPS
-from nupic_history.io_client import FileIoClient
+from nupic_history.io_client import FileIoClient, checkModelId
+from nupic_history.metrics import metrics
+from nupic_history.model_cache import ModelCache
+from nupic_history.redis_io_client import RedisIoClient
+from nupic_history.retention import Compactor, RetentionPolicy
+from nupic_history.shard_pool import SHARD_ENV
 from nupic_history.sp_facade import SpFacade
+from nupic_history.stream_session import StreamSession
 from nupic_history.tm_facade import TmFacade
+from nupic_history.write_queue import WriteQueue
 from nupic_history import TmSnapshots as TM_SNAPS
 from nupic.algorithms.sdr_classifier_factory import SDRClassifierFactory
 
 
-ioClient = FileIoClient(workingDir="./working")
-modelCache = {}
-nupicHistory = NupicHistory(ioClient)
+# History workers are forked before the write queue or any other thread starts,
+# so none of them gets a copy of a lock some thread was holding.
+historyProcesses = int(os.environ.get("NUPIC_HISTORY_PROCESSES", 1))
+historyPool = None
+if historyProcesses > 1:
+  historyPool = multiprocessing.Pool(historyProcesses)
+writeQueue = WriteQueue(workers=2, maxDepth=256)
+if "NUPIC_HISTORY_REDIS_URL" in os.environ:
+  # Workers run by frontserver.py each get their own key prefix.
+  redisPrefix = os.environ.get("NUPIC_HISTORY_REDIS_PREFIX", "htm")
+  if SHARD_ENV in os.environ:
+    redisPrefix += ":shard" + os.environ[SHARD_ENV]
+  ioClient = RedisIoClient(
+    url=os.environ["NUPIC_HISTORY_REDIS_URL"], prefix=redisPrefix,
+    writeQueue=writeQueue
+  )
+else:
+  # Workers run by frontserver.py each get their own directory.
+  ioClient = FileIoClient(
+    workingDir=os.environ.get("NUPIC_HISTORY_WORKING_DIR", "./working"),
+    writeQueue=writeQueue
+  )
+modelCache = ModelCache(ioClient, maxModels=64)
+# Open streaming sessions, keyed by model id.
+streamSessions = {}
+# Processes column history is reconstructed with, when it needs SPs loaded.
+nupicHistory = NupicHistory(
+  ioClient, processes=historyProcesses, pool=historyPool
+)
+# Applies models' retention policies in the background.
+compactor = Compactor(
+  ioClient, interval=int(os.environ.get("NUPIC_HISTORY_COMPACT_INTERVAL", 60))
+)
 
 urls = (
   "/", "Index",
   "/_sp/", "SpRoute",
+  "/_sp/([^/]+)/history/", "SpColumnsHistoryRoute",
   "/_sp/(.+)/history/(.+)", "SpHistoryRoute",
   "/_tm/", "TmRoute",
   "/_compute/", "ComputeRoute",
+  "/_compute/batch/", "BatchComputeRoute",
+  "/_stream/(.+)/", "StreamRoute",
+  "/_activity/([^/]+)/", "ActivityRoute",
   "/_flush/", "RoyalFlush",
+  "/_writes/", "WritesRoute",
+  "/_cache/", "CacheRoute",
+  "/_codecs/", "CodecsRoute",
+  "/_metrics/", "MetricsRoute",
+  "/_compact/", "CompactRoute",
+  "/_models/([^/]+)/retention/", "RetentionRoute",
+  "/_models/([^/]+)/", "ModelRoute",
 )
 web.config.debug = False
 app = web.application(urls, globals())
 
 
 
+def instrument(handler):
+  """
+  Times every request, and sends the time spent in each stage back in a
+  Server-Timing header.
+  """
+  metrics.beginRequest()
+  with metrics.span("request"):
+    result = handler()
+  web.header("Server-Timing", metrics.serverTiming())
+  return result
+
+
+app.add_processor(instrument)
+
+
+
+def respond(payload):
+  """
+  Serializes a response in whichever format the client's Accept header asks
+  for (see wire.py). JSON by default.
+  """
+  contentType = wire.negotiate(web.ctx.env.get("HTTP_ACCEPT"))
+  web.header("Content-Type", contentType)
+  with metrics.span("serialize.response"):
+    out = wire.encode(payload, contentType)
+  metrics.addBytes("response", len(out))
+  return out
+
+
+
+def checkModel(modelId, inMemory=False):
+  """
+  Checks a model id from a URL before it goes anywhere near storage.
+  :param inMemory: also accept models that are only in the model cache
+  :raises: 400 for ids that are not valid model ids, 404 for unknown models
+  """
+  try:
+    known = ioClient.hasModel(modelId)
+  except ValueError as e:
+    print e
+    raise web.badrequest()
+  if not known and not (inMemory and modelId in modelCache):
+    print "Unknown model id: {}".format(modelId)
+    raise web.notfound()
+
+
+
+def checkModelParam(modelId):
+  """
+  Checks a model id from a request param or body, before it is used to look
+  the model up.
+  :raises: 400 for ids that are not valid model ids
+  """
+  try:
+    checkModelId(modelId)
+  except ValueError as e:
+    print e
+    raise web.badrequest()
+
+
+
+def selectSnapshots(spStates, tmStates):
+  """
+  Drops the states computeRecord always returns from requested state lists.
+  Predictive cells are always included.
+  :return: (spSnapshots, tmSnapshots) for computeRecord
+  """
+  spSnapshots = [snap for snap in spStates or [] if snap != SP_SNAPS.ACT_COL]
+  tmSnapshots = [TM_SNAPS.PRD_CELLS] + [
+    snap for snap in tmStates or []
+    if snap not in [TM_SNAPS.ACT_CELLS, TM_SNAPS.PRD_CELLS]
+  ]
+  return spSnapshots, tmSnapshots
+
+
+
+def decodeRecord(record, numInputs):
+  """
+  :param record: (dict) "encoding" (bit array) or "indices" (on-bit array)
+  :return: dense encoding of a batch or stream record
+  """
+  if "indices" in record:
+    encoding = np.zeros(numInputs, dtype="uint32")
+    encoding[np.asarray(record["indices"], dtype="uint32")] = 1
+    return encoding
+  return record["encoding"]
+
+
+
+def computeRecord(modelId, encoding, bucketIdx, actValue, spLearn=True,
+                  tmLearn=True, reset=False, spSnapshots=None,
+                  tmSnapshots=None):
+  """
+  Runs one record through the SP, TM and classifier of a cached model.
+
+  :param encoding: dense input encoding
+  :param spSnapshots: SP states to return besides active columns
+  :param tmSnapshots: TM states to return besides active cells
+  :return: (dict) requested states, plus the top three predictions under
+           "inference"
+  """
+  spSnapshots = [SP_SNAPS.ACT_COL] + (spSnapshots or [])
+  tmSnapshots = [TM_SNAPS.ACT_CELLS] + (tmSnapshots or [])
+
+  with modelCache.lock(modelId):
+    model = modelCache[modelId]
+    sp = model["sp"]
+    tm = model["tm"]
+    classifier = model["classifier"]
+
+    # The SP and TM saves go to storage together.
+    with ioClient.batch():
+      sp.compute(encoding, learn=spLearn, save=model["save"])
+      spResults = sp.getState(*spSnapshots)
+      activeColumns = spResults[SP_SNAPS.ACT_COL]["indices"]
+
+      tm.compute(activeColumns, learn=tmLearn, save=model["save"])
+      tmResults = tm.getState(*tmSnapshots)
+
+    with metrics.span("classifier.compute", modelId):
+      inference = classifier.compute(
+        recordNum=model["recordsSeen"],
+        patternNZ=tmResults[TM_SNAPS.ACT_CELLS],
+        classification={"bucketIdx": bucketIdx, "actValue": actValue},
+        learn=True, infer=True
+      )
+    model["recordsSeen"] += 1
+
+    if reset:
+      tm.reset()
+
+  results = {}
+  results.update(spResults)
+  results.update(tmResults)
+  # Top three predictions for 1 steps out.
+  results["inference"] = sorted(
+    zip(
+      inference[1], inference["actualValues"]
+    ), reverse=True
+  )[:3]
+  return results
+
+
+
 class Index:
 
 
@@ -58,24 +251,48 @@ class SpRoute:
 
     POST params:
 
+    id (string):             Optional. Model id to use instead of a generated
+                             one: letters, digits, "_" and "-". The sharding
+                             front sets it.
+
     states: (string array):  List of the SP states you want back. Active columns
                              are always sent. Otherwise, you can find a list of
                              available states in snapshots.py.
+    keyframeInterval (int):  Optional. Iterations between full SP snapshots on
+                             disk.
+    historyMode (string):    Optional. "delta" stores what changed between
+                             keyframes, "replay" stores nothing and re-runs the
+                             saved encodings from the last keyframe on load.
+    retention (object):      Optional. How much history to keep, see
+                             RetentionRoute.
 
     :return: requested state from the sp instance in JSON, keyed by strings in
              POST "states" param.
     """
-    global modelCache
     requestPayload = json.loads(web.data())
     params = requestPayload["params"]
     states = requestPayload["states"]
     save = requestPayload["save"]
+    modelId = requestPayload.get("id")
+    if modelId is not None:
+      checkModelParam(modelId)
 
     from pprint import pprint; pprint(params)
-    sp = SpFacade(SP(**params), ioClient)
+    sp = SpFacade(SP(**params), ioClient, modelId=modelId)
 
     modelId = sp.getId()
 
+    if "keyframeInterval" in requestPayload:
+      ioClient.setKeyframeInterval(
+        modelId, requestPayload["keyframeInterval"]
+      )
+    if "historyMode" in requestPayload:
+      ioClient.setHistoryMode(modelId, requestPayload["historyMode"])
+    if "retention" in requestPayload:
+      ioClient.setRetentionPolicy(
+        modelId, RetentionPolicy.fromDict(requestPayload["retention"])
+      )
+
     payload = {
       "id": modelId,
       "iteration": -1,
@@ -93,8 +310,7 @@ class SpRoute:
       "save": save,
     }
 
-    web.header("Content-Type", "application/json")
-    return json.dumps(payload)
+    return respond(payload)
 
 
   def PUT(self):
@@ -102,7 +318,10 @@ class SpRoute:
     Runs a row of binary input into a Spatial Pooler by id. This method should
     not be used for history extraction, only for running new data.
 
-    No URL params expected.
+    No URL params expected, unless the body is a binary SDR (Content-Type
+    application/x-sdr-indices or application/x-sdr-packed, see wire.py). Then
+    the body is the encoding, and the other params below are URL params, with
+    "states" comma-separated.
 
     POST params:
 
@@ -115,58 +334,70 @@ class SpRoute:
                              are always sent. Otherwise, you can find a list of
                              available states in snapshots.py.
 
-    :return: id, iteration, and requested state from the sp instance in JSON.
-             States are keyed by strings given in POST "states" param.
+    :return: id, iteration, and requested state from the sp instance in JSON
+             (or msgpack, if accepted). States are keyed by strings given in
+             POST "states" param.
     """
-    start = time.time()
-    requestPayload = json.loads(web.data())
+    contentType = web.ctx.env.get("CONTENT_TYPE")
+    binaryEncoding = wire.isBinarySdr(contentType)
+    with metrics.span("parse"):
+      if binaryEncoding:
+        requestPayload = web.input()
+      else:
+        requestPayload = json.loads(web.data())
 
     if "id" not in requestPayload:
       print "Request must include a model id for Spatial Pooler retrieval."
       return web.badrequest()
-    if "encoding" not in requestPayload:
+    if not binaryEncoding and "encoding" not in requestPayload:
       print "Request must include an encoding."
       return web.badrequest()
 
     modelId = requestPayload["id"]
-    encoding = requestPayload["encoding"]
+    checkModelParam(modelId)
 
     requestedStates = []
     if "states" in requestPayload:
       requestedStates = requestPayload["states"]
+      if binaryEncoding:
+        requestedStates = requestedStates.split(",")
 
     learn = False
     if "learn" in requestPayload and requestPayload["learn"] == "true":
       learn = True
 
-    if modelId in modelCache.keys():
-      print "\tFetching SP {} from memory...".format(modelId)
-      sp = modelCache[modelId]["sp"]
-      save = modelCache[modelId]["save"]
-    else:
-      print "\tFetching SP {} from disk...".format(modelId)
-      sp = SpFacade(modelId, ioClient)
-      sp.load()
-      save = True
-
-    iteration = sp.getIteration()
+    with modelCache.lock(modelId):
+      if modelId in modelCache:
+        sp = modelCache[modelId]["sp"]
+        save = modelCache[modelId]["save"]
+      else:
+        print "\tFetching SP {} from disk...".format(modelId)
+        sp = SpFacade(modelId, ioClient)
+        sp.load()
+        save = True
 
-    print "\tEntering SP {} compute cycle iteration {} (Learn: {} Save: {})"\
-      .format(modelId, iteration, learn, save)
-    sp.compute(encoding, learn=learn, save=save, multiprocess=True)
+      if binaryEncoding:
+        try:
+          with metrics.span("parse"):
+            encoding = wire.decodeSdr(
+              web.data(), contentType, sp.getParams()["numInputs"]
+            )
+        except ValueError as e:
+          print e
+          return web.badrequest()
+      else:
+        encoding = requestPayload["encoding"]
 
-    response = {}
-    response["iteration"] = iteration
-    response["id"] = modelId
-    response["state"] = sp.getState(*requestedStates)
+      iteration = sp.getIteration()
 
-    web.header("Content-Type", "application/json")
-    jsonOut = json.dumps(response)
+      sp.compute(encoding, learn=learn, save=save)
 
-    end = time.time()
-    print("\tHTTP SP compute cycle took %g seconds" % (end - start))
+      response = {}
+      response["iteration"] = iteration
+      response["id"] = modelId
+      response["state"] = sp.getState(*requestedStates)
 
-    return jsonOut
+    return respond(response)
 
 
 
@@ -179,20 +410,120 @@ class SpHistoryRoute:
     requestInput = web.input()
     states = requestInput["states"].split(',')
 
-    if modelId in modelCache.keys():
-      print "Fetching SP {} from memory...".format(modelId)
-      sp = modelCache[modelId]["sp"]
-    else:
-      try:
-        print "Fetching SP {} from disk...".format(modelId)
-        sp = SpFacade(modelId, ioClient)
-      except:
-        print "Unknown model id: {}".format(modelId)
-        return web.badrequest()
+    # History is read from disk only, so it never waits on the live model's
+    # lock, nor on anyone computing with it.
+    checkModel(modelId)
 
     history = nupicHistory.getColumnHistory(modelId, int(columnIndex), states)
 
-    return json.dumps(history)
+    return respond(history)
+
+
+
+class SpColumnsHistoryRoute:
+
+  def GET(self, modelId):
+    """
+    Returns the history of many columns and states at once, read in one pass.
+
+    URL params:
+
+    states (string):   Comma-separated SP states.
+    columns (string):  Optional. Comma-separated column indices, default all.
+    start (int):       Optional. First iteration, default 0.
+    stop (int):        Optional. Iteration to stop before, default after the
+                       last one.
+    stride (int):      Optional. Read every stride-th iteration, default 1.
+
+    :return: "iterations", "present" (1 for iterations that were saved) and a
+             dense matrix per state, with a row per iteration and a column per
+             requested column
+    """
+    requestInput = web.input(columns=None, start=0, stop=None, stride=1)
+    states = requestInput["states"].split(',')
+
+    checkModel(modelId)
+
+    columns = None
+    if requestInput["columns"]:
+      columns = [int(column) for column in requestInput["columns"].split(',')]
+    stop = requestInput["stop"]
+    if stop is not None:
+      stop = int(stop)
+    stride = int(requestInput["stride"])
+    if stride < 1:
+      print "Stride must be at least 1."
+      return web.badrequest()
+
+    history = nupicHistory.getColumnsHistory(
+      modelId, states, columns=columns, start=int(requestInput["start"]),
+      stop=stop, stride=stride
+    )
+
+    return respond(history)
+
+
+
+class ActivityRoute:
+
+  def GET(self, modelId):
+    """
+    Answers when columns or cells were active, from the activity index.
+
+    URL params:
+
+    indices (string):     Comma-separated column or cell indices.
+    state (string):       Optional. "activeColumns" (default), "activeCells" or
+                          "predictiveCells".
+    start (int):          Optional. First iteration, default 0.
+    stop (int):           Optional. Iteration to stop before, default none.
+    iterations (string):  Optional. "true" to also list every iteration each
+                          index was active in.
+
+    :return: "activity", with the count, first and last active iteration of
+             each index, and "coactivation", the number of iterations each pair
+             of indices was active together in
+    """
+    requestInput = web.input(
+      state=SP_SNAPS.ACT_COL, start=0, stop=None, iterations="false"
+    )
+
+    checkModel(modelId)
+    state = requestInput["state"]
+    if not ioClient.hasActivityIndex(modelId, state):
+      print "No {} activity index for model {}.".format(state, modelId)
+      return web.notfound()
+
+    indices = [int(index) for index in requestInput["indices"].split(',')]
+    start = int(requestInput["start"])
+    stop = requestInput["stop"]
+    if stop is not None:
+      stop = int(stop)
+
+    activity = ioClient.getActivity(modelId, state, indices, start, stop)
+    if requestInput["iterations"] == "true":
+      for index in indices:
+        activity[index]["iterations"] = ioClient.getActiveIterations(
+          modelId, state, index, start, stop
+        )
+
+    return respond({
+      "state": state,
+      "indices": indices,
+      "activity": activity,
+      "coactivation": ioClient.getCoactivation(
+        modelId, state, indices, start, stop
+      ),
+    })
+
+
+  def POST(self, modelId):
+    """
+    Rebuilds a model's activity index from its saved history.
+    """
+    checkModel(modelId)
+    ioClient.rebuildActivityIndex(modelId)
+    return "Rebuilt activity index of model {}".format(modelId)
 
 
 
@@ -200,21 +531,26 @@ class TmRoute:
 
 
   def POST(self):
-    global modelCache
     params = json.loads(web.data())
     requestInput = web.input()
     id = requestInput["id"]
+    checkModelParam(id)
     # We will always return the active cells because they are cheap.
     returnSnapshots = [TM_SNAPS.ACT_CELLS]
     from pprint import pprint; pprint(params)
     tm = TM(**params)
 
-    tmFacade = TmFacade(tm, ioClient, modelId=id)
+    with modelCache.lock(id):
+      model = modelCache[id]
+      # Starts at the SP's iteration so both histories line up.
+      tmFacade = TmFacade(
+        tm, ioClient, modelId=id, iteration=model["sp"].getIteration()
+      )
 
-    modelId = tmFacade.getId()
-    modelCache[modelId]["tm"] = tmFacade
-    modelCache[modelId]["classifier"] = SDRClassifierFactory.create(implementation="py")
-    modelCache[modelId]["recordsSeen"] = 0
+      modelId = tmFacade.getId()
+      model["tm"] = tmFacade
+      model["classifier"] = SDRClassifierFactory.create(implementation="py")
+      model["recordsSeen"] = 0
 
     print "Created TM {}".format(modelId)
 
@@ -230,12 +566,10 @@ class TmRoute:
     for key in tmState:
       payload[key] = tmState[key]
 
-    web.header("Content-Type", "application/json")
-    return json.dumps(payload)
+    return respond(payload)
 
 
   def PUT(self):
-    requestStart = time.time()
     requestInput = web.input()
     encoding = web.data()
     stateSnapshots = [
@@ -253,13 +587,12 @@ class TmRoute:
       return web.badrequest()
 
     modelId = requestInput["id"]
+    checkModelParam(modelId)
 
-    if modelId not in tmFacades.keys():
+    if modelId not in modelCache or "tm" not in modelCache[modelId]:
       print "Unknown model id {}!".format(modelId)
       return web.badrequest()
 
-    tm = tmFacades[modelId]
-
     learn = True
     if "learn" in requestInput:
       learn = requestInput["learn"] == "true"
@@ -267,50 +600,57 @@ class TmRoute:
     if "reset" in requestInput:
       reset = requestInput["reset"] == "true"
 
-    inputArray = np.array([])
-    if len(encoding):
-      inputArray = np.array([int(bit) for bit in encoding.split(",")])
-
-    print "Entering TM {} compute cycle | Learning: {}".format(modelId, learn)
-    tm.compute(inputArray.tolist(), learn=learn)
-
-    response = tm.getState(*stateSnapshots)
+    try:
+      with metrics.span("parse"):
+        inputArray = wire.decodeSdrIndices(
+          encoding, web.ctx.env.get("CONTENT_TYPE")
+        )
+    except ValueError as e:
+      print e
+      return web.badrequest()
 
-    if reset:
-      print "Resetting TM."
-      tm.reset()
+    with modelCache.lock(modelId):
+      model = modelCache[modelId]
+      tm = model["tm"]
+      tm.compute(inputArray, learn=learn, save=model["save"])
 
-    web.header("Content-Type", "application/json")
-    jsonOut = json.dumps(response)
+      response = tm.getState(*stateSnapshots)
 
-    requestEnd = time.time()
-    print("\tTM compute cycle took %g seconds" % (requestEnd - requestStart))
+      if reset:
+        tm.reset()
 
-    return jsonOut
+    return respond(response)
 
 
 class ComputeRoute:
 
   def PUT(self):
-    requestStart = time.time()
+    """
+    Runs one record through the SP, TM and classifier of a model.
+
+    The body is the input encoding: comma-separated bits by default, or a
+    binary SDR (Content-Type application/x-sdr-indices or
+    application/x-sdr-packed, see wire.py). Everything else comes in URL
+    params. Responds in JSON, or msgpack if accepted.
+    """
     requestInput = web.input()
     encoding = web.data()
-    spSnapshots = [
-      SP_SNAPS.ACT_COL,
-    ]
+    # Active columns and active cells always come back from computeRecord.
+    spSnapshots = []
     tmSnapshots = [
-      TM_SNAPS.ACT_CELLS,
       TM_SNAPS.PRD_CELLS,
     ]
 
     for snap in SP_SNAPS.listValues():
       getString = "get{}{}".format(snap[:1].upper(), snap[1:])
-      if getString in requestInput and requestInput[getString] == "true":
+      if getString in requestInput and requestInput[getString] == "true" \
+          and snap != SP_SNAPS.ACT_COL:
         spSnapshots.append(snap)
 
     for snap in TM_SNAPS.listValues():
       getString = "get{}{}".format(snap[:1].upper(), snap[1:])
-      if getString in requestInput and requestInput[getString] == "true":
+      if getString in requestInput and requestInput[getString] == "true" \
+          and snap not in [TM_SNAPS.ACT_CELLS, TM_SNAPS.PRD_CELLS]:
         tmSnapshots.append(snap)
 
     if "id" not in requestInput:
@@ -318,8 +658,9 @@ class ComputeRoute:
       return web.badrequest()
 
     modelId = requestInput["id"]
+    checkModelParam(modelId)
 
-    if modelId not in modelCache.keys():
+    if modelId not in modelCache:
       print "Unknown Model id {}!".format(modelId)
       return web.badrequest()
 
@@ -329,17 +670,6 @@ class ComputeRoute:
     if "spLearn" in requestInput:
       spLearn = requestInput["spLearn"] == "true"
 
-    inputArray = np.array([])
-    if len(encoding):
-      inputArray = np.array([int(bit) for bit in encoding.split(",")])
-
-    print "Entering SP {} compute cycle | Learning: {}".format(modelId, spLearn)
-    sp.compute(inputArray, learn=spLearn)
-    spResults = sp.getState(*spSnapshots)
-    activeColumns = spResults[SP_SNAPS.ACT_COL]['indices']
-
-    tm = modelCache[modelId]["tm"]
-
     tmLearn = True
     if "tmLearn" in requestInput:
       tmLearn = requestInput["tmLearn"] == "true"
@@ -348,61 +678,413 @@ class ComputeRoute:
     if "reset" in requestInput:
       reset = requestInput["reset"] == "true"
 
-    print "Entering TM {} compute cycle | Learning: {}".format(modelId, tmLearn)
-    tm.compute(activeColumns, learn=tmLearn)
+    try:
+      with metrics.span("parse"):
+        inputArray = wire.decodeSdr(
+          encoding, web.ctx.env.get("CONTENT_TYPE"),
+          sp.getParams()["numInputs"]
+        )
+    except ValueError as e:
+      print e
+      return web.badrequest()
+
+    completeResults = computeRecord(
+      modelId, inputArray,
+      int(requestInput["bucketIdx"]), requestInput["actValue"],
+      spLearn=spLearn, tmLearn=tmLearn, reset=reset,
+      spSnapshots=spSnapshots, tmSnapshots=tmSnapshots
+    )
 
-    tmResults = tm.getState(*tmSnapshots)
+    return respond(completeResults)
 
-    c = modelCache[modelId]["classifier"]
-    bucketIdx = int(requestInput["bucketIdx"])
-    actValue = requestInput["actValue"]
-    recordNum = int(modelCache[modelId]["recordsSeen"])
 
-    # inference
-    inference = c.compute(
-      recordNum=recordNum, patternNZ=tmResults[TM_SNAPS.ACT_CELLS],
-      classification={"bucketIdx": bucketIdx, "actValue": actValue},
-      learn=True, infer=True
+
+class BatchComputeRoute:
+
+  def PUT(self):
+    """
+    Runs many records through the SP, TM and classifier of a model in one
+    request, back to back.
+
+    Body (JSON, or msgpack with Content-Type application/msgpack):
+
+    id (string):            The model ID.
+    records (object array): One per record, in order, each with:
+                              encoding (bit array) or indices (on-bit array)
+                              bucketIdx (int)
+                              actValue
+                              reset (bool, optional): reset the TM after it
+    spLearn, tmLearn (bool): Optional, default true.
+    spStates, tmStates (string arrays): Optional states to return besides
+                             active columns, active cells and predictive cells.
+    returnStates:            Which records get states back: "all" (default),
+                             "last", "none", or an array of record indices.
+                             Every record gets its "inference" back.
+
+    :return: id and a "records" array lined up with the request's.
+    """
+    with metrics.span("parse"):
+      request = wire.decode(web.data(), web.ctx.env.get("CONTENT_TYPE"))
+
+    if "id" not in request or "records" not in request:
+      print "Request must include a model id and records."
+      return web.badrequest()
+
+    modelId = request["id"]
+    checkModelParam(modelId)
+    if modelId not in modelCache or "tm" not in modelCache[modelId]:
+      print "Unknown Model id {}!".format(modelId)
+      return web.badrequest()
+
+    records = request["records"]
+    spLearn = request.get("spLearn", True)
+    tmLearn = request.get("tmLearn", True)
+    spSnapshots, tmSnapshots = selectSnapshots(
+      request.get("spStates"), request.get("tmStates")
     )
 
-    # Print the top three predictions for 1 steps out.
-    topPredictions = sorted(
-      zip(
-        inference[1], inference["actualValues"]
-      ), reverse=True
-    )[:3]
-    for probability, value in topPredictions:
-      print "Prediction of {} has probability of {}.".format(
-        value, probability*100.0
+    returnStates = request.get("returnStates", "all")
+    if returnStates == "all":
+      returnStates = set(xrange(len(records)))
+    elif returnStates == "last":
+      returnStates = set([len(records) - 1])
+    elif returnStates == "none":
+      returnStates = set()
+    else:
+      returnStates = set(returnStates)
+
+    numInputs = modelCache[modelId]["sp"].getParams()["numInputs"]
+    out = []
+    # Held across the batch so no other request interleaves with its records.
+    with modelCache.lock(modelId):
+      for i, record in enumerate(records):
+        results = computeRecord(
+          modelId, decodeRecord(record, numInputs),
+          int(record["bucketIdx"]), record["actValue"],
+          spLearn=spLearn, tmLearn=tmLearn, reset=record.get("reset", False),
+          spSnapshots=spSnapshots if i in returnStates else None,
+          tmSnapshots=tmSnapshots if i in returnStates else None
+        )
+        if i not in returnStates:
+          results = {"inference": results["inference"]}
+        out.append(results)
+
+    return respond({"id": modelId, "records": out})
+
+
+
+class StreamRoute:
+
+
+  def POST(self, modelId):
+    """
+    Opens a streaming session for a model, or returns the one already open.
+    Records PUT to the session run through the SP, TM and classifier on the
+    session's own thread, and their results are read back with GET.
+
+    Body (JSON, optional):
+
+    window (int):            Max records submitted but not yet read back.
+                             Default 16.
+    spLearn, tmLearn (bool): Optional, default true.
+    spStates, tmStates (string arrays): Optional states to return with every
+                             record, as in batch compute.
+    """
+    checkModelParam(modelId)
+    if modelId not in modelCache or "tm" not in modelCache[modelId]:
+      print "Unknown Model id {}!".format(modelId)
+      return web.badrequest()
+
+    session = streamSessions.get(modelId)
+    if session is None or session.isClosed():
+      data = web.data()
+      request = json.loads(data) if len(data) > 0 else {}
+      spLearn = request.get("spLearn", True)
+      tmLearn = request.get("tmLearn", True)
+      spSnapshots, tmSnapshots = selectSnapshots(
+        request.get("spStates"), request.get("tmStates")
       )
+      numInputs = modelCache[modelId]["sp"].getParams()["numInputs"]
+
+      def compute(record):
+        return computeRecord(
+          modelId, decodeRecord(record, numInputs),
+          int(record["bucketIdx"]), record["actValue"],
+          spLearn=spLearn, tmLearn=tmLearn, reset=record.get("reset", False),
+          spSnapshots=spSnapshots, tmSnapshots=tmSnapshots
+        )
+
+      session = StreamSession(
+        modelId, compute, window=int(request.get("window", 16))
+      )
+      streamSessions[modelId] = session
+      print "Opened stream for model {}".format(modelId)
 
-    if reset:
-      print "Resetting TM."
-      tm.reset()
+    return respond({"id": modelId, "stats": session.getStats()})
+
+
+  def PUT(self, modelId):
+    """
+    Submits records to a model's open stream. Either all of them fit in the
+    stream's window or none are taken, and the response is 503.
 
-    completeResults = {}
-    completeResults.update(spResults)
-    completeResults.update(tmResults)
-    completeResults["inference"] = topPredictions
+    Body (JSON, or msgpack with Content-Type application/msgpack):
 
+    records (object array): One per record, as in batch compute.
+
+    URL params:
+
+    timeout (float): Optional. Seconds to wait for room in the window.
+
+    :return: the records' sequence numbers, which their results carry
+    """
+    session = streamSessions.get(modelId)
+    if session is None or session.isClosed():
+      print "No open stream for model {}!".format(modelId)
+      return web.badrequest()
+    with metrics.span("parse"):
+      request = wire.decode(web.data(), web.ctx.env.get("CONTENT_TYPE"))
+    requestInput = web.input()
+    timeout = None
+    if "timeout" in requestInput:
+      timeout = float(requestInput["timeout"])
+    try:
+      seqs = session.submit(request["records"], timeout=timeout)
+    except ValueError as e:
+      print e
+      return web.badrequest()
+    except RuntimeError as e:
+      print e
+      web.ctx.status = "503 Service Unavailable"
+      return respond({"id": modelId, "stats": session.getStats()})
+    return respond({"id": modelId, "seqs": seqs})
+
+
+  def GET(self, modelId):
+    """
+    Streams a model's results as server-sent events, one "result" event per
+    record, in the order records were submitted. Each event's data is JSON
+    with "seq" and either "result" or "error". A comment line is sent every
+    few seconds while there is nothing to send, to keep the connection open.
+    """
+    session = streamSessions.get(modelId)
+    if session is None or session.isClosed():
+      print "No open stream for model {}!".format(modelId)
+      raise web.badrequest()
+    web.header("Content-Type", "text/event-stream")
+    web.header("Cache-Control", "no-cache")
+    while not session.isClosed():
+      event = session.next(timeout=5)
+      if event is None:
+        yield ": keepalive\n\n"
+      else:
+        yield "event: result\ndata: {}\n\n".format(
+          wire.encode(event, wire.JSON)
+        )
+
+
+  def DELETE(self, modelId):
+    """
+    Closes a model's stream. Records not computed yet are dropped.
+    """
+    session = streamSessions.pop(modelId, None)
+    if session is None:
+      return web.notfound()
+    session.close()
+    print "Closed stream for model {}".format(modelId)
+    return respond({"id": modelId, "stats": session.getStats()})
+
+
+
+class WritesRoute:
+
+
+  def GET(self):
+    """
+    Returns write queue depth and write latency stats.
+    """
+    web.header("Content-Type", "application/json")
+    return json.dumps(writeQueue.getStats())
+
+
+  def POST(self):
+    """
+    Blocks until every queued write is on disk.
+
+    URL params:
+
+    timeout (float): Optional. Seconds to wait before giving up.
+    """
+    requestInput = web.input()
+    timeout = None
+    if "timeout" in requestInput:
+      timeout = float(requestInput["timeout"])
+    drained = ioClient.flush(timeout=timeout)
+    web.header("Content-Type", "application/json")
+    return json.dumps({
+      "drained": drained,
+      "stats": writeQueue.getStats(),
+    })
+
+
+
+class CodecsRoute:
+
+
+  def GET(self):
+    """
+    Returns, per snapshot kind, the codec it is written with, its compression
+    ratio and the mean encode and decode times.
+    """
     web.header("Content-Type", "application/json")
-    jsonOut = json.dumps(completeResults)
+    return json.dumps(ioClient.getCodecStats())
+
+
+
+class MetricsRoute:
+
+
+  def GET(self):
+    """
+    Returns latency histograms per stage (parse, SP/TM/classifier compute,
+    each snapshot, serialization, disk reads and writes), overall and per
+    model, plus byte counters.
+    """
+    web.header("Content-Type", "application/json")
+    return json.dumps(metrics.getStats())
+
+
+  def DELETE(self):
+    """
+    Clears all metrics.
+    """
+    metrics.reset()
+    return "Metrics cleared"
+
 
-    requestEnd = time.time()
-    print("\tFULL compute cycle took %g seconds" % (requestEnd - requestStart))
 
-    modelCache[modelId]["recordsSeen"] += 1
+class CacheRoute:
+
+
+  def GET(self):
+    """
+    Returns model cache hit, miss and eviction counters, along with the
+    snapshot cache's under "snapshots".
+    """
+    stats = modelCache.getStats()
+    stats["snapshots"] = ioClient.getSnapshotCache().getStats()
+    web.header("Content-Type", "application/json")
+    return json.dumps(stats)
+
+
+
+class ModelRoute:
+
+
+  def GET(self, modelId):
+    """
+    Returns what history is stored for a model: iterations, snapshot kinds
+    and their sizes in bytes.
+    """
+    checkModel(modelId)
+    web.header("Content-Type", "application/json")
+    return json.dumps(ioClient.getModelIndex(modelId))
+
+
+  def DELETE(self, modelId):
+    """
+    Removes one model from memory and deletes its history.
+    """
+    checkModel(modelId, inMemory=True)
+    if modelId in streamSessions:
+      streamSessions.pop(modelId).close()
+    with modelCache.lock(modelId):
+      modelCache.discard(modelId)
+      ioClient.delete(modelId)
+    metrics.forgetModel(modelId)
+    compactor.forgetModel(modelId)
+    return "Deleted model {}".format(modelId)
+
+
+
+class RetentionRoute:
+
+
+  def GET(self, modelId):
+    """
+    Returns a model's retention policy, or null if it keeps everything.
+    """
+    checkModel(modelId)
+    policy = ioClient.getRetentionPolicy(modelId)
+    web.header("Content-Type", "application/json")
+    return json.dumps(None if policy is None else policy.toDict())
+
+
+  def PUT(self, modelId):
+    """
+    Sets how much of a model's history the compactor keeps.
+
+    PUT params:
+
+    keepLast (int):      Latest iterations kept at full fidelity.
+    every (int):         Optional. Older iterations keep their SP and TM state
+                         only every this many iterations. Default 1.
+    sdrOnlyAfter (int):  Optional. Iterations this old keep only their SDRs.
+                         Default never.
+    """
+    checkModel(modelId)
+    try:
+      policy = RetentionPolicy.fromDict(json.loads(web.data()))
+    except (KeyError, ValueError) as e:
+      print "Invalid retention policy: {}".format(e)
+      return web.badrequest()
+    ioClient.setRetentionPolicy(modelId, policy)
+    web.header("Content-Type", "application/json")
+    return json.dumps(policy.toDict())
+
+
+  def DELETE(self, modelId):
+    """
+    Keeps all of a model's history from now on. What was compacted is gone.
+    """
+    checkModel(modelId)
+    ioClient.setRetentionPolicy(modelId, None)
+    return "Model {} keeps all history".format(modelId)
+
+
+
+class CompactRoute:
+
+
+  def GET(self):
+    """
+    Returns compactor stats: runs, duration of the last one, errors, and bytes
+    reclaimed in total and per model.
+    """
+    web.header("Content-Type", "application/json")
+    return json.dumps(compactor.getStats())
+
+
+  def POST(self):
+    """
+    Starts a compaction run now, in the background.
+    """
+    compactor.runSoon()
+    web.header("Content-Type", "application/json")
+    return json.dumps(compactor.getStats())
 
-    return jsonOut
 
 
 class RoyalFlush:
 
 
   def DELETE(self):
-    global modelCache
+    for session in streamSessions.values():
+      session.close()
+    streamSessions.clear()
     ioClient.nuke()
-    modelCache = {}
+    modelCache.clear()
+    metrics.reset()
     return "NuPIC History Server got NUKED!"
 
 